@@ -17,7 +17,7 @@ from scipy.cluster.hierarchy import linkage
 from scipy.spatial.distance import pdist
 from .fitter import Fitter
 from .utils.be_loop import projectLoop, fit_loop, generate_guess, calc_switching_coef_vec, switching32
-from ..processing.tree import ClusterTree
+from ..processing.tree import LinkageTree
 from .be_sho_fitter import sho32
 from .fit_methods import BE_Fit_Methods
 from .optimize import Optimize
@@ -974,43 +974,6 @@ class BELoopFitter(Fitter):
             
         """
 
-        def _loop_fit_tree(tree, guess_mat, fit_results, vdc_shifted, shift_ind):
-            """
-            Recursive function that fits a tree object describing the cluster results
-
-            Parameters
-            ----------
-            tree : ClusterTree object
-                Tree describing the clustering results
-            guess_mat : 1D numpy float array
-                Loop parameters that serve as guesses for the loops in the tree
-            fit_results : 1D numpy float array
-                Loop parameters that serve as fits for the loops in the tree
-            vdc_shifted : 1D numpy float array
-                DC voltages shifted be 1/4 cycle
-            shift_ind : unsigned int
-                Number of units to shift loops by
-
-            Returns
-            -------
-            guess_mat : 1D numpy float array
-                Loop parameters that serve as guesses for the loops in the tree
-            fit_results : 1D numpy float array
-                Loop parameters that serve as fits for the loops in the tree
-                
-            """
-            # print('Now fitting cluster #{}'.format(tree.name))
-            # I already have a guess. Now fit myself
-            curr_fit_results = fit_loop(vdc_shifted, np.roll(tree.value, shift_ind), guess_mat[tree.name])
-            # keep all the fit results
-            fit_results[tree.name] = curr_fit_results
-            for child in tree.children:
-                # Use my fit as a guess for the lower layers:
-                guess_mat[child.name] = curr_fit_results[0].x
-                # Fit this child:
-                guess_mat, fit_mat = _loop_fit_tree(child, guess_mat, fit_results, vdc_shifted, shift_ind)
-            return guess_mat, fit_results
-
         num_clusters = max(2, int(projected_loops_2d.shape[0] ** 0.5))  # change this to 0.6 if necessary
         estimators = KMeans(num_clusters)
         results = estimators.fit(projected_loops_2d)
@@ -1025,10 +988,10 @@ class BELoopFitter(Fitter):
         linkage_pairing[:, 2] = linkage_pairing[:, 2] / max(linkage_pairing[:, 2])
 
         # Now use the tree class:
-        cluster_tree = ClusterTree(linkage_pairing[:, :2], labels,
+        cluster_tree = LinkageTree(linkage_pairing[:, :2], labels,
                                    distances=linkage_pairing[:, 2],
                                    centroids=centroids)
-        num_nodes = len(cluster_tree.nodes)
+        num_nodes = cluster_tree.num_nodes
 
         # prepare the guess and fit matrices
         loop_guess_mat = np.zeros(shape=(num_nodes, 9), dtype=np.float32)
@@ -1038,16 +1001,21 @@ class BELoopFitter(Fitter):
         shift_ind, vdc_shifted = BELoopFitter.shift_vdc(vdc_vec)
 
         # guess the top (or last) node
-        loop_guess_mat[-1] = generate_guess(vdc_vec, cluster_tree.tree.value)
+        loop_guess_mat[-1] = generate_guess(vdc_vec, cluster_tree.centroids[cluster_tree.root])
 
-        # Now guess the rest of the tree
-        loop_guess_mat, loop_fit_results = _loop_fit_tree(cluster_tree.tree, loop_guess_mat, loop_fit_results,
-                                                          vdc_shifted, shift_ind)
+        # Now guess the rest of the tree. Every node is fit before its children
+        for node in cluster_tree.get_top_down_order():
+            curr_fit_results = fit_loop(vdc_shifted, np.roll(cluster_tree.centroids[node], shift_ind),
+                                        loop_guess_mat[node])
+            # keep all the fit results
+            loop_fit_results[node] = curr_fit_results
+            # Use my fit as a guess for the lower layers:
+            loop_guess_mat[cluster_tree.get_children(node)] = curr_fit_results[0].x
 
         # Prepare guesses for each pixel using the fit of the cluster it belongs to:
         guess_parms = np.zeros(shape=projected_loops_2d.shape[0], dtype=loop_fit32)
         for clust_id in range(num_clusters):
-            pix_inds = np.where(labels == clust_id)[0]
+            pix_inds = cluster_tree.get_members(clust_id)
             temp = np.atleast_2d(loop_fit_results[clust_id][0].x)
             # convert to the appropriate dtype as well:
             r2 = 1 - np.sum(np.abs(loop_fit_results[clust_id][0].fun ** 2))
@@ -5,6 +5,23 @@
 from __future__ import division, print_function, absolute_import
 import numpy as np
 import h5py as h5
+from scipy import ndimage, sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from ...processing.fft import FilterCache
+
+# Spectra of the filter kernels, keyed by the filter, its parameters and the image shape
+_kernel_cache = FilterCache(max_size=16)
+
+
+def _correlate_fft(images_fft, kernel_fft, fft_shape, img_shape):
+    """
+    Inverse real FFT of the product of image and kernel spectra, cropped to the original image shape
+    """
+    corr = np.fft.irfft2(images_fft * kernel_fft, s=fft_shape)
+    return corr[..., :img_shape[0], :img_shape[1]]
+
 
 def apply_select_channel(file_in_h5, img_num, channel_num):
     main_h5_handle = h5.File(file_in_h5, 'r+')
@@ -73,6 +90,49 @@ def apply_select_channel(file_in_h5, img_num, channel_num):
     return 1
 
 
+def wiener_filter(images, blur=1.1, noise_levels=None):
+    """
+    Wiener deconvolution of one or more images with an exponentially decaying blur kernel. The noise level giving the
+    lowest standard deviation of the deconvolved image is picked for each image.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Image or stack of images with the rows and columns as the last two dimensions
+    blur : float, optional
+        Decay constant of the blur kernel. Default 1.1
+    noise_levels : 1D array-like, optional
+        Noise to signal ratios to try. Default 100 values between 0.001 and 1
+
+    Returns
+    -------
+    filtered : numpy.ndarray
+        Magnitude of the deconvolved images, shaped as images
+    """
+    images = np.asarray(images, dtype=np.float64)
+    if noise_levels is None:
+        noise_levels = np.linspace(.001, 1, 100)
+    img_shape = images.shape[-2:]
+
+    def get_blur_spectrum():
+        h = (blur / 2 * np.pi) ** (-blur * np.sqrt(np.arange(img_shape[0])[:, None] ** 2 +
+                                                   np.arange(img_shape[1])[None, :] ** 2))
+        return np.fft.rfft2(h / np.sum(h))
+
+    blur_fft = _kernel_cache.fetch(('wiener', img_shape, blur), get_blur_spectrum)
+    images_fft = np.fft.rfft2(images)
+    blur_conj = np.conj(blur_fft)
+    blur_power = np.abs(blur_fft) ** 2
+
+    errors = np.zeros(images.shape[:-2] + (len(noise_levels),))
+    for k_ind, noise in enumerate(noise_levels):
+        filtered = np.fft.irfft2(blur_conj / (blur_power + noise) * images_fft, s=img_shape)
+        errors[..., k_ind] = np.std(np.abs(filtered), axis=(-2, -1))
+
+    best_noise = np.asarray(noise_levels)[np.argmin(errors, axis=-1)][..., None, None]
+    return np.abs(np.fft.irfft2(blur_conj / (blur_power + best_noise) * images_fft, s=img_shape))
+
+
 def apply_wiener_filter(file_in_h5, img_num, filter_num):
     import numpy as np
     import h5py as h5
@@ -106,40 +166,9 @@ def apply_wiener_filter(file_in_h5, img_num, filter_num):
     img = np.empty([max(posi_ind[:, 0]), max(posi_ind[:, 1])], dtype=h5_image.dtype)
     img[posi_ind[:, 0] - 1, posi_ind[:, 1] - 1] = img2[0:len(img2), 0]
 
-    # test shape doe wiener filter
-    s = 1.1  # constant for now change latter
-
-    size = img.shape
-    h = np.empty(size)
-    width = size[0]
-    height = size[1]
-    for x in range(0, width):
-        for y in range(0, height):
-            h[x, y] = (s / 2 * 3.141592) ** (-s * np.sqrt(x ** 2 + y ** 2))
-    h = h / np.sum(np.sum(h))
-    H = np.fft.fft2(h)
-    K = np.linspace(.001, 1, 100)
-    G = np.fft.fft2(img)
-    errorV = np.empty([1, 100])
-    errorV = errorV[0]
-    for k1 in range(0, 100):
-        W = np.conj(H) / (np.abs(H) ** 2 + K[k1])
-        F = W * G
-        R = np.abs(np.fft.ifft2(F))
-        errorV[k1] = np.std(np.reshape(R, [1, width * height]))
-
-    # use best option 
-    minv = np.min(errorV)
-    minl = np.where(errorV == minv)
-    minl = minl[0]
-    minl = minl[0]
-    W = np.conj(H) / (np.abs(H) ** 2 + K[minl])
-    F = W * G
-    img = np.fft.ifft2(F)
+    img = wiener_filter(img)
 
     img = img.reshape(len(img2), 1)
-    img = abs(img)
-    img = np.real(img)
 
     image_path = "/Frame_%04i/Channel_Current" % img_num
     for x in range(0, filter_num + 2):
@@ -173,6 +202,71 @@ def apply_wiener_filter(file_in_h5, img_num, filter_num):
     return 1
 
 
+def gaussian_corr_filter(images, gauss_width, gauss_box_width):
+    """
+    Pearson correlation coefficient between a gaussian and the window of the image centered at every pixel. Windows
+    at the edges are cropped to the image, as is the gaussian.
+
+    The sums over the windows are computed as correlations in Fourier space, so the cost does not depend on the
+    window size. The correlations of the image outline with the gaussian and the window, which only depend on the
+    image shape, are cached.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Image or stack of images with the rows and columns as the last two dimensions
+    gauss_width : float
+        Standard deviation of the gaussian
+    gauss_box_width : unsigned int
+        Half-width of the window
+
+    Returns
+    -------
+    corr : numpy.ndarray
+        Correlation coefficients, shaped as images
+    """
+    images = np.asarray(images, dtype=np.float64)
+    img_shape = images.shape[-2:]
+    fft_shape = (img_shape[0] + gauss_box_width, img_shape[1] + gauss_box_width)
+
+    key = (img_shape, gauss_width, gauss_box_width)
+
+    def get_gauss_spectra():
+        offsets = np.arange(-gauss_box_width, gauss_box_width + 1)
+        [xx, yy] = np.meshgrid(offsets, offsets)
+        gaus = fun_2d_gaussian(xx, yy, [1, 0, 0, gauss_width, gauss_width, 0])
+        spectra = []
+        for kernel in [np.ones(gaus.shape), gaus, gaus ** 2]:
+            # flipped and wrapped around so that the product of spectra correlates instead of convolving
+            kernel_mat = np.zeros(fft_shape)
+            kernel_mat[np.ix_(-offsets % fft_shape[0], -offsets % fft_shape[1])] = kernel
+            spectra.append(np.fft.rfft2(kernel_mat))
+        return np.array(spectra)
+
+    spectra = _kernel_cache.fetch(('gauss_corr_spectra',) + key, get_gauss_spectra)
+
+    def get_window_sums():
+        outline_fft = np.fft.rfft2(np.ones(img_shape), s=fft_shape)
+        num_pix, sum_g, sum_g2 = [_correlate_fft(outline_fft, spectrum, fft_shape, img_shape)
+                                  for spectrum in spectra]
+        num_pix = np.round(num_pix)
+        return np.array([num_pix, sum_g, np.maximum(sum_g2 - sum_g ** 2 / num_pix, 0)])
+
+    num_pix, sum_g, var_g = _kernel_cache.fetch(('gauss_corr_sums',) + key, get_window_sums)
+    box_fft, gauss_fft = spectra[:2]
+    # the coefficient does not depend on the offset of the image, which would otherwise cost precision
+    images = images - np.mean(images, axis=(-2, -1), keepdims=True)
+    images_fft = np.fft.rfft2(images, s=fft_shape)
+    sum_w = _correlate_fft(images_fft, box_fft, fft_shape, img_shape)
+    sum_gw = _correlate_fft(images_fft, gauss_fft, fft_shape, img_shape)
+    sum_w2 = _correlate_fft(np.fft.rfft2(images ** 2, s=fft_shape), box_fft, fft_shape, img_shape)
+
+    covariance = sum_gw - sum_g * sum_w / num_pix
+    var_w = np.maximum(sum_w2 - sum_w ** 2 / num_pix, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / np.sqrt(var_g * var_w)
+
+
 def apply_gaussian_corr_filter(file_in_h5, img_num, filter_num, gauss_width, gauss_box_width):
     import numpy as np
     import h5py as h5
@@ -206,24 +300,7 @@ def apply_gaussian_corr_filter(file_in_h5, img_num, filter_num, gauss_width, gau
     img = np.empty([max(posi_ind[:, 0]), max(posi_ind[:, 1])], dtype=h5_image.dtype)
     img[posi_ind[:, 0] - 1, posi_ind[:, 1] - 1] = img2[0:len(img2), 0]
 
-    gauss_cell = [1, 0, 0, gauss_width, gauss_width, 0]
-
-    s1 = len(img[:, 0])
-    s2 = len(img[0, :])
-    new_deconv = np.zeros([s1, s2])
-
-    for k1 in range(0, s1):
-        for k2 in range(0, s2):
-            x_min = max([-gauss_box_width, -k1])
-            x_max = min([gauss_box_width, (s1 - k1 - 1)])
-            y_min = max([-gauss_box_width, -k2])
-            y_max = min([gauss_box_width, (s2 - k2 - 1)])
-            [xx, yy] = np.meshgrid(range(y_min, y_max + 1), range(x_min, x_max + 1))
-            gaus = fun_2d_gaussian(xx, yy, gauss_cell)
-            temp = np.corrcoef(gaus.reshape([1, gaus.size]),
-                               img[k1 + x_min:k1 + x_max + 1,
-                               k2 + y_min:k2 + y_max + 1].reshape([1, gaus.size]))
-            new_deconv[k1, k2] = temp[0, 1]
+    new_deconv = gaussian_corr_filter(img, gauss_width, gauss_box_width)
 
     image_path = "/Frame_%04i/Channel_Current" % img_num
     for x in range(0, filter_num + 2):
@@ -377,6 +454,27 @@ def apply_find(file_path_h5, file_name_h5, file_path_png, file_name_png, filter_
     return 1
 
 
+def binarize_images(images, thresholds):
+    """
+    Binarizes one or more images at every one of the given thresholds
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Image or stack of images
+    thresholds : 1D array-like
+        Values above which pixels are set
+
+    Returns
+    -------
+    binary : numpy.ndarray
+        Boolean array arranged as [threshold, ...] with the remaining dimensions shaped as images
+    """
+    images = np.asarray(images)
+    thresholds = np.asarray(thresholds)
+    return images[None] > thresholds.reshape((-1,) + (1,) * images.ndim)
+
+
 def apply_binarization_filter(file_in_h5, img_num, filter_num):
     main_h5_handle = h5.File(file_in_h5, 'r+')
     image_path = "/Frame_%04i/Channel_Current" % img_num
@@ -410,17 +508,9 @@ def apply_binarization_filter(file_in_h5, img_num, filter_num):
     i_diff = i_max - i_min
 
     max_r = 49
-    filter_img = np.zeros([max_r + 1, len(img)])
-    time_out = np.zeros([max_r + 1, 1])
-    time_out_i = np.zeros([max_r + 1, 1])
-
-    for x in range(0, max_r + 1):
-        temp = np.zeros([len(img), 1])
-        r = x / max_r
-        temp[img > (i_min + (i_diff * r))] = 1
-        filter_img[x, :] = temp[:, 0]
-        time_out[x] = r
-        time_out_i[x] = x + 1
+    time_out = np.arange(max_r + 1).reshape(-1, 1) / max_r
+    time_out_i = np.arange(1, max_r + 2, dtype=np.float64).reshape(-1, 1)
+    filter_img = np.float64(binarize_images(np.ravel(img), i_min + i_diff * time_out[:, 0]))
 
     image_path = "/Frame_%04i/Channel_Current" % img_num
     for x in range(0, filter_num + 2):
@@ -520,11 +610,8 @@ def apply_binarization_filter_select(file_in_h5, img_num, filter_num, threshold)
     i_diff = i_max - i_min
 
     max_r = 49.0
-    filter_img = np.zeros([1, len(img)])
-    temp = np.zeros([len(img), 1])
     r = threshold / max_r
-    temp[img > (i_min + (i_diff * r))] = 1
-    filter_img = temp[:, 0]
+    filter_img = np.float64(binarize_images(np.ravel(img), [i_min + (i_diff * r)])[0])
 
     image_path = "/Frame_%04i/Channel_Current" % img_num
     for x in range(0, filter_num + 2):
@@ -679,84 +766,102 @@ def cluster_into_atomic_columns(file_in_h5, img_num, filter_num, dist_val):
     main_h5_handle.close()
 
 
-def cluster_2d_oleg(mat_in, dist_val):
-    import numpy as np
+def label_clusters_2d(mat_in, dist_val):
+    """
+    Groups the nonzero pixels of an image into clusters of pixels that are linked through chains of pixels no further
+    than dist_val apart (city block distance).
+
+    Touching pixels are first grouped into connected components with scipy.ndimage.label. Components whose edge
+    pixels lie within dist_val of each other are then merged using a KD-tree, so the cost scales with the number of
+    edge pixels rather than the square of the number of pixels.
+
+    Parameters
+    ----------
+    mat_in : 2D numpy.ndarray
+        Binarized image
+    dist_val : float
+        Largest city block distance between linked pixels
+
+    Returns
+    -------
+    points : 2D numpy.ndarray
+        Row and column of every nonzero pixel, in the order of numpy.argwhere
+    labels : 1D numpy.ndarray
+        Cluster of each pixel. Clusters are numbered in the order of their first pixel
+    num_clusters : unsigned int
+        Number of clusters
+    """
+    foreground = np.asarray(mat_in) != 0
+    link_dist = np.floor(dist_val)
+    if link_dist >= 2:
+        structure = np.ones((3, 3), dtype=bool)
+    elif link_dist == 1:
+        structure = ndimage.generate_binary_structure(2, 1)
+    else:
+        structure = np.zeros((3, 3), dtype=bool)
+        structure[1, 1] = True
+    label_mat, num_comps = ndimage.label(foreground, structure=structure)
+    points = np.argwhere(foreground)
+    labels = label_mat[foreground] - 1
+
+    if link_dist >= 2 and num_comps > 1:
+        # The closest pixels of two components always lie on their edges
+        edges = np.logical_and(foreground, np.logical_not(ndimage.binary_erosion(foreground, border_value=1)))
+        edge_points = np.argwhere(edges)
+        edge_labels = label_mat[edges] - 1
+        pairs = np.array(list(cKDTree(edge_points).query_pairs(link_dist, p=1)), dtype=np.int64).reshape(-1, 2)
+        pairs = edge_labels[pairs]
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        graph = sparse.coo_matrix((np.ones(pairs.shape[0]), (pairs[:, 0], pairs[:, 1])),
+                                  shape=(num_comps, num_comps))
+        _, comp_clusters = connected_components(graph, directed=False)
+        labels = comp_clusters[labels]
+
+    # number the clusters in the order of their first pixel
+    _, first_inds, labels = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first_inds))
+    return points, order[labels], first_inds.size
+
+
+def cluster_2d_centers(mat_in, dist_val):
+    """
+    Geometric centers and sizes of the clusters of label_clusters_2d
+
+    Parameters
+    ----------
+    mat_in : 2D numpy.ndarray
+        Binarized image
+    dist_val : float
+        Largest city block distance between linked pixels
+
+    Returns
+    -------
+    centers : 2D numpy.ndarray
+        Mean row and column of the pixels of each cluster
+    sizes : 1D numpy.ndarray
+        Number of pixels in each cluster
+    """
+    points, labels, num_clusters = label_clusters_2d(mat_in, dist_val)
+    sizes = np.bincount(labels, minlength=num_clusters)
+    centers = np.zeros((num_clusters, 2))
+    for axis in range(2):
+        centers[:, axis] = np.bincount(labels, weights=points[:, axis], minlength=num_clusters)
+    centers /= np.maximum(sizes, 1)[:, None]
+    return centers, sizes
 
-    tt = [0, 0]
-    clusters = []
-    to_cluster = np.argwhere(mat_in)
-    to_cluster = to_cluster.tolist()
-
-    while len(to_cluster) > 0:
-        clust = []
-        final_clust = []
-        clust.append(to_cluster[0])
-        to_cluster.remove(to_cluster[0])
-        while (len(clust) > 0) & (len(to_cluster) > 0):
-            tt[0] = 5000.0 * dist_val
-            tt[1] = len(to_cluster)
-            t1 = min(tt)
-            t1 = int(t1)
-            to_cluster_t = to_cluster[0:t1]
-            dem_diff = abs(to_cluster_t - np.tile(clust[0], [t1, 1]))
-            diff_vec = np.argwhere(sum(dem_diff, 1) <= dist_val)
-            for px in range(len(diff_vec), 0, -1):
-                pt = diff_vec[px - 1]
-                clust.append(to_cluster[pt])
-                to_cluster.remove(to_cluster[pt])
-            final_clust.append(clust[0])
-            clust.remove(clust[0])
-
-        if len(clust) > 0:
-            while len(clust) < 0:
-                final_clust.append(clust[0])
-                clust.remove(clust[0])
-
-        clusters.append(final_clust)
-
-    return clusters
 
+def cluster_2d_oleg(mat_in, dist_val):
+    points, labels, num_clusters = label_clusters_2d(mat_in, dist_val)
+    if num_clusters == 0:
+        return []
+    order = np.argsort(labels, kind='mergesort')
+    splits = np.cumsum(np.bincount(labels, minlength=num_clusters))[:-1]
+    return [clust.tolist() for clust in np.split(points[order], splits)]
 
-def cluster_2d_oleg_return_geo_center(mat_in, dist_val):
-    import numpy as np
 
-    tt = [0, 0]
-    clusters = []
-    to_cluster = np.argwhere(mat_in)
-    to_cluster = to_cluster.tolist()
-
-    while len(to_cluster) > 0:
-        clust = []
-        final_clust = []
-        clust.append(to_cluster[0])
-        to_cluster.remove(to_cluster[0])
-        while (len(clust) > 0) & (len(to_cluster) > 0):
-            tt[0] = 5000.0 * dist_val
-            tt[1] = len(to_cluster)
-            t1 = min(tt)
-            t1 = int(t1)
-            to_cluster_t = to_cluster[0:t1]
-            dem_diff = abs(to_cluster_t - np.tile(clust[0], [t1, 1]))
-            diff_vec = np.argwhere(np.sum(dem_diff, axis=1) <= dist_val)
-            for px in range(len(diff_vec), 0, -1):
-                pt = diff_vec[px - 1]
-                clust.append(to_cluster[pt])
-                to_cluster.remove(to_cluster[pt])
-            final_clust.append(clust[0])
-            clust.remove(clust[0])
-
-        if len(clust) > 0:
-            while len(clust) < 0:
-                final_clust.append(clust[0])
-                clust.remove(clust[0])
-
-        if len(final_clust) > 2:
-            clusters.append(np.mean(final_clust, 0))
-
-    clusters = np.array(clusters)
-    clusters = clusters.tolist()
-
-    return clusters
+def cluster_2d_oleg_return_geo_center(mat_in, dist_val):
+    centers, sizes = cluster_2d_centers(mat_in, dist_val)
+    return centers[sizes > 2].tolist()
 
 
 def return_img(file_in_h5, img_num, filter_num):
@@ -824,11 +929,109 @@ def return_pos(file_in_h5, img_num):
     return pos
 
 
-def run_PCA_atoms(file_in_h5, img_num, box_width):
-    import numpy as np
-    import h5py as h5
-    from scipy import linalg
-
+def iter_atom_patches(image, positions, box_width, batch_size=4096, edge_mode='constant'):
+    """
+    Yields the square windows of the image around batches of atoms. The image is padded once so that the windows of
+    every atom can be cut out with a precomputed grid of offsets, without checking each atom against the edges.
+
+    Parameters
+    ----------
+    image : 2D numpy.ndarray
+        Image
+    positions : 2D numpy.ndarray
+        Row and column of each atom. Windows start box_width pixels before the rounded position
+    box_width : unsigned int
+        Half-width of the windows
+    batch_size : unsigned int, optional
+        Number of atoms per batch. Default 4096
+    edge_mode : str, optional
+        Mode of numpy.pad used to fill the parts of windows outside the image. Default 'constant'
+
+    Yields
+    ------
+    patches : 3D numpy.ndarray
+        Windows arranged as [atom, row, column]
+    """
+    image_shape = np.array(image.shape)
+    padded = np.pad(image, box_width, mode=edge_mode)
+    centers = np.clip(np.round(positions[:, :2]).astype(np.int64), 0, image_shape) + box_width
+    offsets = np.arange(-box_width, box_width)
+    for start in range(0, centers.shape[0], batch_size):
+        rows = centers[start: start + batch_size, 0, None] + offsets
+        cols = centers[start: start + batch_size, 1, None] + offsets
+        yield padded[rows[:, :, None], cols[:, None, :]]
+
+
+def atom_patch_svd(image, positions, box_width, batch_size=4096, edge_mode='constant'):
+    """
+    Singular values and vectors of the matrix of flattened atom windows, without building that matrix. The
+    triangular factor of a QR decomposition of the matrix, which is only as large as the number of pixels in a window
+    squared, is updated with every batch of atoms (TSQR) and its SVD is that of the full matrix.
+
+    Parameters
+    ----------
+    image : 2D numpy.ndarray
+        Image
+    positions : 2D numpy.ndarray
+        Row and column of each atom
+    box_width : unsigned int
+        Half-width of the windows
+    batch_size : unsigned int, optional
+        Number of atoms per batch. Default 4096
+    edge_mode : str, optional
+        Mode of numpy.pad used to fill the parts of windows outside the image. Default 'constant'
+
+    Returns
+    -------
+    S : 1D numpy.ndarray
+        Singular values in descending order. Values indistinguishable from round-off are set to zero
+    V : 2D numpy.ndarray
+        Right singular vectors (eigen-windows) arranged as [component, pixel]
+    """
+    num_pix = (2 * box_width) ** 2
+    r_mat = np.zeros((0, num_pix))
+    for patches in iter_atom_patches(image, positions, box_width, batch_size=batch_size, edge_mode=edge_mode):
+        r_mat = np.linalg.qr(np.vstack((r_mat, patches.reshape(-1, num_pix))), mode='r')
+    _, S, V = np.linalg.svd(r_mat, full_matrices=False)
+    # same tolerance as numpy.linalg.matrix_rank
+    S[S <= S[0] * max(positions.shape[0], num_pix) * np.finfo(S.dtype).eps] = 0
+    return S, V
+
+
+def write_atom_patch_scores(h5_scores, image, positions, box_width, S, V, batch_size=4096, edge_mode='constant'):
+    """
+    Writes the left singular vectors (scores) of every atom window, one batch of atoms at a time
+
+    Parameters
+    ----------
+    h5_scores : h5py.Dataset or numpy.ndarray
+        Dataset to write to, arranged as [atom, component]
+    image : 2D numpy.ndarray
+        Image
+    positions : 2D numpy.ndarray
+        Row and column of each atom
+    box_width : unsigned int
+        Half-width of the windows
+    S : 1D numpy.ndarray
+        Singular values from atom_patch_svd
+    V : 2D numpy.ndarray
+        Right singular vectors from atom_patch_svd
+    batch_size : unsigned int, optional
+        Number of atoms per batch. Default 4096
+    edge_mode : str, optional
+        Mode of numpy.pad used to fill the parts of windows outside the image. Default 'constant'
+    """
+    # components without any variance have no defined scores and are left as zeros
+    inv_s = np.zeros(S.shape)
+    inv_s[S > 0] = 1 / S[S > 0]
+    start = 0
+    for patches in iter_atom_patches(image, positions, box_width, batch_size=batch_size, edge_mode=edge_mode):
+        patches = patches.reshape(patches.shape[0], -1)
+        h5_scores[start: start + patches.shape[0]] = np.dot(patches, V.T) * inv_s
+        start += patches.shape[0]
+
+
+def run_PCA_atoms(file_in_h5, img_num, box_width, edge_mode=None, batch_size=4096):
     main_h5_handle = h5.File(file_in_h5, 'r+')
     image_path = "/Frame_%04i/Channel_Finished" % img_num
     type_ref = type(main_h5_handle.get(image_path))
@@ -875,23 +1078,16 @@ def run_PCA_atoms(file_in_h5, img_num, box_width):
     except:
         img[posi_ind[:, 0] - 1, posi_ind[:, 1] - 1] = img2[0:len(img2)]
 
-    sel_vec = np.zeros([len(pos[:, 0]), 1])
-    kk = 0
-    new_pos = []
-    img_vectors = []
-    for k1 in range(0, len(pos[:, 0])):
-        if (box_width <= pos[k1, 0].round() <= len(img[:, 0]) - box_width and
-                        box_width <= pos[k1, 1].round() <= len(img[0, :]) - box_width):
-            sel_vec[k1] = 1
-            new_pos.append(pos[k1, :])
-            vector = img[pos[k1, 0] - box_width:pos[k1, 0] + box_width, pos[k1, 1] - box_width:pos[k1, 1] + box_width]
-            img_vectors.append(vector.reshape([(box_width * 2) ** 2]))
+    if edge_mode is None:
+        # only atoms whose windows lie entirely within the image
+        centers = pos[:, :2].round()
+        sel_vec = np.all(np.logical_and(centers >= box_width, centers <= np.array(img.shape) - box_width), axis=1)
+        edge_mode = 'constant'
+    else:
+        sel_vec = np.ones(len(pos), dtype=bool)
+    new_pos = pos[sel_vec, :2]
 
-    new_pos = array(new_pos)
-    img_vectors = array(img_vectors)
-
-    U, S, V = linalg.svd(img_vectors)
-    V = V[0:len(S)]
+    S, V = atom_patch_svd(img, new_pos, box_width, batch_size=batch_size, edge_mode=edge_mode)
 
     temp = 1
     x = -1
@@ -905,39 +1101,38 @@ def run_PCA_atoms(file_in_h5, img_num, box_width):
 
     image_path = image_temp
 
-    [xx, yy] = np.meshgrid(range(1, len(U) + 1), range(1, len(U[0]) + 1))
-    xx = np.reshape(xx, [1, len(U) * len(U[0])])
-    yy = np.reshape(yy, [1, len(U) * len(U[0])])
-    xy = [xx, yy]
-    U = np.reshape(U, [1, len(U) * len(U[0])])
+    comp_nums = np.arange(1, len(S) + 1)
+    atom_nums = np.flatnonzero(sel_vec).reshape(-1, 1) + 1
 
     image_path_sv = "%s/Spectroscopic_Values_01" % image_path
-    main_h5_handle[image_path_sv] = [1]
+    main_h5_handle[image_path_sv] = comp_nums
     h5_image_new = main_h5_handle.get(image_path_sv)
     new_sv_ref = h5_image_new.ref
-    new_sv_reg = h5_image_new.regionref[0]
+    new_sv_reg = h5_image_new.regionref[0:len(comp_nums)]
 
     image_path_si = "%s/Spectroscopic_Indices_01" % image_path
-    main_h5_handle[image_path_si] = [1]
+    main_h5_handle[image_path_si] = comp_nums
     h5_image_new = main_h5_handle.get(image_path_si)
     new_si_ref = h5_image_new.ref
-    new_si_reg = h5_image_new.regionref[0]
+    new_si_reg = h5_image_new.regionref[0:len(comp_nums)]
 
     image_path_sv = "%s/Position_Values_01" % image_path
-    main_h5_handle[image_path_sv] = xy
+    main_h5_handle[image_path_sv] = new_pos
     h5_image_new = main_h5_handle.get(image_path_sv)
     new_pv_ref = h5_image_new.ref
-    new_pv_reg = h5_image_new.regionref[0:1, 0:len(xy[0])]
+    new_pv_reg = h5_image_new.regionref[0:len(new_pos), 0:2]
 
     image_path_si = "%s/Position_Indices_01" % image_path
-    main_h5_handle[image_path_si] = xy
+    main_h5_handle[image_path_si] = atom_nums
     h5_image_new = main_h5_handle.get(image_path_si)
     new_pi_ref = h5_image_new.ref
-    new_pi_reg = h5_image_new.regionref[0:1, 0:len(xy[0])]
+    new_pi_reg = h5_image_new.regionref[0:len(atom_nums), 0:1]
 
     image_path_b = "%s/Analysis_Data_01_U" % image_path
-    main_h5_handle[image_path_b] = U
-    h5_image_new = main_h5_handle.get(image_path_b)
+    h5_image_new = main_h5_handle.create_dataset(image_path_b, shape=(len(new_pos), len(S)), dtype=np.float64,
+                                                 chunks=(max(1, min(batch_size, len(new_pos))), len(S)))
+    write_atom_patch_scores(h5_image_new, img, new_pos, box_width, S, V, batch_size=batch_size,
+                            edge_mode=edge_mode)
     h5_new_attrs = h5_image_new.attrs
     h5_new_attrs["Filter_Name"] = "PCA_Atom_Shape"
     h5_new_attrs["Number_Of_Variables"] = 1
@@ -1001,38 +1196,34 @@ def run_PCA_atoms(file_in_h5, img_num, box_width):
     h5_new_attrs["Parent"] = current_ref
     h5_new_attrs["Parent_Region"] = current_reg
 
-    [xx, yy] = np.meshgrid(range(1, len(V) + 1), range(1, len(V[0]) + 1))
-    xx = np.reshape(xx, [1, len(V) * len(V[0])])
-    yy = np.reshape(yy, [1, len(V) * len(V[0])])
-    xy = [xx, yy]
-    V = np.reshape(U, [1, len(U) * len(U[0])])
+    pix_nums = np.arange(1, V.shape[1] + 1)
 
     image_path_sv = "%s/Spectroscopic_Values_03" % image_path
-    main_h5_handle[image_path_sv] = [1]
+    main_h5_handle[image_path_sv] = pix_nums
     h5_image_new = main_h5_handle.get(image_path_sv)
     new_sv_ref = h5_image_new.ref
-    new_sv_reg = h5_image_new.regionref[0]
+    new_sv_reg = h5_image_new.regionref[0:len(pix_nums)]
 
     image_path_si = "%s/Spectroscopic_Indices_03" % image_path
-    main_h5_handle[image_path_si] = [1]
+    main_h5_handle[image_path_si] = pix_nums
     h5_image_new = main_h5_handle.get(image_path_si)
     new_si_ref = h5_image_new.ref
-    new_si_reg = h5_image_new.regionref[0]
+    new_si_reg = h5_image_new.regionref[0:len(pix_nums)]
 
     image_path_sv = "%s/Position_Values_03" % image_path
-    main_h5_handle[image_path_sv] = xy
+    main_h5_handle[image_path_sv] = comp_nums
     h5_image_new = main_h5_handle.get(image_path_sv)
     new_pv_ref = h5_image_new.ref
-    new_pv_reg = h5_image_new.regionref[0:1, 0:len(xy[0])]
+    new_pv_reg = h5_image_new.regionref[0:len(comp_nums)]
 
     image_path_si = "%s/Position_Indices_03" % image_path
-    main_h5_handle[image_path_si] = xy
+    main_h5_handle[image_path_si] = comp_nums
     h5_image_new = main_h5_handle.get(image_path_si)
     new_pi_ref = h5_image_new.ref
-    new_pi_reg = h5_image_new.regionref[0:1, 0:len(xy[0])]
+    new_pi_reg = h5_image_new.regionref[0:len(comp_nums)]
 
     image_path_b = "%s/Analysis_Data_03_V" % image_path
-    main_h5_handle[image_path_b] = V1
+    main_h5_handle[image_path_b] = V
     h5_image_new = main_h5_handle.get(image_path_b)
     h5_new_attrs = h5_image_new.attrs
     h5_new_attrs["Filter_Name"] = "PCA_Atom_Shape"
@@ -6,10 +6,13 @@ Created on Mon Jan 23 11:13:22 2017
 """
 
 from __future__ import division, print_function, absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
 import numpy as np
 from scipy.optimize import least_squares
-import itertools as itt
-import multiprocessing as mp
+from scipy.spatial import cKDTree
+import joblib
 import time as tm
 from _warnings import warn
 from sklearn.neighbors import KNeighborsClassifier
@@ -36,6 +39,109 @@ atom_coeff_dtype = np.dtype({'names': ['Amplitude', 'x', 'y', 'Sigma'],
                              'formats': [np.float32, np.float32, np.float32, np.float32]})
 
 
+def get_nearest_neighbors(positions, num_neighbors, query_positions=None):
+    """
+    Finds the nearest atoms using a k-d tree instead of sorting the full matrix of distances between all atoms
+
+    Parameters
+    ----------
+    positions : 2D numpy array
+        Positions of the atoms arranged as [atom index, row(0) and column(1)]
+    num_neighbors : unsigned int
+        Number of nearest neighbors to find
+    query_positions : 2D numpy array (Optional. Default = None)
+        Positions arranged as [point index, row(0) and column(1)] whose nearest atoms should be found.
+        By default, the nearest neighbors of each atom, excluding the atom itself, are found
+
+    Returns
+    -------
+    neighbors : 2D numpy array
+        Indices of the nearest atoms arranged as [point index, neighbor] in order of increasing distance.
+        Atoms at equal distances are ordered by their index
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    num_atoms = positions.shape[0]
+    exclude_self = query_positions is None
+    if exclude_self:
+        query_positions = positions
+    query_positions = np.atleast_2d(np.asarray(query_positions, dtype=np.float64))
+    num_wanted = min(num_neighbors + int(exclude_self), num_atoms)
+    if num_wanted == 0:
+        return np.zeros((query_positions.shape[0], 0), dtype=np.intp)
+
+    tree = cKDTree(positions)
+    num_candidates = num_wanted
+    while True:
+        # one extra candidate reveals any atoms tied with the farthest wanted neighbor
+        num_query = min(num_candidates + 1, num_atoms)
+        dists, inds = tree.query(query_positions, k=num_query)
+        dists = dists.reshape(-1, num_query)
+        inds = inds.reshape(-1, num_query)
+        if num_query == num_atoms or np.all(dists[:, -1] > dists[:, num_wanted - 1]):
+            break
+        num_candidates *= 2
+
+    rows = np.arange(query_positions.shape[0])[:, None]
+    sort_keys = (inds, dists)
+    if exclude_self:
+        sort_keys += (inds != rows,)
+    order = np.lexsort(sort_keys, axis=-1)[:, :num_wanted]
+    neighbors = inds[rows, order]
+    if exclude_self:
+        neighbors = neighbors[:, 1:]
+    return neighbors
+
+
+def _map_atom_blocks(worker, num_atoms, shared, num_cores=1, blocks_per_core=4, **kwargs):
+    """
+    Calls worker(atom_inds, **shared, **kwargs) over blocks of atoms. With more than one core, the arrays in shared
+    are written once to read-only memmaps that the worker processes open by reference, instead of being pickled
+    along with every task.
+
+    Parameters
+    ----------
+    worker : callable
+        Picklable function that processes a block of atoms
+    num_atoms : unsigned int
+        Number of atoms
+    shared : dictionary
+        Arrays and other values needed by every block
+    num_cores : unsigned int (Optional. Default = 1)
+        Number of cores to compute with
+    blocks_per_core : unsigned int (Optional. Default = 4)
+        Number of blocks given to each core, to balance the load
+    kwargs : dictionary
+        Passed on to the worker
+
+    Returns
+    -------
+    results : list of tuples
+        Indices of the atoms in each block and the output of the worker for that block
+    """
+    if num_cores <= 1:
+        atom_inds = np.arange(num_atoms)
+        return [(atom_inds, worker(atom_inds, **dict(shared, **kwargs)))]
+
+    blocks = np.array_split(np.arange(num_atoms), min(num_atoms, num_cores * blocks_per_core))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        shared = dict(shared)
+        for key, value in shared.items():
+            if isinstance(value, np.ndarray):
+                file_path = os.path.join(temp_dir, key + '.dat')
+                shared_array = np.memmap(file_path, dtype=value.dtype, mode='w+', shape=value.shape)
+                shared_array[:] = value
+                shared_array.flush()
+                del shared_array
+                shared[key] = np.memmap(file_path, dtype=value.dtype, mode='r', shape=value.shape)
+        outputs = joblib.Parallel(n_jobs=num_cores)(joblib.delayed(worker)(block, **dict(shared, **kwargs))
+                                                    for block in blocks)
+        del shared
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return list(zip(blocks, outputs))
+
+
 def multi_gauss_surface_fit(coef_mat, s_mat):
     """
     Evaluates the provided coefficients for N gaussian peaks to generate a 2D matrix
@@ -213,9 +319,28 @@ def fit_atom_pos(single_parm):
         return coef_guess_mat, coef_fit_mat
 
 
+def _fit_atom_block(atom_inds, atom_pos_guess, nearest_neighbors, cropped_cleaned_image, fitting_parms):
+    """
+    Fits the positions of a block of atoms and returns the guess and fit coefficients as structured arrays
+    """
+    parm_dict = {'atom_pos_guess': atom_pos_guess,
+                 'nearest_neighbors': nearest_neighbors,
+                 'cropped_cleaned_image': cropped_cleaned_image,
+                 'verbose': False}
+    guess_parms = np.zeros(shape=(len(atom_inds), nearest_neighbors.shape[1] + 1), dtype=atom_coeff_dtype)
+    fit_parms = np.zeros(shape=guess_parms.shape, dtype=guess_parms.dtype)
+    for row_ind, atom_ind in enumerate(atom_inds):
+        guess_coeff, fit_coeff = fit_atom_pos((atom_ind, parm_dict, fitting_parms))
+        num_neighbors_used = guess_coeff.shape[0]
+        guess_parms[row_ind, :num_neighbors_used] = np.squeeze(stack_real_to_compound(guess_coeff, atom_coeff_dtype))
+        fit_parms[row_ind, :num_neighbors_used] = np.squeeze(stack_real_to_compound(fit_coeff, atom_coeff_dtype))
+    return guess_parms, fit_parms
+
+
 def fit_atom_positions_parallel(parm_dict, fitting_parms, num_cores=None):
     """
-    Fits the positions of N atoms in parallel
+    Fits the positions of N atoms in parallel. Each core fits blocks of atoms and reads the image, guesses and
+    nearest neighbors from memory maps shared by all the cores.
 
     Parameters
     ----------
@@ -228,28 +353,31 @@ def fit_atom_positions_parallel(parm_dict, fitting_parms, num_cores=None):
 
     Returns
     -------
-    results : list of tuples
-        Guess and fit coefficients
+    guess_parms : 2D numpy array
+        Guess coefficients arranged as [atom, atom or neighbor] with the atom_coeff_dtype. Coefficients of
+        neighbors left out of the fit are zero
+    fit_parms : 2D numpy array
+        Fit coefficients arranged in the same manner as guess_parms
     """
-    parm_dict['verbose'] = False
     all_atom_guesses = parm_dict['atom_pos_guess']
+    num_atoms = all_atom_guesses.shape[0]
     t_start = tm.time()
-    num_cores = recommend_cpu_cores(all_atom_guesses.shape[0], requested_cores=num_cores, lengthy_computation=False)
-    if num_cores > 1:
-        pool = mp.Pool(processes=num_cores)
-        parm_list = itt.izip(range(all_atom_guesses.shape[0]), itt.repeat(parm_dict), itt.repeat(fitting_parms))
-        chunk = int(all_atom_guesses.shape[0] / num_cores)
-        jobs = pool.imap(fit_atom_pos, parm_list, chunksize=chunk)
-        results = [j for j in jobs]
-        pool.close()
-    else:
-        parm_list = itt.izip(range(all_atom_guesses.shape[0]), itt.repeat(parm_dict), itt.repeat(fitting_parms))
-        results = [fit_atom_pos(parm) for parm in parm_list]
+    num_cores = recommend_cpu_cores(num_atoms, requested_cores=num_cores, lengthy_computation=False)
+
+    shared = {'atom_pos_guess': all_atom_guesses,
+              'nearest_neighbors': parm_dict['nearest_neighbors'],
+              'cropped_cleaned_image': parm_dict['cropped_cleaned_image']}
+    guess_parms = np.zeros(shape=(num_atoms, parm_dict['nearest_neighbors'].shape[1] + 1), dtype=atom_coeff_dtype)
+    fit_parms = np.zeros(shape=guess_parms.shape, dtype=guess_parms.dtype)
+    for atom_inds, (guess_block, fit_block) in _map_atom_blocks(_fit_atom_block, num_atoms, shared,
+                                                                num_cores=num_cores, fitting_parms=fitting_parms):
+        guess_parms[atom_inds] = guess_block
+        fit_parms[atom_inds] = fit_block
 
     tot_time = np.round(tm.time() - t_start)
-    print('Took {} sec to find {} atoms with {} cores'.format(tot_time, len(results), num_cores))
+    print('Took {} sec to find {} atoms with {} cores'.format(tot_time, num_atoms, num_cores))
 
-    return results
+    return guess_parms, fit_parms
 
 
 def fit_atom_positions_dset(h5_grp, fitting_parms=None, num_cores=None):
@@ -280,17 +408,6 @@ def fit_atom_positions_dset(h5_grp, fitting_parms=None, num_cores=None):
     win_size = h5_grp.attrs['motif_win_size']
     psf_width = h5_grp.attrs['psf_width']
 
-    num_atoms = all_atom_guesses.shape[0]  # number of atoms
-
-    # build distance matrix
-    pos_vec = all_atom_guesses[:, 0] + 1j * all_atom_guesses[:, 1]
-
-    pos_mat1 = np.tile(np.transpose(np.atleast_2d(pos_vec)), [1, num_atoms])
-    pos_mat2 = np.transpose(pos_mat1)
-    d_mat = np.abs(pos_mat2 - pos_mat1)  # matrix of distances between all atoms
-    # sort the distance matrix and keep only the atoms within the nearest neighbor limit
-    neighbor_dist_order = np.argsort(d_mat)
-
     if fitting_parms is None:
         num_nearest_neighbors = 6  # to consider when fitting
         fitting_parms = {'fit_region_size': win_size * 0.80,  # region to consider when fitting
@@ -307,25 +424,15 @@ def fit_atom_positions_dset(h5_grp, fitting_parms=None, num_cores=None):
 
     num_nearest_neighbors = fitting_parms['num_nearest_neighbors']
 
-    # neighbor dist order has the (indices of the) neighbors for each atom sorted by distance
-    closest_neighbors_mat = neighbor_dist_order[:, 1:num_nearest_neighbors + 1]
+    # (indices of the) neighbors for each atom sorted by distance
+    closest_neighbors_mat = get_nearest_neighbors(all_atom_guesses, num_nearest_neighbors)
 
     parm_dict = {'atom_pos_guess': all_atom_guesses,
                  'nearest_neighbors': closest_neighbors_mat,
                  'cropped_cleaned_image': cropped_clean_image}
 
     # do the parallel fitting
-    fitting_results = fit_atom_positions_parallel(parm_dict, fitting_parms, num_cores=num_cores)
-
-    # Make datasets to write back to file:
-    guess_parms = np.zeros(shape=(num_atoms, num_nearest_neighbors + 1), dtype=atom_coeff_dtype)
-    fit_parms = np.zeros(shape=guess_parms.shape, dtype=guess_parms.dtype)
-
-    for atom_ind, single_atom_results in enumerate(fitting_results):
-        guess_coeff, fit_coeff = single_atom_results
-        num_neighbors_used = guess_coeff.shape[0]
-        guess_parms[atom_ind, :num_neighbors_used] = np.squeeze(stack_real_to_compound(guess_coeff, guess_parms.dtype))
-        fit_parms[atom_ind, :num_neighbors_used] = np.squeeze(stack_real_to_compound(fit_coeff, guess_parms.dtype))
+    guess_parms, fit_parms = fit_atom_positions_parallel(parm_dict, fitting_parms, num_cores=num_cores)
 
     ds_atom_guesses = VirtualDataset('Guess', data=guess_parms)
     ds_atom_fits = VirtualDataset('Fit', data=fit_parms)
@@ -472,20 +579,13 @@ def remove_duplicate_labels(atom_labels, psf_width, double_cropped_image, distan
         atom_families.append(np.ones(shape=family.shape[0], dtype=np.uint32) * family_ind)
     atom_families = np.hstack(atom_families)
 
-    # build distance matrix
-    pos_vec = all_atom_pos[:, 0] + 1j * all_atom_pos[:, 1]
-
-    pos_mat1 = np.tile(np.transpose(np.atleast_2d(pos_vec)), [1, all_atom_pos.shape[0]])
-    pos_mat2 = np.transpose(pos_mat1)
-    d_mat = np.abs(pos_mat2 - pos_mat1)  # matrix of distances between all atoms
-
-    # replace the diagonal with zeros and then by some large number:
-    d_mat = np.tril(d_mat, -1)
-    d_mat[d_mat == 0] = 100 * psf_width
-
-    # Now find the atoms which are too close to each other:
-    culprits = np.vstack(np.where(d_mat <= distance_multiplier * psf_width)).T
-    # the culprits should be arranged as pairs in a N,2 matrix
+    # Now find the atoms which are too close to each other, but not at the very same position:
+    culprits = np.array(list(cKDTree(all_atom_pos).query_pairs(distance_multiplier * psf_width)),
+                        dtype=np.intp).reshape(-1, 2)
+    culprits = culprits[np.any(all_atom_pos[culprits[:, 0]] != all_atom_pos[culprits[:, 1]], axis=1)]
+    # the culprits should be arranged as pairs in a N,2 matrix, with the later atom first
+    culprits = culprits[:, ::-1]
+    culprits = culprits[np.lexsort((culprits[:, 1], culprits[:, 0]))]
 
     if culprits.size == 0:
         # nothing to remove
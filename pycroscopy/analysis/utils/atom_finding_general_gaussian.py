@@ -6,8 +6,6 @@
 from __future__ import division, print_function, absolute_import, unicode_literals
 import numpy as np
 from scipy.optimize import least_squares
-import itertools as itt
-import multiprocessing as mp
 import time as tm
 import matplotlib.pyplot as plt
 
@@ -15,6 +13,7 @@ from pyUSID.io.io_utils import recommend_cpu_cores
 from ...io.virtual_data import VirtualDataset, VirtualGroup
 from ...io.hdf_writer import HDFwriter
 from pyUSID.viz.plot_utils import cmap_jet_white_center
+from .atom_finding import get_nearest_neighbors, _map_atom_blocks
 
 
 def do_fit(single_parm):
@@ -42,6 +41,22 @@ def do_fit(single_parm):
     return coef_fit_mat
 
 
+def _get_fit_window(image, x_center, y_center, fit_region_size):
+    """
+    Cuts out the region of the image around an atom along with the X and Y parameters for gauss2d
+    """
+    x_range = slice(max(int(np.round(x_center - fit_region_size)), 0),
+                    min(int(np.round(x_center + fit_region_size)), image.shape[0]))
+    y_range = slice(max(int(np.round(y_center - fit_region_size)), 0),
+                    min(int(np.round(y_center + fit_region_size)), image.shape[1]))
+    fit_region = image[x_range, y_range]
+
+    # define x and y fitting range
+    s1, s2 = np.meshgrid(range(x_range.start, x_range.stop),
+                         range(y_range.start, y_range.stop))
+    return fit_region, s1, s2
+
+
 def gauss_2d_residuals(parms_vec, orig_data_mat, x_data, y_data, **kwargs):
     """
     Calculates the residual
@@ -123,6 +138,217 @@ def gauss2d(X, Y, *parms, **kwargs):
     return Z
 
 
+def gauss2d_stack(x_data, y_data, coeffs, symmetric=False, jacobian=False):
+    """
+    Evaluates the sum of gaussians of gauss2d, and optionally its derivatives with respect to every coefficient,
+    for a stack of fit regions at once
+
+    Parameters
+    ----------
+    x_data, y_data : 3D numpy.ndarray
+        X and Y values of each fit region arranged as [region, row, column]
+    coeffs : 3D numpy.ndarray
+        Coefficients arranged as [region, gaussian, parameter] with the parameters in the same order as for gauss2d.
+        Only the background of the first gaussian of each region is used
+    symmetric : bool, optional
+        Whether sigma_x should also be used as sigma_y. Default False
+    jacobian : bool, optional
+        Whether to also return the derivatives. Default False
+
+    Returns
+    -------
+    model : 3D numpy.ndarray
+        Sum of the gaussians arranged as [region, row, column]
+    jac : 5D numpy.ndarray
+        Derivatives of the model arranged as [region, gaussian, parameter, row, column]. Only returned if jacobian
+    """
+    amp, x_0, y_0, sigma_x, sigma_y, theta = [coeffs[:, :, ind, None, None] for ind in range(6)]
+    if symmetric:
+        sigma_y = sigma_x
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    delta_x = x_data[:, None] - x_0
+    delta_y = y_data[:, None] - y_0
+    # coordinates along the principal axes of each gaussian
+    u_mat = cos_theta * delta_x + sin_theta * delta_y
+    v_mat = cos_theta * delta_y - sin_theta * delta_x
+    gauss = np.exp(-(u_mat ** 2 / (2 * sigma_x ** 2) + v_mat ** 2 / (2 * sigma_y ** 2)))
+    model = np.sum(amp * gauss, axis=1) + coeffs.shape[1] * coeffs[:, 0, 6, None, None]
+    if not jacobian:
+        return model
+
+    jac = np.zeros(coeffs.shape + x_data.shape[1:])
+    jac[:, :, 0] = gauss
+    gauss = amp * gauss
+    u_scaled = u_mat / sigma_x ** 2
+    v_scaled = v_mat / sigma_y ** 2
+    jac[:, :, 1] = gauss * (u_scaled * cos_theta - v_scaled * sin_theta)
+    jac[:, :, 2] = gauss * (u_scaled * sin_theta + v_scaled * cos_theta)
+    if symmetric:
+        jac[:, :, 3] = gauss * (u_mat ** 2 + v_mat ** 2) / sigma_x ** 3
+    else:
+        jac[:, :, 3] = gauss * u_mat ** 2 / sigma_x ** 3
+        jac[:, :, 4] = gauss * v_mat ** 2 / sigma_y ** 3
+        jac[:, :, 5] = gauss * u_mat * v_mat * (1 / sigma_y ** 2 - 1 / sigma_x ** 2)
+    jac[:, 0, 6] = coeffs.shape[1]
+    return model, jac
+
+
+def fit_gauss2d_stack(fit_regions, x_data, y_data, coef_guesses, lower_bounds, upper_bounds, weights=None,
+                      symmetric=False, max_iterations=100, ftol=1E-8, xtol=1E-8):
+    """
+    Fits sums of gaussians to a stack of fit regions at once using Levenberg-Marquardt iterations with analytic
+    derivatives. Steps are projected onto the bounds and each region stops iterating once it has converged.
+
+    Parameters
+    ----------
+    fit_regions : 3D numpy.ndarray
+        Image data arranged as [region, row, column]
+    x_data, y_data : 3D numpy.ndarray
+        X and Y values of each fit region arranged as [region, row, column]
+    coef_guesses : 3D numpy.ndarray
+        Starting coefficients arranged as [region, gaussian, parameter], in the same order as for gauss2d
+    lower_bounds, upper_bounds : 3D numpy.ndarray
+        Bounds for the coefficients, arranged in the same manner as coef_guesses
+    weights : 3D numpy.ndarray, optional
+        Weight of each pixel, e.g. zero for the padding of regions smaller than the others. Default 1 everywhere
+    symmetric : bool, optional
+        Whether sigma_x should also be used as sigma_y. Default False
+    max_iterations : unsigned int, optional
+        Maximum number of iterations. Default 100
+    ftol : float, optional
+        Relative reduction in the sum of squares below which a region is considered converged. Default 1E-8
+    xtol : float, optional
+        Relative change in the coefficients below which a region is considered converged. Default 1E-8
+
+    Returns
+    -------
+    coeffs : 3D numpy.ndarray
+        Fit coefficients arranged in the same manner as coef_guesses
+    """
+    lower_bounds = np.asarray(lower_bounds, dtype=np.float64)
+    upper_bounds = np.asarray(upper_bounds, dtype=np.float64)
+    coeffs = np.clip(np.asarray(coef_guesses, dtype=np.float64), lower_bounds, upper_bounds)
+    if weights is None:
+        weights = np.ones(fit_regions.shape)
+    num_regions, num_gauss, num_parms = coeffs.shape
+
+    # coefficients that never change the model
+    free = np.ones((num_gauss, num_parms), dtype=bool)
+    free[1:, 6] = False
+    if symmetric:
+        free[:, 4:6] = False
+    free = free.ravel()
+
+    def get_residuals(inds, coeff_mat):
+        model = gauss2d_stack(x_data[inds], y_data[inds], coeff_mat, symmetric=symmetric)
+        return ((fit_regions[inds] - model) * weights[inds]).reshape(len(inds), -1)
+
+    residuals = get_residuals(np.arange(num_regions), coeffs)
+    cost = 0.5 * np.sum(residuals ** 2, axis=1)
+    damping = np.full(num_regions, 1E-3)
+    active = np.ones(num_regions, dtype=bool)
+
+    for _ in range(max_iterations):
+        inds = np.flatnonzero(active)
+        if inds.size == 0:
+            break
+        old_coeffs = coeffs[inds].reshape(inds.size, -1)
+        _, jac = gauss2d_stack(x_data[inds], y_data[inds], coeffs[inds], symmetric=symmetric, jacobian=True)
+        jac = jac.reshape(inds.size, num_gauss * num_parms, -1)[:, free] * weights[inds].reshape(inds.size, 1, -1)
+        hessian = np.matmul(jac, np.swapaxes(jac, 1, 2))
+        gradient = np.matmul(jac, residuals[inds, :, None])[..., 0]
+
+        # coefficients held at a bound by the gradient are left out of the step
+        held = np.logical_or(np.logical_and(old_coeffs[:, free] <= lower_bounds[inds].reshape(inds.size, -1)[:, free],
+                                            gradient < 0),
+                             np.logical_and(old_coeffs[:, free] >= upper_bounds[inds].reshape(inds.size, -1)[:, free],
+                                            gradient > 0))
+        gradient[held] = 0
+        hessian[held[:, :, None] | held[:, None, :]] = 0
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2).copy()
+        model_hessian = hessian.copy()
+
+        # Marquardt scaling, kept away from zero for gaussians that have vanished
+        diagonal = np.maximum(diagonal, 1E-12 * np.max(diagonal, axis=1, keepdims=True) + 1E-300)
+        diagonal[held] = 1
+        diag_inds = np.arange(diagonal.shape[1])
+        hessian[:, diag_inds, diag_inds] += damping[inds, None] * diagonal
+        step = np.linalg.solve(hessian, gradient[..., None])[..., 0]
+
+        new_coeffs = old_coeffs.copy()
+        new_coeffs[:, free] += step
+        new_coeffs = np.clip(new_coeffs.reshape(coeffs[inds].shape), lower_bounds[inds], upper_bounds[inds])
+        new_residuals = get_residuals(inds, new_coeffs)
+        new_cost = 0.5 * np.sum(new_residuals ** 2, axis=1)
+
+        # reduction in the sum of squares predicted by the linearized model for the (projected) step
+        step = (new_coeffs.reshape(inds.size, -1) - old_coeffs)[:, free]
+        predicted = np.sum(gradient * step, axis=1) - \
+            0.5 * np.sum(step * np.matmul(model_hessian, step[..., None])[..., 0], axis=1)
+        reduction = cost[inds] - new_cost
+        improved = reduction > 0
+        converged = np.logical_or(np.logical_and(reduction <= ftol * cost[inds], reduction > 0.25 * predicted),
+                                  np.linalg.norm(step, axis=1) <= xtol * (xtol + np.linalg.norm(old_coeffs, axis=1)))
+        converged = np.logical_or(np.logical_and(improved, converged), damping[inds] > 1E16)
+
+        accepted = inds[improved]
+        coeffs[accepted] = new_coeffs[improved]
+        residuals[accepted] = new_residuals[improved]
+        cost[accepted] = new_cost[improved]
+        damping[inds] = np.where(improved, np.maximum(damping[inds] / 10, 1E-12), damping[inds] * 10)
+        active[inds[converged]] = False
+
+    return coeffs
+
+
+def _stack_fit_windows(image, positions, fit_region_size):
+    """
+    Fit regions around each position, as cut by _get_fit_window, zero-padded to a common size along with their
+    X and Y values and weights that are zero in the padding
+    """
+    starts = np.zeros(positions.shape, dtype=np.int64)
+    stops = np.zeros(positions.shape, dtype=np.int64)
+    for axis in range(2):
+        starts[:, axis] = np.maximum(np.round(positions[:, axis] - fit_region_size), 0)
+        stops[:, axis] = np.minimum(np.round(positions[:, axis] + fit_region_size), image.shape[axis])
+    sizes = np.max(stops - starts, axis=0)
+    rows = starts[:, 0, None] + np.arange(sizes[0])
+    cols = starts[:, 1, None] + np.arange(sizes[1])
+    weights = np.logical_and((rows < stops[:, 0, None])[:, :, None], (cols < stops[:, 1, None])[:, None, :])
+    rows = np.minimum(rows, image.shape[0] - 1)
+    cols = np.minimum(cols, image.shape[1] - 1)
+    fit_regions = image[rows[:, :, None], cols[:, None, :]] * weights
+    x_data = np.broadcast_to(rows[:, :, None], weights.shape).astype(np.float64)
+    y_data = np.broadcast_to(cols[:, None, :], weights.shape).astype(np.float64)
+    return fit_regions, x_data, y_data, weights.astype(np.float64)
+
+
+def _fit_atom_block(atom_inds, positions, coef_guesses, lower_bounds, upper_bounds, image, fitting_parms,
+                    max_mem_mb=256):
+    """
+    Fits the gaussians around the atoms in a block, cutting the fit regions out of the (shared) image and fitting
+    as many regions at a time as fit within max_mem_mb
+    """
+    atom_inds = np.asarray(atom_inds)
+    fit_coeffs = np.zeros(shape=(atom_inds.size,) + coef_guesses.shape[1:])
+    # each iteration evaluates the model once, and the first evaluation is at the guess
+    max_iterations = fitting_parms.get('max_iterations', max(fitting_parms['max_function_evals'] - 1, 0))
+    window_size = 2 * int(np.ceil(fitting_parms['fit_region_size'])) + 1
+    # the derivatives of every coefficient for every pixel dominate the memory
+    region_bytes = window_size ** 2 * (np.prod(coef_guesses.shape[1:]) * 3 + 8) * 8
+    batch_size = max(1, int(max_mem_mb * 1024 ** 2 / region_bytes))
+    for start in range(0, atom_inds.size, batch_size):
+        batch = atom_inds[start: start + batch_size]
+        fit_regions, x_data, y_data, weights = _stack_fit_windows(image, np.asarray(positions[batch, :2]),
+                                                                  fitting_parms['fit_region_size'])
+        fit_coeffs[start: start + batch_size] = fit_gauss2d_stack(fit_regions, x_data, y_data,
+                                                                  coef_guesses[batch], lower_bounds[batch],
+                                                                  upper_bounds[batch], weights=weights,
+                                                                  symmetric=fitting_parms['symmetric'],
+                                                                  max_iterations=max_iterations)
+    return fit_coeffs
+
+
 class Gauss_Fit(object):
     """
     Initializes the gaussian fitting routines:
@@ -145,6 +371,10 @@ class Gauss_Fit(object):
         pixels.
         'position_range': range that the fitted position can move from initial guess position in pixels
         'max_function_evals': maximum allowed function calls; passed to the least squares fitter
+        'max_iterations': (optional) maximum number of Levenberg-Marquardt iterations when fitting the atom positions.
+        Each iteration evaluates the analytic derivatives and the model once, whether or not its step is accepted.
+        Default: 'max_function_evals' - 1, which matches the number of function evaluations (excluding derivatives)
+        counted by the least squares fitter
         'fitting_tolerance': target difference between the fit and the data
         'symmetric': flag to signal if a symmetric gaussian is desired (i.e. sigma_x == sigma_y)
         'background': flag to signal if a background constant is desired
@@ -193,29 +423,21 @@ class Gauss_Fit(object):
 
         self.num_atoms = self.all_atom_guesses.shape[0]  # number of atoms
 
-        # build distance matrix
-        pos_vec = self.all_atom_guesses[:, 0] + 1j * self.all_atom_guesses[:, 1]
-
-        pos_mat1 = np.tile(np.transpose(np.atleast_2d(pos_vec)), [1, self.num_atoms])
-        pos_mat2 = np.transpose(pos_mat1)
-        d_mat = np.abs(pos_mat2 - pos_mat1)  # matrix of distances between all atoms
-        # sort the distance matrix and keep only the atoms within the nearest neighbor limit
-        neighbor_dist_order = np.argsort(d_mat)
-
         self.num_nearest_neighbors = self.fitting_parms['num_nearest_neighbors']
 
-        # neighbor dist order has the (indices of the) neighbors for each atom sorted by distance
-        self.closest_neighbors_mat = neighbor_dist_order[:, 1:self.num_nearest_neighbors + 1]
+        # (indices of the) neighbors for each atom sorted by distance
+        self.closest_neighbors_mat = get_nearest_neighbors(self.all_atom_guesses[:, :2], self.num_nearest_neighbors)
+        # each atom followed by its neighbors, used to gather guesses for all atoms at once
+        self.neighborhood_inds = np.hstack((np.arange(self.num_atoms)[:, None], self.closest_neighbors_mat))
 
         # find which atoms are at the centers of the motifs
-        self.center_atom_vec = (self.motif_centers[:, 0]) + (1j * self.motif_centers[:, 1])
-        self.center_atom_dists = [np.abs(pos_vec - item) for item in self.center_atom_vec]
-        self.center_atom_sorted = np.argsort(self.center_atom_dists)
-        self.center_atom_indices = self.center_atom_sorted[:, 0]
+        self.center_atom_indices = get_nearest_neighbors(self.all_atom_guesses[:, :2], 1,
+                                                         query_positions=self.motif_centers)[:, 0]
 
     def fit_atom_positions_parallel(self, plot_results=True, num_cores=None):
         """
-        Fits the positions of N atoms in parallel
+        Fits the positions of N atoms in parallel. Each core fits blocks of atoms and reads the image and guesses
+        from memory maps shared by all the cores.
 
         Parameters
         ----------
@@ -240,41 +462,38 @@ class Gauss_Fit(object):
             num_cores = recommend_cpu_cores(self.num_atoms, requested_cores=num_cores, lengthy_computation=False)
 
         print('Setting up guesses')
-        self.guess_parms = []
-        for i in range(self.num_atoms):
-            self.guess_parms.append(self.do_guess(i))
+        # only the coefficients and bounds are kept. Workers cut the fit regions out of the image themselves
+        num_coeffs = len(self.motif_coeff_dtype.names)
+        guess_coeffs = np.zeros(shape=self.neighborhood_inds.shape + (num_coeffs,))
+        lower_bounds = np.zeros(shape=guess_coeffs.shape)
+        upper_bounds = np.zeros(shape=guess_coeffs.shape)
+        for atom_ind in range(self.num_atoms):
+            _, guess_coeffs[atom_ind], _, _, _, lower_bounds[atom_ind], upper_bounds[atom_ind] = \
+                self.do_guess(atom_ind)
 
         print('Fitting...')
-        if num_cores > 1:
-            pool = mp.Pool(processes=num_cores)
-            parm_list = itt.izip(self.guess_parms, itt.repeat(self.fitting_parms))
-            chunk = int(self.num_atoms / num_cores)
-            jobs = pool.imap(do_fit, parm_list, chunksize=chunk)
-            self.fitting_results = [j for j in jobs]
-            pool.close()
-        else:
-            parm_list = itt.izip(self.guess_parms, itt.repeat(self.fitting_parms))
-            self.fitting_results = [do_fit(parm) for parm in parm_list]
+        shared = {'positions': self.all_atom_guesses,
+                  'coef_guesses': guess_coeffs,
+                  'lower_bounds': lower_bounds,
+                  'upper_bounds': upper_bounds,
+                  'image': self.cropped_clean_image}
+        self.fitting_results = np.zeros(shape=guess_coeffs.shape)
+        for atom_inds, fit_block in _map_atom_blocks(_fit_atom_block, self.num_atoms, shared, num_cores=num_cores,
+                                                     fitting_parms=self.fitting_parms):
+            self.fitting_results[atom_inds] = fit_block
 
         print('Finalizing datasets...')
-        self.guess_dataset = np.zeros(shape=(self.num_atoms, self.num_nearest_neighbors + 1),
-                                      dtype=self.atom_coeff_dtype)
+        self.guess_dataset = np.zeros(shape=self.neighborhood_inds.shape, dtype=self.atom_coeff_dtype)
         self.fit_dataset = np.zeros(shape=self.guess_dataset.shape, dtype=self.guess_dataset.dtype)
 
-        for atom_ind, single_atom_results in enumerate(self.fitting_results):
-            types = np.hstack((self.h5_guess['type'][atom_ind],
-                               [self.h5_guess['type'][neighbor] for neighbor in self.closest_neighbors_mat[atom_ind]]))
-            atom_data = np.hstack((np.vstack(types), single_atom_results))
-            atom_data = [tuple(element) for element in atom_data]
-            self.fit_dataset[atom_ind] = atom_data
-
-            single_atom_guess = self.guess_parms[atom_ind]
-            atom_guess_data = np.hstack((np.vstack(types), single_atom_guess[1]))
-            atom_guess_data = [tuple(element) for element in atom_guess_data]
-            self.guess_dataset[atom_ind] = atom_guess_data
+        types = self.all_atom_guesses[self.neighborhood_inds, 2]
+        for dataset, coeffs in zip([self.guess_dataset, self.fit_dataset], [guess_coeffs, self.fitting_results]):
+            dataset['type'] = types
+            for field_ind, field in enumerate(self.motif_coeff_dtype.names):
+                dataset[field] = coeffs[..., field_ind]
 
         tot_time = np.round(tm.time() - t_start)
-        print('Took {} sec to find {} atoms with {} cores'.format(tot_time, len(self.fitting_results), num_cores))
+        print('Took {} sec to find {} atoms with {} cores'.format(tot_time, self.num_atoms, num_cores))
 
         # if plotting is desired
         if plot_results:
@@ -325,25 +544,12 @@ class Gauss_Fit(object):
         position_range = self.fitting_parms['position_range']
 
         # start writing down initial guesses
-        x_center_atom = self.h5_guess['x'][atom_ind]
-        y_center_atom = self.h5_guess['y'][atom_ind]
-        x_neighbor_atoms = [self.h5_guess['x'][self.closest_neighbors_mat[atom_ind][i]] for i in
-                            range(self.num_nearest_neighbors)]
-        y_neighbor_atoms = [self.h5_guess['y'][self.closest_neighbors_mat[atom_ind][i]] for i in
-                            range(self.num_nearest_neighbors)]
+        x_center_atom, y_center_atom = self.all_atom_guesses[atom_ind, :2]
+        x_neighbor_atoms = self.all_atom_guesses[self.closest_neighbors_mat[atom_ind], 0]
+        y_neighbor_atoms = self.all_atom_guesses[self.closest_neighbors_mat[atom_ind], 1]
 
         # select the window we're going to be fitting
-        x_range = slice(max(int(np.round(x_center_atom - fit_region_size)), 0),
-                        min(int(np.round(x_center_atom + fit_region_size)),
-                            self.cropped_clean_image.shape[0]))
-        y_range = slice(max(int(np.round(y_center_atom - fit_region_size)), 0),
-                        min(int(np.round(y_center_atom + fit_region_size)),
-                            self.cropped_clean_image.shape[1]))
-        fit_region = self.cropped_clean_image[x_range, y_range]
-
-        # define x and y fitting range
-        s1, s2 = np.meshgrid(range(x_range.start, x_range.stop),
-                             range(y_range.start, y_range.stop))
+        fit_region, s1, s2 = _get_fit_window(self.cropped_clean_image, x_center_atom, y_center_atom, fit_region_size)
 
         # guesses are different if we're fitting the initial windows
         if initial_motifs:
@@ -384,10 +590,10 @@ class Gauss_Fit(object):
                                                      theta_guess, background_guess)))
         else:
             # otherwise better guesses are assumed to exist
-            motif_type = self.h5_guess['type'][atom_ind]
+            motif_type = int(self.all_atom_guesses[atom_ind, 2])
             coef_guess_mat = np.copy(self.motif_converged_parms[motif_type])
-            coef_guess_mat[:, 1] = self.h5_guess['x'][atom_ind] + coef_guess_mat[:, 1]
-            coef_guess_mat[:, 2] = self.h5_guess['y'][atom_ind] + coef_guess_mat[:, 2]
+            coef_guess_mat[:, 1] = x_center_atom + coef_guess_mat[:, 1]
+            coef_guess_mat[:, 2] = y_center_atom + coef_guess_mat[:, 2]
 
         # Choose upper and lower bounds for the fitting
         #
@@ -14,13 +14,14 @@ import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import xlrd as xlreader
+from joblib import Parallel, delayed
 
 from pyUSID.io.hdf_utils import get_auxiliary_datasets, find_dataset, get_h5_obj_refs, link_h5_objects_as_attrs, \
     get_attr, create_indexed_group, write_simple_attrs, write_main_dataset, Dimension
 from pyUSID.io.write_utils import create_spec_inds_from_vals
 from pyUSID.io.io_utils import get_available_memory, recommend_cpu_cores
 from ....analysis.optimize import Optimize
-from ....processing.histogram import build_histogram
+from ....processing.histogram import HistogramAccumulator
 from ....viz.be_viz_utils import plot_1d_spectrum, plot_2d_spectrogram, plot_histograms
 from ...hdf_writer import HDFwriter
 from ...virtual_data import VirtualDataset, VirtualGroup
@@ -371,6 +372,9 @@ def generatePlotGroups(h5_main, mean_resp, folder_path, basename, max_resp=[], m
     #     col_names = [col for col in col_names if col not in std_cols + ignore_plot_groups]
 
     freq_inds = spec_inds[spec_inds.attrs['Frequency']].flatten()
+    freq_vals = h5_freq[()]
+    # Find the bins of every UDVS step once instead of searching the indices for each step in each plot group
+    step_bin_groups = group_bins_by_step(UDVS_inds[()])
 
     for col_name in col_names:
 
@@ -382,8 +386,9 @@ def generatePlotGroups(h5_main, mean_resp, folder_path, basename, max_resp=[], m
         if not isinstance(ref, h5py.RegionReference):
             continue
         # 4. Access that column of the data through region reference
-        steps = np.where(np.isfinite(UDVS[ref]))[0]
-        step_inds = np.array([np.where(UDVS_inds.value == step)[0] for step in steps]).flatten()
+        udvs_col = UDVS[ref]
+        steps = np.where(np.isfinite(udvs_col))[0]
+        step_inds = get_bins_for_steps(step_bin_groups, steps)
         """selected_UDVS_steps = UDVS[ref]
         selected_UDVS_steps = selected_UDVS_steps[np.isfinite(selected_UDVS_steps)]"""
 
@@ -395,10 +400,10 @@ def generatePlotGroups(h5_main, mean_resp, folder_path, basename, max_resp=[], m
         We are assuming that there is only one excitation waveform per plot group
         """
         freq_slice = np.unique(freq_inds[step_inds])
-        freq_vec = h5_freq.value[freq_slice]
+        freq_vec = freq_vals[freq_slice]
 
         num_bins = len(freq_slice)  # int(len(freq_inds)/len(UDVS[ref]))
-        pg_data = np.repeat(UDVS[ref], num_bins)
+        pg_data = np.repeat(udvs_col, num_bins)
 
         plot_grp = create_indexed_group(grp, 'Spatially_Averaged_Plot_Group')
         write_simple_attrs(plot_grp, {'Name': col_name})
@@ -502,6 +507,57 @@ def generatePlotGroups(h5_main, mean_resp, folder_path, basename, max_resp=[], m
 ###############################################################################
 
 
+def group_bins_by_step(udvs_inds):
+    """
+    Groups the spectroscopic bins by UDVS step in a single pass through the UDVS indices
+
+    Parameters
+    ----------
+    udvs_inds : 1D numpy array
+        UDVS step of each spectroscopic bin
+
+    Returns
+    -------
+    step_bin_groups : tuple
+        (unique UDVS steps, bins sorted by UDVS step, index of the first bin of each step in the sorted bins,
+        number of bins in each step). Use get_bins_for_steps() to look up the bins of specific steps
+    """
+    udvs_inds = np.ravel(udvs_inds)
+    # A stable sort keeps the bins of each step in ascending order
+    bin_order = np.argsort(udvs_inds, kind='mergesort')
+    steps, starts, counts = np.unique(udvs_inds[bin_order], return_index=True, return_counts=True)
+    return steps, bin_order, starts, counts
+
+
+def get_bins_for_steps(step_bin_groups, steps):
+    """
+    Returns the spectroscopic bins of the requested UDVS steps
+
+    Parameters
+    ----------
+    step_bin_groups : tuple
+        Bins grouped by UDVS step as returned by group_bins_by_step()
+    steps : 1D numpy array or list
+        UDVS steps of interest
+
+    Returns
+    -------
+    bins : 1D numpy array
+        Spectroscopic bins of each requested step (in ascending order), one step after another
+    """
+    all_steps, bin_order, starts, counts = step_bin_groups
+    steps = np.ravel(steps)
+    group_inds = np.searchsorted(all_steps, steps)
+    # Skip steps without any bins
+    found = group_inds < all_steps.size
+    found[found] = all_steps[group_inds[found]] == steps[found]
+    group_inds = group_inds[found]
+    num_bins = counts[group_inds]
+    # Concatenate the ranges [start, start + count) of all requested steps without a python loop
+    offsets = np.repeat(starts[group_inds] - np.cumsum(num_bins) + num_bins, num_bins)
+    return bin_order[offsets + np.arange(np.sum(num_bins))]
+
+
 def reshape_mean_data(spec_inds, step_inds, mean_resp):
     """
     Takes in the mean data vector and rearranges that data according to 
@@ -1195,8 +1251,9 @@ class BEHistogram:
         self.N_freqs = 1
         self.N_pixels = 1
         self.N_y_bins = 1
+        self.cores = None
 
-    def addBEHist(self, h5_path, max_mem_mb=1024, show_plot=True, save_plot=True):
+    def addBEHist(self, h5_path, max_mem_mb=1024, show_plot=True, save_plot=True, cores=None):
         """
         This function adds Histgrams from the Main Data to the Plot Groups for
         an existing hdf5 BEPS datafile.
@@ -1212,6 +1269,8 @@ class BEHistogram:
             created
         save_plot : Boolean
             Should plots of the histograms be saved
+        cores : unsigned integer, optional
+            Number of threads used to bin blocks of pixels. Default - recommended by recommend_cpu_cores()
 
         Returns
         -------
@@ -1223,8 +1282,6 @@ class BEHistogram:
         print('Adding Histograms to file {}'.format(h5_file.name))
         print('Path to HDF5 file is {}'.format(hdf.path))
 
-        max_mem = min(max_mem_mb * 1024 ** 2, 0.75 * get_available_memory())
-
         h5_main = find_dataset(h5_file, 'Raw_Data')
         h5_udvs = find_dataset(h5_file, 'UDVS')
 
@@ -1251,8 +1308,11 @@ class BEHistogram:
 
                 print('Creating BEHistogram for Plot Group {}'.format(p_group.name))
                 udvs_lab = p_group.attrs['Name']
-                udvs_col = h5_udvs[im][h5_udvs[im].attrs[udvs_lab]]
-                actual_udvs_steps = np.where(np.isnan(udvs_col) is False)[0]
+                udvs_col = np.squeeze(h5_udvs[im][h5_udvs[im].attrs[udvs_lab]])
+                actual_udvs_steps = np.where(~np.isnan(udvs_col))[0]
+                # buildPlotGroupHist expects the spectroscopic indices of the steps in the plot group
+                step_inds = get_auxiliary_datasets(h5_main[im], aux_dset_name=['UDVS_Indices'])[0][()]
+                active_spec_steps = get_bins_for_steps(group_bins_by_step(step_inds), actual_udvs_steps)
 
                 """
                 Add the BEHistogram for the current plot group
@@ -1262,10 +1322,11 @@ class BEHistogram:
                 hist = BEHistogram()
                 hist_mat, hist_labels, hist_indices, hist_indices_labels = \
                     hist.buildPlotGroupHist(h5_main[im],
-                                            actual_udvs_steps,
+                                            active_spec_steps,
                                             max_response=max_resp,
                                             min_response=min_resp,
-                                            max_mem_mb=max_mem)
+                                            max_mem_mb=max_mem_mb,
+                                            cores=cores)
 
                 ds_hist = VirtualDataset('Histograms', hist_mat, dtype=np.int32,
                                          chunking=(1, hist_mat.shape[1]), compression='gzip')
@@ -1279,7 +1340,7 @@ class BEHistogram:
                 for hist_ind_ind, hist_ind_dim in enumerate(hist_indices_labels):
                     hist_ind_dict[hist_ind_dim] = (slice(hist_ind_ind, hist_ind_ind + 1), slice(None))
                 ds_hist_indices.attrs['labels'] = hist_ind_dict
-                ds_hist_labels = VirtualDataset('Histograms_Labels', np.array(hist_labels))
+                ds_hist_labels = VirtualDataset('Histograms_Labels', np.array(hist_labels, dtype='S'))
                 plot_grp.add_children([ds_hist, ds_hist_indices, ds_hist_labels])
                 hdf.write(plot_grp)
 
@@ -1293,7 +1354,8 @@ class BEHistogram:
 
         hdf.close()
 
-    def buildBEHist(self, h5_main, max_response=[], min_response=[], max_mem_mb=1024, max_bins=256, debug=False):
+    def buildBEHist(self, h5_main, max_response=[], min_response=[], max_mem_mb=1024, max_bins=256, debug=False,
+                    num_samples=1000, cores=None):
         """
         Creates Histograms from dataset
 
@@ -1305,6 +1367,10 @@ class BEHistogram:
         max_mem_mb : int
         max_bins : int
         debug : bool
+        num_samples : int
+            number of evenly spaced pixels used to estimate max_response and min_response if they are not provided
+        cores : int
+            number of threads used to bin blocks of pixels
 
         Returns
         -------
@@ -1315,14 +1381,14 @@ class BEHistogram:
         if debug:
             print('We have {} bytes of memory available'.format(free_mem))
         self.max_mem = min(max_mem_mb * 1024 ** 2, 0.75 * free_mem)
+        self.cores = cores
 
         """
         Check that max_response and min_response have been defined.
-        Call __getminmaxresponse__ is not
+        Estimate them from a subset of the pixels if not
         """
         if max_response == [] or min_response == []:
-            max_response = np.max(np.abs(h5_main), axis=1)
-            min_response = np.min(np.abs(h5_main), axis=1)
+            max_response, min_response = self.__estimateResponseRange(h5_main, 1, num_samples)
 
         self.max_response = np.mean(max_response) + 3 * np.std(max_response)
         self.min_response = np.max([0, np.mean(min_response) - 3 * np.std(min_response)])
@@ -1350,7 +1416,7 @@ class BEHistogram:
         # print('There are {} total frequencies in this dataset'.format(self.N_bins))
         del freqs_mat, spec_ind_mat
 
-        self.N_pixels = np.shape(h5_main)[1]
+        self.N_pixels = np.shape(h5_main)[0]
         # print('There are {} pixels in this dataset'.format(self.N_pixels))
 
         self.N_y_bins = np.int(np.min((max_bins, np.rint(np.sqrt(self.N_pixels * self.N_spectral_steps)))))
@@ -1363,7 +1429,7 @@ class BEHistogram:
 
     def buildPlotGroupHist(self, h5_main, active_spec_steps, max_response=[],
                            min_response=[], max_mem_mb=1024, max_bins=256,
-                           std_mult=3, debug=False):
+                           std_mult=3, debug=False, num_samples=1000, cores=None):
         """
         Creates Histograms for a given plot group
 
@@ -1388,6 +1454,12 @@ class BEHistogram:
             binning
         debug : boolean
             Turns on debug printing statements if true.  Default False.
+        num_samples : integer
+            number of evenly spaced pixels used to estimate max_response
+            and min_response if they are not provided
+        cores : integer
+            number of threads used to bin blocks of pixels.
+            Default - recommended by recommend_cpu_cores()
 
         Returns
         -------
@@ -1404,15 +1476,15 @@ class BEHistogram:
         free_mem = get_available_memory()
         if debug:
             print('We have {} bytes of memory available'.format(free_mem))
-        self.max_mem = min(max_mem_mb, 0.75 * free_mem)
+        self.max_mem = min(max_mem_mb * 1024 ** 2, 0.75 * free_mem)
+        self.cores = cores
 
         """
         Check that max_response and min_response have been defined.
-        Call __getminmaxresponse__ is not
+        Estimate them from a subset of the pixels if not
         """
         if max_response == [] or min_response == []:
-            max_response = np.amax(np.abs(h5_main), axis=0)
-            min_response = np.amin(np.abs(h5_main), axis=0)
+            max_response, min_response = self.__estimateResponseRange(h5_main, 0, num_samples)
 
         self.max_response = np.mean(max_response) + std_mult * np.std(max_response)
         self.min_response = np.mean(min_response) - std_mult * np.std(min_response)
@@ -1481,22 +1553,60 @@ class BEHistogram:
 
         hist_labels = ['Amplitude', 'Phase', 'Real Part', 'Imaginary Part']
 
-        hist_indices = np.zeros((2, hist_mat.shape[1]), dtype=np.int32)
-
         hist_index_labels = ['Frequency Bin', 'Spectroscopic Bin']
 
-        for isbin in range(hist_shape[1]):
-            for ifbin in range(hist_shape[2]):
-                ihbin = ifbin + isbin * hist_shape[2]
-                hist_indices[0, ihbin] = ifbin
-                hist_indices[1, ihbin] = isbin
+        # Columns of hist_mat run over the last axis of ds_hist fastest
+        hist_indices = np.vstack((np.tile(np.arange(hist_shape[2], dtype=np.int32), hist_shape[1]),
+                                  np.repeat(np.arange(hist_shape[1], dtype=np.int32), hist_shape[2])))
 
         return hist_mat, hist_labels, hist_indices, hist_index_labels
 
+    def __estimateResponseRange(self, h5_main, axis, num_samples):
+        """
+        Estimates the maximum and minimum amplitude of the response from evenly spaced pixels instead of reading the
+        entire dataset
+
+        Parameters
+        ----------
+        h5_main : HDF5 Dataset
+            Main_Dataset to be histogramed
+        axis : int
+            0 to get the extrema at each spectroscopic bin, 1 to get the extrema at each pixel
+        num_samples : int
+            maximum number of pixels to read
+
+        Returns
+        -------
+        max_response : numpy array
+            maximum amplitude
+        min_response : numpy array
+            minimum amplitude
+        """
+        sample_step = max(1, int(np.ceil(h5_main.shape[0] / num_samples)))
+        sample_rows = np.arange(0, h5_main.shape[0], sample_step)
+        max_pixels = int(maxReadPixels(self.max_mem, sample_rows.size, h5_main.shape[1],
+                                       bytes_per_bin=h5_main.dtype.itemsize))
+
+        max_response = []
+        min_response = []
+        for start in range(0, sample_rows.size, max_pixels):
+            rows = sample_rows[start: start + max_pixels]
+            amp_mat = np.abs(h5_main[rows[0]: rows[-1] + 1: sample_step])
+            max_response.append(np.amax(amp_mat, axis=axis))
+            min_response.append(np.amin(amp_mat, axis=axis))
+
+        if axis == 0:
+            return np.amax(max_response, axis=0), np.amin(min_response, axis=0)
+        return np.hstack(max_response), np.hstack(min_response)
+
     def __datasetHist(self, h5_main, active_udvs_steps, x_hist, debug=False):
         """
         Create the histogram for a single dataset
 
+        The data is read only once, one block of pixels at a time, and the histograms of the amplitude, phase, real
+        and imaginary parts for all the active UDVS steps are accumulated from each block. Sets of blocks are binned
+        on concurrent threads and the partial histograms are summed.
+
         Parameters
         ----------
         h5_main : HDF5 Dataset
@@ -1515,106 +1625,94 @@ class BEHistogram:
         """
 
         """
-        Estimate maximum number of pixels to read at once
+        Get the correct Spectroscopic bins for the active UDVS steps and
+        the frequency of each bin relative to the first bin in its UDVS step
         """
-        max_pixels = maxReadPixels(self.max_mem, self.N_pixels, self.num_udvs_steps,
-                                   bytes_per_bin=h5_main.dtype.itemsize * self.N_y_bins * self.N_freqs)
+        active_bins = np.flatnonzero(np.in1d(x_hist[1], active_udvs_steps))
+        bin_freqs = np.take(x_hist[0], active_bins)
+        _, first_bins, step_of_bin = np.unique(np.take(x_hist[1], active_bins), return_index=True,
+                                               return_inverse=True)
+        freq_offsets = bin_freqs - bin_freqs[first_bins][step_of_bin]
+        read_all_bins = active_bins.size == h5_main.shape[1]
+        if debug:
+            print('{} active bins in {} UDVS steps'.format(active_bins.size, first_bins.size))
 
         """
-        Divide the pixels into chunks that will fit in memory
+        Set up the list of functions to call and their corresponding maxima and minima
         """
-        pix_chunks = np.append(np.arange(0, self.N_pixels, max_pixels, dtype=np.int), self.N_pixels)
+        func_list = [np.abs, np.angle, np.real, np.imag]
+        max_list = [self.max_response, np.pi, self.max_response, self.max_response]
+        min_list = [self.min_response, -np.pi, self.min_response, self.min_response]
 
         """
-        Initialize the histograms
+        Divide the pixels into blocks that will fit in memory.
+        Each thread holds the raw block, the active bins and the binning temporaries
         """
-        ds_hist = np.zeros((4, self.N_freqs, self.N_y_bins), dtype=np.int32)
+        N_pixels = h5_main.shape[0]
+        cores = recommend_cpu_cores(N_pixels, requested_cores=self.cores)
+        bytes_per_bin = 2 * h5_main.dtype.itemsize + 3 * np.float64(0).itemsize
+        max_pixels = int(maxReadPixels(self.max_mem / cores, N_pixels, h5_main.shape[1],
+                                       bytes_per_bin=bytes_per_bin))
+        pix_chunks = [slice(start, min(start + max_pixels, N_pixels)) for start in range(0, N_pixels, max_pixels)]
+
+        def __read_block(pix_slice):
+            data_mat = h5_main[pix_slice]
+            if not read_all_bins:
+                data_mat = data_mat[:, active_bins]
+            return data_mat
 
         """
-        loop over pixels
+        Initialize the histograms
         """
-        for ichunk in range(len(pix_chunks) - 1):
-            if debug:
-                print('pixel chunk', ichunk)
+        ds_hist = np.zeros((4, self.N_freqs, self.N_y_bins), dtype=np.int64)
 
-            chunk = range(pix_chunks[ichunk], pix_chunks[ichunk + 1])
+        """
+        loop over sets of pixel blocks
+        """
+        with Parallel(n_jobs=cores, backend='threading') as parallel:
+            for set_start in range(0, len(pix_chunks), cores):
+                cur_chunks = pix_chunks[set_start: set_start + cores]
+                print('Binning BEHistogram...{}% --pixels {}-{}'.format(
+                    np.rint(100 * cur_chunks[0].start / N_pixels), cur_chunks[0].start, cur_chunks[-1].stop - 1))
+                blocks = [__read_block(pix_slice) for pix_slice in cur_chunks]
+                partial_hists = parallel(delayed(_bin_be_block)(data_mat, freq_offsets, self.N_freqs, self.N_y_bins,
+                                                                func_list, min_list, max_list)
+                                         for data_mat in blocks)
+                for chunk_hist in partial_hists:
+                    ds_hist += chunk_hist
 
-            """
-        Loop over active UDVS steps
-            """
-            for iudvs in range(self.num_udvs_steps):
-                selected = (iudvs + chunk[0] * self.num_udvs_steps) % np.rint(
-                    self.num_udvs_steps * self.N_pixels / 10) == 0
-                if selected:
-                    per_done = np.rint(
-                        100 * (iudvs + chunk[0] * self.num_udvs_steps) / (self.num_udvs_steps * self.N_pixels))
-                    print('Binning BEHistogram...{}% --pixels {}-{}, step # {}'.format(per_done, chunk[0],
-                                                                                       chunk[-1], iudvs))
-                udvs_step = active_udvs_steps[iudvs]
-                if debug:
-                    print('udvs step', udvs_step)
+        return np.int32(ds_hist)
 
-                """
-        Get the correct Spectroscopic bins for the current UDVS step
-        Read desired pixel chunk from these bins for Main_Data into data_mat
-                """
-                udvs_bins = np.where(x_hist[1] == udvs_step)[0]
-                if debug:
-                    print(np.shape(x_hist))
-                data_mat = h5_main[pix_chunks[ichunk]:pix_chunks[ichunk + 1], udvs_bins]
 
-                """
-        Get the frequecies that correspond to the current UDVS bins from the total x_hist
-                """
-                this_x_hist = np.take(x_hist[0], udvs_bins)
-                this_x_hist = this_x_hist - this_x_hist[0]
-                this_x_hist = np.transpose(np.tile(this_x_hist, (1, pix_chunks[ichunk + 1] - pix_chunks[ichunk])))
-                this_x_hist = np.squeeze(this_x_hist)
-
-                N_x_bins = np.shape(this_x_hist)[0]
-                if debug:
-                    print('N_x_bins', N_x_bins)
-                    print(this_x_hist)
-                    print(np.shape(this_x_hist))
-                """
-        Create weighting vector.  If setting all to one value, can be a scalar.
-                """
-                weighting_vec = 1
-
-                if debug:
-                    print(np.shape(data_mat))
+def _bin_be_block(data_mat, x_inds, N_x_bins, N_y_bins, func_list, min_list, max_list):
+    """
+    Histograms each of the requested components of a block of pixels
 
-                """
-        Set up the list of functions to call and their corresponding maxima and minima
-                """
-                func_list = [np.abs, np.angle, np.real, np.imag]
-                max_list = [self.max_response, np.pi, self.max_response, self.max_response]
-                min_list = [self.min_response, -np.pi, self.min_response, self.min_response]
-                """
-        Get the Histograms and store in correct place in ds_hist
-                """
-                for ifunc, func in enumerate(func_list):
-                    chunk_hist = build_histogram(this_x_hist,
-                                                 data_mat,
-                                                 N_x_bins,
-                                                 self.N_y_bins,
-                                                 weighting_vec,
-                                                 min_list[ifunc],
-                                                 max_list[ifunc],
-                                                 func,
-                                                 debug)
-                    if debug:
-                        print('chunkhist-{}'.format(func.__name__), np.shape(chunk_hist))
-                        print(chunk_hist.dtype)
-
-                    for (i, ifreq) in enumerate(udvs_bins):
-                        ids_freq = this_x_hist[i]
-                        if debug:
-                            print(i, ifreq)
-                            print(ids_freq)
-                        ds_hist[ifunc, ids_freq, :] = np.add(ds_hist[ifunc, ids_freq, :], chunk_hist[i, :])
+    Parameters
+    ----------
+    data_mat : 2D numpy array
+        block of pixels arranged as [pixel, bin]
+    x_inds : 1D numpy array
+        x-bin of each column of data_mat
+    N_x_bins : int
+        number of bins in the x-direction
+    N_y_bins : int
+        number of bins in the y-direction
+    func_list : list of functions
+        functions that extract each component of the response
+    min_list : list of floats
+        minimum value for y binning of each component
+    max_list : list of floats
+        maximum value for y binning of each component
 
-        return ds_hist
+    Returns
+    -------
+    block_hist : 3D numpy array
+        histograms arranged as [component, x-bin, y-bin]
+    """
+    return np.array([HistogramAccumulator(N_x_bins, N_y_bins, min_resp, max_resp, func=func).add(x_inds,
+                                                                                                  data_mat).histogram
+                     for func, min_resp, max_resp in zip(func_list, min_list, max_list)])
 
 
 def maxReadPixels(max_memory, tot_pix, bins_per_step, bytes_per_bin=4):
@@ -1791,7 +1889,7 @@ def getIndicesforPlotGroup(h5_udvs_inds, ds_udvs, plt_grp_name):
     # All UDVS steps that are NOT part of the plot grop are empty cells in the table
     # and hence assume a nan value.
     # getting the udvs step indices that belong to this plot group:
-    step_inds = np.where(np.isnan(udvs_col_data) is False)[0]
+    step_inds = np.where(np.isfinite(udvs_col_data))[0]
     # Getting the values in that plot group that were non NAN
     udvs_plt_grp_col = udvs_col_data[step_inds]
 
@@ -1800,14 +1898,9 @@ def getIndicesforPlotGroup(h5_udvs_inds, ds_udvs, plt_grp_name):
     # Now we use the udvs step indices calculated above to get
     # the indices in the spectroscopic indices table
     spec_ind_udvs_step_col = h5_udvs_inds[h5_udvs_inds.attrs.get('UDVS_Step')]
-    num_bins = len(np.where(spec_ind_udvs_step_col == step_inds[0])[0])
+    oneD_indices = get_bins_for_steps(group_bins_by_step(spec_ind_udvs_step_col), step_inds)
     # Stepehen says that we can assume that the number of bins will NOT change in a plot group
-    step_bin_indices = np.zeros(shape=(len(step_inds), num_bins), dtype=int)
-
-    for indx, step in enumerate(step_inds):
-        step_bin_indices[indx, :] = np.where(spec_ind_udvs_step_col == step)[0]
-
-    oneD_indices = step_bin_indices.reshape((step_bin_indices.shape[0] * step_bin_indices.shape[1]))
+    step_bin_indices = oneD_indices.reshape(len(step_inds), -1)
     return step_bin_indices, oneD_indices, udvs_plt_grp_col
 
 
@@ -30,8 +30,9 @@ from .cluster import Cluster
 from . import image_processing
 from .image_processing import ImageWindow
 from .signal_filter import SignalFilter
-from .tree import ClusterTree
+from .tree import ClusterTree, LinkageTree
 from . import proc_utils
 
 __all__ = ['Cluster', 'Decomposition', 'ImageWindow', 'SVD', 'fft', 'gmode_utils', 'histogram', 'svd_utils',
-           'rebuild_svd', 'SignalFilter', 'ClusterTree', 'proc_utils']
+           'rebuild_svd', 'SignalFilter', 'ClusterTree', 'LinkageTree',
+           'proc_utils']
@@ -7,12 +7,16 @@ Created on Tue Jan 05 07:55:56 2016
 """
 from __future__ import division, print_function, absolute_import
 import time
+import h5py
 import numpy as np
 import sklearn.cluster as cls
+from sklearn.utils import gen_batches
+from scipy import sparse
 from scipy.cluster.hierarchy import linkage
 from scipy.spatial.distance import pdist
 from .proc_utils import get_component_slice
-from pyUSID.processing.process import Process, parallel_compute
+from .svd_utils import streamed_randomized_svd
+from pyUSID.processing.process import Process
 from pyUSID.io.hdf_utils import reshape_to_n_dims, create_results_group, write_main_dataset, get_attr, \
     write_simple_attrs, link_h5_obj_as_alias, write_ind_val_dsets
 from pyUSID import USIDataset
@@ -26,7 +30,8 @@ class Cluster(Process):
     Pycroscopy wrapper around the sklearn.cluster classes.
     """
 
-    def __init__(self, h5_main, estimator, num_comps=None, **kwargs):
+    def __init__(self, h5_main, estimator, num_comps=None, spatial_connectivity=False, num_svd_comps=None,
+                 **kwargs):
         """
         Constructs the Cluster object
         Parameters
@@ -37,7 +42,24 @@ class Cluster(Process):
             configured clustering algorithm to be applied to the data
         num_comps : (optional) unsigned int
             Number of features / spectroscopic indices to be used to cluster the data. Default = all
+        spatial_connectivity : bool, optional. Default = False
+            Only for AgglomerativeClustering. If True, only positions that are adjacent to each other on the grid
+            described by the position indices may be merged
+        num_svd_comps : (optional) unsigned int
+            If provided, each position is clustered based on its projection onto these many SVD components computed
+            out-of-core instead of the raw data. The mean response is still calculated from the raw data.
+            Not applicable to MiniBatchKMeans. Default = raw data is clustered
         args and kwargs : arguments to be passed to the estimator
+
+        Notes
+        -----
+        MiniBatchKMeans is fit by streaming chunks of positions from the HDF5 file via partial_fit(). The file is
+        passed over up to max_iter times, subject to the tol and max_no_improvement settings of the estimator. The
+        labels and the mean response of each cluster are then computed together in a single streamed pass.
+
+        Unconstrained AgglomerativeClustering requires memory that scales as the square of the number of positions.
+        With spatial_connectivity, (Ward) agglomeration only considers the sparse grid of neighboring positions,
+        which yields spatially contiguous domains while the memory scales linearly with the number of positions.
         """
 
         allowed_methods = [cls.AgglomerativeClustering,
@@ -52,6 +74,16 @@ class Cluster(Process):
         if type(estimator) not in allowed_methods:
             raise TypeError('Cannot work with {} just yet'.format(self.method_name))
 
+        if spatial_connectivity and not isinstance(estimator, cls.AgglomerativeClustering):
+            raise TypeError('spatial_connectivity is only applicable to AgglomerativeClustering, not {}'
+                            ''.format(self.method_name))
+
+        if num_svd_comps is not None:
+            if isinstance(estimator, cls.MiniBatchKMeans):
+                raise ValueError('num_svd_comps cannot be used with MiniBatchKMeans')
+            if not isinstance(num_svd_comps, (int, np.integer)) or num_svd_comps < 1:
+                raise ValueError('num_svd_comps should be a positive integer')
+
         # Done with decomposition-related checks, now call super init
         super(Cluster, self).__init__(h5_main, **kwargs)
 
@@ -90,6 +122,14 @@ class Cluster(Process):
                            'spectral_components': comp_attr}
         self.parms_dict.update(self.estimator.get_params())
 
+        self.spatial_connectivity = spatial_connectivity
+        self.num_svd_comps = num_svd_comps
+        if spatial_connectivity:
+            # The graph itself is built from the position indices when clustering
+            self.parms_dict['connectivity'] = 'position_grid'
+        if num_svd_comps is not None:
+            self.parms_dict['svd_components'] = num_svd_comps
+
         # update n_jobs according to the cores argument
         # print('cores reset to', self._cores)
         # different number of cores should not* be a reason for different results
@@ -109,6 +149,9 @@ class Cluster(Process):
         # supercharge h5_main!
         self.h5_main = USIDataset(self.h5_main)
 
+        # MiniBatchKMeans can learn incrementally and predict labels for chunks of positions
+        self.__streaming = isinstance(self.estimator, cls.MiniBatchKMeans)
+
         self.__labels = None
         self.__mean_resp = None
 
@@ -145,18 +188,36 @@ class Cluster(Process):
         t1 = time.time()
 
         print('Performing clustering on {}.'.format(self.h5_main.name))
-        # perform fit on the real dataset
-        results = self.estimator.fit(self.data_transform_func(self.h5_main[self.data_slice]))
+        if self.__streaming:
+            self._fit_streamed()
 
-        print('Took {} to compute {}'.format(format_time(time.time() - t1), self.method_name))
+            print('Took {} to compute {}'.format(format_time(time.time() - t1), self.method_name))
 
-        t1 = time.time()
-        self.__mean_resp = self._get_mean_response(results.labels_)
-        print('Took {} to calculate mean response per cluster'.format(format_time(time.time() - t1)))
+            t1 = time.time()
+            self.__labels, self.__mean_resp = self._predict_mean_response()
+            print('Took {} to predict labels and calculate mean response per cluster'
+                  ''.format(format_time(time.time() - t1)))
+        else:
+            if self.spatial_connectivity:
+                self.estimator.connectivity = get_grid_connectivity(self.h5_main.h5_pos_inds[()])
+
+            if self.num_svd_comps is None:
+                # perform fit on the real dataset
+                data = self.data_transform_func(self.h5_main[self.data_slice])
+            else:
+                data = self._get_svd_projection()
+
+            results = self.estimator.fit(data)
+
+            print('Took {} to compute {}'.format(format_time(time.time() - t1), self.method_name))
+
+            t1 = time.time()
+            self.__labels = results.labels_
+            self.__mean_resp = self._get_mean_response(self.__labels)
+            print('Took {} to calculate mean response per cluster'.format(format_time(time.time() - t1)))
 
-        self.__labels = results.labels_
         if rearrange_clusters:
-            self.__labels, self.__mean_resp = reorder_clusters(results.labels_, self.__mean_resp,
+            self.__labels, self.__mean_resp = reorder_clusters(self.__labels, self.__mean_resp,
                                                                self.data_transform_func)
 
         # TODO: What if test() is called repeatedly?
@@ -214,9 +275,147 @@ class Cluster(Process):
 
         return h5_group
 
+    def _get_batches(self):
+        """
+        Returns the slices of positions that can be read into memory at a time
+
+        Returns
+        -------
+        batches : generator of slice objects
+            Contiguous slices of positions
+        """
+        return gen_batches(self.h5_main.shape[0], max(1, self._max_pos_per_read))
+
+    def _read_data(self, pos_slice):
+        """
+        Reads the spectral components of interest for the requested positions as real values
+
+        Parameters
+        ----------
+        pos_slice : slice
+            Positions to read
+
+        Returns
+        -------
+        data : 2D real numpy array
+            Data arranged as [position, component]
+        """
+        return self.data_transform_func(self.h5_main[pos_slice, self.data_slice[1]])
+
+    def _get_svd_projection(self):
+        """
+        Projects each position onto the first num_svd_comps SVD components of the spectral components of interest.
+        The SVD is computed by streaming blocks of positions from the file.
+
+        Returns
+        -------
+        projection : 2D real numpy array
+            Projection arranged as [position, SVD component]
+        """
+        u_mat, s_vec, _ = streamed_randomized_svd(self.h5_main, self.num_svd_comps, max_mem_mb=self._max_mem_mb,
+                                                  col_slice=self.data_slice[1], verbose=self.verbose)
+        return u_mat * s_vec
+
+    def _fit_streamed(self):
+        """
+        Fits the estimator one mini-batch at a time while reading one chunk of positions at a time from the file.
+        The cluster centers are initialized from the first init_size positions. Like MiniBatchKMeans.fit(), passes
+        over the file are repeated up to max_iter times until the cluster centers move by less than tol (scaled by
+        the mean variance of the data) over a pass or the mean inertia has not improved for max_no_improvement
+        consecutive passes.
+        """
+        batch_size = self.estimator.batch_size
+        init_size = self.estimator.init_size
+        if init_size is None:
+            init_size = 3 * batch_size
+        init_size = max(init_size, self.estimator.n_clusters)
+        max_no_improvement = self.estimator.max_no_improvement
+
+        # Forget any prior fit
+        for attr_name in ['cluster_centers_', 'counts_', 'random_state_']:
+            if hasattr(self.estimator, attr_name):
+                delattr(self.estimator, attr_name)
+
+        tolerance = None
+        best_inertia = None
+        no_improvement = 0
+        for epoch in range(max(1, self.estimator.max_iter)):
+            old_centers = None
+            inertia = 0
+            data_sum = 0
+            data_sq_sum = 0
+            for pos_slice in self._get_batches():
+                if self.verbose:
+                    print('Epoch {}: fitting positions {} to {}'.format(epoch, pos_slice.start, pos_slice.stop))
+                data = self._read_data(pos_slice)
+                if tolerance is None:
+                    data_sum = data_sum + np.sum(data, axis=0, dtype=np.float64)
+                    data_sq_sum = data_sq_sum + np.sum(np.float64(data) ** 2, axis=0)
+                start = 0
+                if not hasattr(self.estimator, 'cluster_centers_'):
+                    start = min(init_size, data.shape[0])
+                    self.estimator.partial_fit(data[:start])
+                if old_centers is None:
+                    old_centers = self.estimator.cluster_centers_.copy()
+                for mini_batch in gen_batches(data.shape[0] - start, batch_size):
+                    batch = data[start + mini_batch.start: start + mini_batch.stop]
+                    # inertia of the batch is measured before the centers are updated with it, as in fit()
+                    inertia -= self.estimator.score(batch)
+                    self.estimator.partial_fit(batch)
+
+            if tolerance is None:
+                num_pos = self.h5_main.shape[0]
+                tolerance = self.estimator.tol * np.mean(data_sq_sum / num_pos - (data_sum / num_pos) ** 2)
+
+            center_shift = np.sum((self.estimator.cluster_centers_ - old_centers) ** 2)
+            if self.verbose:
+                print('Epoch {}: mean inertia = {}, squared center shift = {}'
+                      ''.format(epoch, inertia / self.h5_main.shape[0], center_shift))
+            if tolerance > 0 and center_shift <= tolerance:
+                break
+            if best_inertia is None or inertia < best_inertia:
+                best_inertia = inertia
+                no_improvement = 0
+            else:
+                no_improvement += 1
+            if max_no_improvement is not None and no_improvement >= max_no_improvement:
+                break
+
+    def _predict_mean_response(self):
+        """
+        Predicts the labels for each chunk of positions and accumulates the sum of the responses in each cluster in
+        the same pass through the file
+
+        Returns
+        -------
+        labels : 1D unsigned int array
+            Array of cluster labels for each position
+        mean_resp : 2D numpy array
+            Array of the mean response for each cluster arranged as [cluster number, response]
+        """
+        num_clusts = self.estimator.n_clusters
+        labels = np.zeros(self.h5_main.shape[0], dtype=np.int32)
+        sums = None
+        counts = np.zeros(num_clusts, dtype=np.int64)
+
+        for pos_slice in self._get_batches():
+            data = self._read_data(pos_slice)
+            labels[pos_slice] = self.estimator.predict(data)
+            chunk_sums, chunk_counts = get_cluster_sums(labels[pos_slice], data, num_clusts)
+            sums = chunk_sums if sums is None else sums + chunk_sums
+            counts += chunk_counts
+
+        return labels, self.__sums_to_mean_response(sums, counts)
+
+    def __sums_to_mean_response(self, sums, counts):
+        # Empty clusters are left as zeros
+        avg_data = sums / np.maximum(counts, 1)[:, None]
+        # transform back to the source data type
+        return stack_real_to_target_dtype(avg_data.astype(sums.dtype), self.h5_main.dtype)
+
     def _get_mean_response(self, labels):
         """
-        Gets the mean response for each cluster
+        Gets the mean response for each cluster in a single pass through the file
 
         Parameters
         -------------
@@ -229,25 +428,17 @@ class Cluster(Process):
             Array of the mean response for each cluster arranged as [cluster number, response]
         """
         print('Calculated the Mean Response of each cluster.')
-        num_clusts = len(np.unique(labels))
-
-        def __mean_resp_for_cluster(clust_ind, h5_raw, labels_vec, data_slice, xform_func):
-            # get all pixels with this label
-            targ_pos = np.argwhere(labels_vec == clust_ind)
-            # slice to get the responses for all these pixels, ensure that it's 2d
-            data_chunk = np.atleast_2d(h5_raw[:, data_slice[1]][targ_pos, :])
-            # transform to real from whatever type it was
-            avg_data = np.mean(xform_func(data_chunk), axis=0, keepdims=True)
-            # transform back to the source data type and insert into the mean response
-            return np.squeeze(stack_real_to_target_dtype(avg_data, h5_raw.dtype))
-
-        # TODO: Force usage of multiple threads. This should not take 3 cores
-        mean_resp = np.array(parallel_compute(np.arange(num_clusts), __mean_resp_for_cluster,
-                                              func_args=[self.h5_main, labels, self.data_slice,
-                                                         self.data_transform_func], lengthy_computation=True,
-                                              verbose=self.verbose))
-
-        return mean_resp
+        num_clusts = int(np.max(labels)) + 1
+
+        sums = None
+        counts = np.zeros(num_clusts, dtype=np.int64)
+
+        for pos_slice in self._get_batches():
+            chunk_sums, chunk_counts = get_cluster_sums(labels[pos_slice], self._read_data(pos_slice), num_clusts)
+            sums = chunk_sums if sums is None else sums + chunk_sums
+            counts += chunk_counts
+
+        return self.__sums_to_mean_response(sums, counts)
 
     def _write_results_chunk(self):
         """
@@ -308,6 +499,253 @@ class Cluster(Process):
         return h5_cluster_group
 
 
+def get_grid_connectivity(pos_inds):
+    """
+    Builds the sparse connectivity graph that connects each position to its immediate neighbors along each
+    position dimension. Positions may be in any order and the grid need not be fully populated.
+
+    Parameters
+    ----------
+    pos_inds : 2D unsigned int numpy array
+        Position indices arranged as [position, dimension]
+
+    Returns
+    -------
+    connectivity : scipy.sparse.csr_matrix
+        Symmetric adjacency matrix of shape [position, position]
+    """
+    pos_inds = np.asarray(pos_inds, dtype=np.int64)
+    if pos_inds.ndim == 1:
+        pos_inds = np.expand_dims(pos_inds, axis=1)
+    num_pos = pos_inds.shape[0]
+
+    pos_inds = pos_inds - np.min(pos_inds, axis=0)
+    grid_shape = tuple(np.max(pos_inds, axis=0) + 1)
+
+    # Position (row) located at each point on the grid. -1 where the grid is not populated
+    lookup = -np.ones(int(np.prod(grid_shape)), dtype=np.int64)
+    lookup[np.ravel_multi_index(pos_inds.T, grid_shape)] = np.arange(num_pos)
+
+    rows = []
+    cols = []
+    for dim_ind in range(pos_inds.shape[1]):
+        has_next = np.flatnonzero(pos_inds[:, dim_ind] < grid_shape[dim_ind] - 1)
+        next_inds = pos_inds[has_next]
+        next_inds[:, dim_ind] += 1
+        neighbors = lookup[np.ravel_multi_index(next_inds.T, grid_shape)]
+        valid = neighbors >= 0
+        rows.append(has_next[valid])
+        cols.append(neighbors[valid])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    connectivity = sparse.coo_matrix((np.ones(2 * rows.size, dtype=np.int32),
+                                      (np.hstack((rows, cols)), np.hstack((cols, rows)))),
+                                     shape=(num_pos, num_pos))
+    return connectivity.tocsr()
+
+
+def _as_int_labels(labels):
+    """
+    Returns the cluster labels as integers that can be used for counting and indexing
+
+    Parameters
+    ----------
+    labels : numpy array
+        Cluster labels of any real dtype
+
+    Returns
+    -------
+    labels : numpy array
+        Labels as integers
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind in 'ui':
+        return labels
+    int_labels = labels.astype(np.intp)
+    if not np.array_equal(int_labels, labels):
+        raise ValueError('Cluster labels must be whole numbers')
+    return int_labels
+
+
+def _group_by_label(labels, num_clusters):
+    """
+    Finds the order that groups positions by their cluster label
+
+    Parameters
+    ----------
+    labels : 1D unsigned int numpy array
+        Cluster label of each position
+    num_clusters : unsigned int
+        Number of clusters
+
+    Returns
+    -------
+    counts : 1D unsigned int numpy array
+        Number of positions in each cluster
+    order : 1D unsigned int numpy array
+        Positions sorted by their cluster label. Positions within a cluster retain their relative order
+    present : 1D unsigned int numpy array
+        Clusters with at least one position
+    starts : 1D unsigned int numpy array
+        Index into order where each of the present clusters starts
+    """
+    counts = np.bincount(labels, minlength=num_clusters)
+    order = np.argsort(labels, kind='mergesort')
+    present = np.flatnonzero(counts)
+    starts = np.cumsum(counts)[present] - counts[present]
+    return counts, order, present, starts
+
+
+def get_cluster_sums(labels, data, num_clusters=None):
+    """
+    Sums the responses belonging to each cluster in a single pass through the labels
+
+    Parameters
+    ----------
+    labels : 1D numpy array
+        Cluster label of each position. Labels stored as floats must be whole numbers
+    data : 2D real numpy array
+        Data arranged as [position, features]
+    num_clusters : unsigned int, optional
+        Number of clusters. Default = largest label + 1
+
+    Returns
+    -------
+    sums : 2D numpy array
+        Sum of the responses of each cluster arranged as [cluster, features]
+    counts : 1D unsigned int numpy array
+        Number of positions in each cluster
+    """
+    labels = _as_int_labels(np.ravel(labels))
+    if num_clusters is None:
+        num_clusters = int(np.max(labels)) + 1
+    counts, order, present, starts = _group_by_label(labels, num_clusters)
+
+    sums = np.zeros((num_clusters, data.shape[1]), dtype=np.result_type(data.dtype, np.float32))
+    if present.size == 0:
+        return sums, counts
+
+    # Sum each contiguous group of rows
+    sums[present] = np.add.reduceat(data[order], starts, axis=0)
+
+    return sums, counts
+
+
+def _get_chunk_statistics(labels, data, num_clusters):
+    """
+    Computes the size, mean and sum of squared deviations from the mean of each cluster as well as the distance of
+    each position from the mean of its cluster
+
+    Parameters
+    ----------
+    labels : 1D unsigned int numpy array
+        Cluster label of each position
+    data : 2D real numpy array
+        Data arranged as [position, features]
+    num_clusters : unsigned int
+        Number of clusters
+
+    Returns
+    -------
+    counts : 1D unsigned int numpy array
+        Number of positions in each cluster
+    means : 2D numpy array
+        Mean response of each cluster arranged as [cluster, features]
+    sq_devs : 2D numpy array
+        Sum of the squared deviations from the mean arranged as [cluster, features]
+    distances : 1D numpy array
+        Euclidean distance between each position and the mean of its cluster
+    """
+    counts, order, present, starts = _group_by_label(labels, num_clusters)
+
+    dtype = np.result_type(data.dtype, np.float32)
+    means = np.zeros((num_clusters, data.shape[1]), dtype=dtype)
+    sq_devs = np.zeros((num_clusters, data.shape[1]), dtype=dtype)
+    distances = np.zeros(labels.size, dtype=dtype)
+    if present.size == 0:
+        return counts, means, sq_devs, distances
+
+    sorted_data = data[order]
+    means[present] = np.add.reduceat(sorted_data, starts, axis=0) / counts[present, None]
+    deviations = (sorted_data - means[labels[order]]) ** 2
+    sq_devs[present] = np.add.reduceat(deviations, starts, axis=0)
+    distances[order] = np.sqrt(np.sum(deviations, axis=1))
+
+    return counts, means, sq_devs, distances
+
+
+def get_cluster_statistics(labels, data, num_clusters=None, max_mem_mb=1024):
+    """
+    Computes the size, mean response and standard deviation of each cluster and the distance of each position from
+    the mean response of its cluster.
+
+    In-memory data are grouped by label once and all statistics are computed from that grouping. HDF5 datasets are
+    read in chunks of positions: the per-chunk statistics are merged to obtain the size, mean and standard deviation
+    of each cluster, and the distances are computed in a second pass through the file.
+
+    Parameters
+    ----------
+    labels : 1D numpy array or h5py.Dataset
+        Cluster label of each position, such as the Labels dataset written by Cluster. Labels stored as floats must
+        be whole numbers
+    data : 2D numpy array or h5py.Dataset
+        Data arranged as [position, features]. Complex and compound HDF5 datasets are flattened to real values
+    num_clusters : unsigned int, optional
+        Number of clusters. Default = largest label + 1
+    max_mem_mb : uint, optional. Default = 1024
+        Memory budget (in MB) that determines the number of positions read at a time from HDF5 datasets
+
+    Returns
+    -------
+    counts : 1D unsigned int numpy array
+        Number of positions in each cluster
+    mean_resp : 2D real numpy array
+        Mean response of each cluster arranged as [cluster, features]
+    std_resp : 2D real numpy array
+        Standard deviation of the response of each cluster arranged as [cluster, features]
+    distances : 1D real numpy array
+        Euclidean distance between each position and the mean response of its cluster
+    """
+    if isinstance(labels, h5py.Dataset):
+        labels = labels[()]
+    labels = _as_int_labels(np.ravel(labels))
+    if num_clusters is None:
+        num_clusters = int(np.max(labels)) + 1
+
+    if not isinstance(data, h5py.Dataset):
+        counts, mean_resp, sq_devs, distances = _get_chunk_statistics(labels, np.asarray(data), num_clusters)
+        return counts, mean_resp, np.sqrt(sq_devs / np.maximum(counts, 1)[:, None]), distances
+
+    data_transform_func, _, _, _, type_mult = check_dtype(data)
+    # The chunk of data, its sorted copy and the deviations from the mean:
+    rows_per_chunk = max(1, int(max_mem_mb * 1024 ** 2 // (3 * data.shape[1] * type_mult)))
+    batches = list(gen_batches(data.shape[0], rows_per_chunk))
+
+    counts = None
+    for pos_slice in batches:
+        chunk_counts, chunk_means, chunk_sq_devs, _ = _get_chunk_statistics(labels[pos_slice],
+                                                                            data_transform_func(data[pos_slice]),
+                                                                            num_clusters)
+        if counts is None:
+            counts, mean_resp, sq_devs = chunk_counts, chunk_means, chunk_sq_devs
+            continue
+        # Merge the statistics of the chunk with those of the previous chunks (Chan et al.)
+        new_counts = counts + chunk_counts
+        weights = (chunk_counts / np.maximum(new_counts, 1))[:, None]
+        delta = chunk_means - mean_resp
+        mean_resp = mean_resp + delta * weights
+        sq_devs = sq_devs + chunk_sq_devs + delta ** 2 * counts[:, None] * weights
+        counts = new_counts
+
+    distances = np.zeros(labels.size, dtype=mean_resp.dtype)
+    for pos_slice in batches:
+        chunk = data_transform_func(data[pos_slice])
+        distances[pos_slice] = np.sqrt(np.sum((chunk - mean_resp[labels[pos_slice]]) ** 2, axis=1))
+
+    return counts, mean_resp, np.sqrt(sq_devs / np.maximum(counts, 1)[:, None]), distances
+
+
 def reorder_clusters(labels, mean_response, transform_function=None):
     """
     Reorders clusters by the distances between the clusters
@@ -330,6 +768,9 @@ def reorder_clusters(labels, mean_response, transform_function=None):
     """
 
     num_clusters = mean_response.shape[0]
+    if num_clusters < 2:
+        return labels.copy(), mean_response.copy()
+
     # Get the distance between cluster means
     if transform_function is not None:
         distance_mat = pdist(transform_function(mean_response))
@@ -339,20 +780,12 @@ def reorder_clusters(labels, mean_response, transform_function=None):
     # get hierarchical pairings of clusters
     linkage_pairing = linkage(distance_mat, 'weighted')
 
-    # get the new order - this has been checked to be OK
-    new_cluster_order = []
-    for row in range(linkage_pairing.shape[0]):
-        for col in range(2):
-            if linkage_pairing[row, col] < num_clusters:
-                new_cluster_order.append(int(linkage_pairing[row, col]))
+    # get the new order - leaves (original clusters) in the order in which they are paired
+    pairings = linkage_pairing[:, :2].ravel()
+    new_cluster_order = pairings[pairings < num_clusters].astype(np.intp)
 
     # Now that we know the order, rearrange the clusters and labels:
-    new_labels = np.zeros(shape=labels.shape, dtype=labels.dtype)
-    new_mean_response = np.zeros(shape=mean_response.shape, dtype=mean_response.dtype)
-
-    # Reorder clusters
-    for old_clust_ind, new_clust_ind in enumerate(new_cluster_order):
-        new_labels[np.where(labels == new_clust_ind)[0]] = old_clust_ind
-        new_mean_response[old_clust_ind] = mean_response[new_clust_ind]
+    old_to_new = np.zeros(num_clusters, dtype=labels.dtype)
+    old_to_new[new_cluster_order] = np.arange(num_clusters)
 
-    return new_labels, new_mean_response
+    return old_to_new[labels], mean_response[new_cluster_order]
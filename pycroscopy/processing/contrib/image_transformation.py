@@ -8,14 +8,18 @@ Abandoned code - needs documentation to be promoted to Process classes
 """
 
 from __future__ import division, print_function, absolute_import
-from skimage.feature import match_descriptors, register_translation
 from skimage.measure import ransac
-from skimage.transform import warp, SimilarityTransform
+from skimage.transform import warp, SimilarityTransform, ProjectiveTransform
+from sklearn.utils import gen_batches
+import hashlib
+import os
+import shutil
+import tempfile
 import warnings
 import h5py
+import joblib
 import numpy as np
 import skimage.feature
-import multiprocessing as mp
 
 
 def pickle_keypoints(keypoints):
@@ -50,25 +54,36 @@ class FeatureExtractor(object):
         The following can be used for:
         lib = opencv: SIFT, ORB, SURF
         lib = skimage: ORB, BRIEF, CENSURE
+    cache_path : (string), optional
+        Path to an HDF5 file in which the features of each frame are kept so that they are only computed once
+        for a given dataset, detector and set of detector parameters.
+    detector_params : dict, optional
+        Keyword arguments passed on to the detector, e.g. n_keypoints for ORB
 
     """
 
-    def __init__(self, detector_name, lib):
+    def __init__(self, detector_name, lib, cache_path=None, **detector_params):
         self.data = []
+        self._data_id = None
         self.lib = lib
+        self.detector = None
+        self.detector_name = detector_name
+        self.detector_params = detector_params
+        self.cache_path = cache_path
 
         try:
             if self.lib == 'opencv':
                 pass
                 #                detector = cv2.__getattribute__(detector_name)
             elif self.lib == 'skimage':
-                self.detector = skimage.feature.__getattribute__(detector_name)
+                self.detector = skimage.feature.__getattribute__(detector_name)(**detector_params)
         except AttributeError:
             print('Error: The Library does not contain the specified detector')
 
     def clear_data(self):
         del self.data
         self.data = []
+        self._data_id = None
 
     def load_data(self, dataset):
         """
@@ -76,27 +91,46 @@ class FeatureExtractor(object):
 
         Parameters
         ----------
-        dataset : h5py.Dataset
-            Dataset to be corrected
+        dataset : h5py.Dataset or numpy.ndarray
+            Dataset to be corrected, with one flattened square frame per row.
+            HDF5 datasets are read a chunk at a time rather than being loaded into memory.
+            In the feature cache, HDF5 datasets are identified by their file and path and arrays by their contents.
         """
-        if not isinstance(dataset, h5py.Dataset):
-            warnings.warn('Error: Data must be an h5 Dataset object')
+        if isinstance(dataset, h5py.Dataset):
+            self.data = _FrameStack(dataset)
+            self._data_id = (os.path.abspath(dataset.file.filename), dataset.name)
+        elif isinstance(dataset, np.ndarray):
+            dim = int(np.sqrt(dataset.shape[-1]))
+            self.data = dataset.reshape(-1, dim, dim)
+            self._data_id = (dataset.dtype.str, hashlib.md5(np.ascontiguousarray(dataset)).hexdigest())
         else:
-            self.data = dataset
-            dim = int(np.sqrt(self.data.shape[-1]))
-            self.data = self.data.reshape(-1, dim, dim)
+            warnings.warn('Error: Data must be an h5 Dataset object or a numpy array')
+
+    def _get_cache_key(self, window):
+        """
+        Name of the cache group holding the features of the loaded data computed with the current detector parameters
+        """
+        params = repr((self._data_id, self.lib, sorted(self.detector_params.items()), window,
+                       tuple(self.data.shape)))
+        return '{}_{}'.format(self.detector_name, hashlib.md5(params.encode('utf-8')).hexdigest())
 
-    def getFeatures(self, mask=False, origin=[0, 0], win_size=0, processes=1):
+    def getFeatures(self, mask=False, origin=[0, 0], win_size=0, processes=1, max_mem_mb=1024):
         """
         This is a Method that returns features (keypoints and descriptors)
         that are obtained by using the FeatureExtractor.Detector object.
 
         Parameters
         ----------
-        processors : int, optional
+        processes : int, optional
                     Number of processors to use, default = 1.
         mask : boolean, optional, default False.
-            Whether to use
+            Whether to only use a square window of each image
+        origin : list, optional
+            Center of the window as [row, column], default = [0, 0].
+        win_size : int, optional
+            Size of the window, default = 0.
+        max_mem_mb : float, optional
+            Memory, in megabytes, available for staging images, default = 1024.
 
         Returns
         -------
@@ -106,65 +140,45 @@ class FeatureExtractor(object):
             descriptors
 
         """
-        detector = self.detector
-        dset = self.data
-        lib = self.lib
-
+        window = None
         if mask:
-            def mask_func(x, winSize):
-                x[origin[0] - winSize / 2: origin[0] + winSize / 2,
-                  origin[1] - winSize / 2: origin[1] + winSize / 2] = 2
-                x = x - 1
-                return x
-
-            mask_ind = np.mask_indices(dset.shape[-1], mask_func, win_size)
-            self.data = np.array([imp[mask_ind].reshape(win_size, win_size) for imp in dset])
-
-        # detect and compute keypoints
-        def detect(image):
-            if lib == 'opencv':
-                image = (image - image.mean()) / image.std()
-                image = image.astype('uint8')
-                k_obj, d_obj = detector.detectAndCompute(image, None)
-                keypts, descs = pickle_keypoints(k_obj), pickle_keypoints(d_obj)
-
-            elif lib == 'skimage':
-                imp = (image - image.mean()) / np.std(image)
-                imp[imp < 0] = 0
-                imp.astype('float32')
-                detector.detect_and_extract(imp)
-                keypts, descs = detector.keypoints, detector.descriptors
-
-            return keypts, descs
-
-        # start pool of workers
-        if processes > 1:
-            print('launching %i kernels...' % processes)
-            pool = mp.Pool(processes)
-            tasks = [imp for imp in self.data]
-            chunk = int(self.data.shape[0] / processes)
-            jobs = pool.imap(detect, tasks, chunksize=chunk)
-
-            # get keypoints and descriptors
-            results = []
-            print('Extracting features...')
-            try:
-                for j in jobs:
-                    results.append(j)
-            except ValueError:
-                warnings.warn('ValueError something about 2d-image. Probably some of the detector '
-                              'input params are wrong.')
-
-            # close the pool
-            print('Closing down the kernels... \n')
-            pool.close()
+            window = (slice(origin[0] - win_size // 2, origin[0] + win_size // 2),
+                      slice(origin[1] - win_size // 2, origin[1] + win_size // 2))
 
-        else:
-            results = [detect(imp) for imp in self.data]
+        features = dict()
+        h5_cache = None
+        if self.cache_path is not None:
+            h5_cache = h5py.File(self.cache_path, mode='a')
+        try:
+            if h5_cache is not None:
+                h5_grp = h5_cache.require_group(self._get_cache_key(window))
+                for frame_ind in range(len(self.data)):
+                    name = 'Frame_{:05d}'.format(frame_ind)
+                    if name in h5_grp:
+                        features[frame_ind] = (h5_grp[name]['Keypoints'][()], h5_grp[name]['Descriptors'][()])
+
+            # detect and compute keypoints of the remaining frames
+            missing = np.array([ind for ind in range(len(self.data)) if ind not in features], dtype=np.intp)
+            if missing.size > 0:
+                if processes > 1:
+                    print('launching %i kernels...' % processes)
+                print('Extracting features...')
+                for batch, results in _map_frame_batches(_detect_frames, self.data, [missing], processes=processes,
+                                                         max_mem_mb=max_mem_mb, frames_per_task=4,
+                                                         detector=self.detector, lib=self.lib, window=window):
+                    for frame_ind, (keypts, descs) in zip(missing[batch], results):
+                        features[frame_ind] = (keypts.astype('int'), descs)
+                        if h5_cache is not None:
+                            h5_frame = h5_grp.create_group('Frame_{:05d}'.format(frame_ind))
+                            h5_frame.create_dataset('Keypoints', data=features[frame_ind][0])
+                            h5_frame.create_dataset('Descriptors', data=descs)
+        finally:
+            if h5_cache is not None:
+                h5_cache.close()
 
         # get keypoints and descriptors
-        keypts = [itm[0].astype('int') for itm in results]
-        desc = [itm[1] for itm in results]
+        keypts = [features[ind][0] for ind in range(len(self.data))]
+        desc = [features[ind][1] for ind in range(len(self.data))]
 
         return keypts, desc
 
@@ -185,6 +199,346 @@ def euclidMatch(Matches, keypts1, keypts2, misalign):
     return filteredMatches
 
 
+class _FrameStack(object):
+    """
+    Presents an HDF5 dataset of flattened square frames as a stack of 2D frames without reading it into memory
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.dtype = dataset.dtype
+        dim = int(np.sqrt(dataset.shape[-1]))
+        self.shape = (int(np.prod(dataset.shape[:-1])), dim, dim)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        frames = self.dataset[item]
+        return frames.reshape(frames.shape[:-1] + self.shape[1:])
+
+
+def _share_frames(frames, temp_dir, max_mem_mb=1024):
+    """
+    Returns the stack of frames as a read-only numpy memmap that worker processes open by reference.
+    HDF5 datasets and in-memory arrays are copied into temp_dir one chunk at a time.
+    """
+    if isinstance(frames, np.memmap):
+        return frames
+    file_path = os.path.join(temp_dir, 'frames.dat')
+    shared = np.memmap(file_path, dtype=frames.dtype, mode='w+', shape=frames.shape)
+    frame_bytes = np.prod(frames.shape[1:]) * np.dtype(frames.dtype).itemsize
+    for batch in gen_batches(frames.shape[0], max(1, int(max_mem_mb * 1024 ** 2 / frame_bytes))):
+        shared[batch] = frames[batch]
+    shared.flush()
+    del shared
+    return np.memmap(file_path, dtype=frames.dtype, mode='r', shape=frames.shape)
+
+
+def _map_frame_batches(worker, frames, task_arrays, processes=1, max_mem_mb=1024, frames_per_task=1, **kwargs):
+    """
+    Calls worker(frames, *task_batches, **kwargs) over consecutive batches of tasks and yields the results in order
+    so that they can be written out one chunk at a time. With more than one process, the frames are shared
+    through a memmap and the workers only receive the indices of the frames they need.
+
+    Parameters
+    ----------
+    worker : callable
+        Module-level function that takes the stack of frames followed by one batch of each of the task arrays
+    frames : numpy.ndarray or _FrameStack
+        Stack of 2D frames
+    task_arrays : list of numpy.ndarray
+        Arrays with one entry per task, such as frame indices or transformation matrices
+    processes : int, optional
+        Number of processes to use. Default 1
+    max_mem_mb : float, optional
+        Memory, in megabytes, for the results held at any one time. Default 1024
+    frames_per_task : float, optional
+        Working memory needed by each task, as a multiple of a frame of float64 values. Default 1
+    kwargs : dict
+        Passed on to the worker
+
+    Yields
+    ------
+    batch : slice
+        Tasks in this batch
+    result : object
+        Output of the worker for this batch
+    """
+    num_tasks = len(task_arrays[0])
+    frame_bytes = frames_per_task * np.prod(frames.shape[1:]) * np.float64(0).itemsize
+    batch_size = max(1, min(int(np.ceil(num_tasks / max(1, processes))),
+                            int(max_mem_mb * 1024 ** 2 / (max(1, processes) * frame_bytes))))
+    batches = list(gen_batches(num_tasks, batch_size))
+
+    if processes <= 1:
+        for batch in batches:
+            yield batch, worker(frames, *[arr[batch] for arr in task_arrays], **kwargs)
+        return
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        shared = _share_frames(frames, temp_dir, max_mem_mb=max_mem_mb)
+        with joblib.Parallel(n_jobs=processes) as parallel:
+            for start in range(0, len(batches), processes):
+                batch_set = batches[start: start + processes]
+                results = parallel(joblib.delayed(worker)(shared, *[arr[batch] for arr in task_arrays], **kwargs)
+                                   for batch in batch_set)
+                for batch, result in zip(batch_set, results):
+                    yield batch, result
+        del shared
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _full_spectrum(half_spectra, num_cols):
+    """
+    Rebuilds the full 2D spectra of real images from the half spectra returned by np.fft.rfft2
+    """
+    num_rows = half_spectra.shape[-2]
+    rows = (-np.arange(num_rows)) % num_rows
+    cols = num_cols - np.arange(half_spectra.shape[-1], num_cols)
+    mirrored = np.conj(half_spectra[..., rows[:, None], cols[None, :]])
+    return np.concatenate((half_spectra, mirrored), axis=-1)
+
+
+def _upsampled_dft_stack(spectra, region_size, upsample_factor, offsets):
+    """
+    Upsampled DFT, by matrix multiplication, of a small region of each spectrum in a stack. Vectorized form of the
+    matrix-multiply DFT used by skimage.feature.register_translation
+
+    Parameters
+    ----------
+    spectra : numpy.ndarray
+        (N, rows, cols) full 2D spectra
+    region_size : int
+        Size of the square region to be sampled
+    upsample_factor : int
+        Upsampling factor
+    offsets : numpy.ndarray
+        (N, 2) offsets of the region sampled from each spectrum
+
+    Returns
+    -------
+    upsampled : numpy.ndarray
+        (N, region_size, region_size) upsampled DFT of each region
+    """
+    num_rows, num_cols = spectra.shape[-2:]
+    region = np.arange(region_size)
+    row_freqs = np.fft.ifftshift(np.arange(num_rows)) - np.floor(num_rows / 2)
+    col_freqs = np.fft.ifftshift(np.arange(num_cols)) - np.floor(num_cols / 2)
+    row_kernel = np.exp((-2j * np.pi / (num_rows * upsample_factor)) *
+                        (region[None, :, None] - offsets[:, 0, None, None]) * row_freqs[None, None, :])
+    col_kernel = np.exp((-2j * np.pi / (num_cols * upsample_factor)) *
+                        col_freqs[None, :, None] * (region[None, None, :] - offsets[:, 1, None, None]))
+    return np.matmul(np.matmul(row_kernel, spectra), col_kernel)
+
+
+def register_frame_pairs(frames, ref_inds, mov_inds, upsample_factor=1):
+    """
+    Finds the translation of each moving frame relative to its reference frame by cross-correlation. Every frame is
+    read and Fourier transformed once no matter how many pairs it belongs to, and all pairs are correlated and
+    refined together. The shifts match those of skimage.feature.register_translation for each pair.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray, numpy.memmap or _FrameStack
+        Stack of 2D frames
+    ref_inds : array-like
+        Index of the reference frame of each pair
+    mov_inds : array-like
+        Index of the moving frame of each pair
+    upsample_factor : int, optional
+        Frames will be registered to within 1 / upsample_factor of a pixel. Default 1
+
+    Returns
+    -------
+    shifts : numpy.ndarray
+        (pairs, 2) shift, in pixels as (row, column), required to register each moving frame with its reference
+    """
+    ref_inds = np.asarray(ref_inds, dtype=np.intp).ravel()
+    mov_inds = np.asarray(mov_inds, dtype=np.intp).ravel()
+    num_pairs = ref_inds.size
+    if num_pairs == 0:
+        return np.zeros((0, 2))
+
+    # read every frame only once, as a single block when the frames are contiguous
+    frame_inds, pair_inds = np.unique(np.concatenate((ref_inds, mov_inds)), return_inverse=True)
+    if frame_inds[-1] - frame_inds[0] + 1 == frame_inds.size:
+        stack = frames[frame_inds[0]: frame_inds[-1] + 1]
+    else:
+        stack = frames[frame_inds]
+    shape = np.array(stack.shape[-2:])
+
+    spectra = np.fft.rfft2(np.asarray(stack, dtype=np.float64))
+    image_product = spectra[pair_inds[:num_pairs]] * spectra[pair_inds[num_pairs:]].conj()
+    del spectra, stack
+
+    # coarse shifts from the peak of the cross-correlation
+    cross_correlation = np.fft.irfft2(image_product, s=tuple(shape))
+    peaks = np.argmax(np.abs(cross_correlation).reshape(num_pairs, -1), axis=1)
+    del cross_correlation
+    shifts = np.array(np.unravel_index(peaks, tuple(shape)), dtype=np.float64).T
+    midpoints = np.fix(shape / 2)
+    shifts = np.where(shifts > midpoints, shifts - shape, shifts)
+
+    if upsample_factor > 1:
+        # refine within a small neighborhood of each coarse peak with the upsampled DFT
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        region_size = int(np.ceil(upsample_factor * 1.5))
+        dftshift = np.fix(region_size / 2.0)
+        upsampled = _upsampled_dft_stack(_full_spectrum(image_product, shape[1]).conj(), region_size,
+                                         upsample_factor, dftshift - shifts * upsample_factor).conj()
+        peaks = np.argmax(np.abs(upsampled).reshape(num_pairs, -1), axis=1)
+        maxima = np.array(np.unravel_index(peaks, upsampled.shape[1:]), dtype=np.float64).T - dftshift
+        shifts = shifts + maxima / upsample_factor
+
+    shifts[:, shape == 1] = 0
+    return shifts
+
+
+def _get_registration_pairs(num_frames, reference=None):
+    """
+    Indices of the reference and moving frames to register, either each frame against the previous frame or every
+    frame against a single reference frame
+    """
+    if reference is None:
+        return np.arange(num_frames - 1), np.arange(1, num_frames)
+    return np.full(num_frames, reference, dtype=np.intp), np.arange(num_frames)
+
+
+def _warp_frames(frames, frame_inds, matrices, output_shape):
+    """
+    Warps each frame using its homogeneous transformation matrix as the inverse map
+    """
+    return np.array([warp(frames[ind], ProjectiveTransform(matrix=matrix), output_shape=output_shape,
+                          cval=0, preserve_range=True) for ind, matrix in zip(frame_inds, matrices)])
+
+
+def _detect_frames(frames, frame_inds, detector, lib, window=None):
+    """
+    Detects the keypoints and extracts the descriptors of each frame
+    """
+    results = []
+    for ind in frame_inds:
+        image = np.asarray(frames[ind], dtype=np.float64)
+        if window is not None:
+            image = image[window]
+        if lib == 'opencv':
+            image = (image - image.mean()) / image.std()
+            image = image.astype('uint8')
+            k_obj, d_obj = detector.detectAndCompute(image, None)
+            keypts, descs = pickle_keypoints(k_obj), pickle_keypoints(d_obj)
+
+        elif lib == 'skimage':
+            imp = (image - image.mean()) / np.std(image)
+            imp[imp < 0] = 0
+            detector.detect_and_extract(imp)
+            keypts, descs = detector.keypoints, detector.descriptors
+
+        results.append((keypts, descs))
+    return results
+
+
+def match_descriptor_pairs(descriptors, ref_inds, mov_inds, max_distance=np.inf, max_ratio=1.0, cross_check=True,
+                           max_mem_mb=1024):
+    """
+    Brute-force matching of descriptors for many pairs of images at once. The nearest neighbours of the descriptors
+    of each image are found with batched matrix products instead of one distance matrix per pair. The matches are
+    those of skimage.feature.match_descriptors with its default metric: hamming for binary descriptors and
+    euclidean otherwise.
+
+    Parameters
+    ----------
+    descriptors : list of numpy.ndarray
+        (keypoints, features) descriptors of each image
+    ref_inds : array-like
+        Index of the first image of each pair
+    mov_inds : array-like
+        Index of the second image of each pair
+    max_distance : float, optional
+        Maximum allowed distance between descriptors of two keypoints. Default infinity
+    max_ratio : float, optional
+        Maximum ratio between the distances of the nearest and second nearest neighbours. Default 1
+    cross_check : bool, optional
+        Only keep keypoints that are each other's nearest neighbour. Default True
+    max_mem_mb : float, optional
+        Memory, in megabytes, for the distance matrices held at any one time. Default 1024
+
+    Returns
+    -------
+    matches : list of numpy.ndarray
+        (matches, 2) indices of the matching descriptors in the first and second image of each pair
+    """
+    ref_inds = np.asarray(ref_inds, dtype=np.intp).ravel()
+    mov_inds = np.asarray(mov_inds, dtype=np.intp).ravel()
+    if ref_inds.size == 0:
+        return []
+
+    # zero-padded stack of descriptors and their squared norms
+    frame_inds, pair_inds = np.unique(np.concatenate((ref_inds, mov_inds)), return_inverse=True)
+    ref_pairs, mov_pairs = pair_inds[:ref_inds.size], pair_inds[ref_inds.size:]
+    num_descs = np.array([np.asarray(descriptors[ind]).shape[0] for ind in frame_inds])
+    binary = np.asarray(descriptors[frame_inds[0]]).dtype == np.bool_
+    # counts of differing bits are exact in single precision
+    dtype = np.float32 if binary else np.float64
+    stack = np.zeros((frame_inds.size, max(1, num_descs.max()), np.asarray(descriptors[frame_inds[0]]).shape[-1]),
+                     dtype=dtype)
+    for stack_ind, ind in enumerate(frame_inds):
+        stack[stack_ind, :num_descs[stack_ind]] = descriptors[ind]
+    sq_norms = np.sum(stack ** 2, axis=-1)
+    valid = np.arange(stack.shape[1])[None, :] < num_descs[:, None]
+
+    matches = []
+    pair_bytes = stack.shape[1] ** 2 * stack.itemsize
+    for batch in gen_batches(ref_pairs.size, max(1, int(max_mem_mb * 1024 ** 2 / (2 * pair_bytes)))):
+        first, second = ref_pairs[batch], mov_pairs[batch]
+        # |a - b| ** 2 = |a| ** 2 + |b| ** 2 - 2 a.b, which for binary descriptors counts the differing bits.
+        # np.dot, unlike np.matmul on stacks, goes through BLAS
+        distances = np.empty((first.size, stack.shape[1], stack.shape[1]), dtype=dtype)
+        for pair_ind, (ind1, ind2) in enumerate(zip(first, second)):
+            np.dot(stack[ind1], stack[ind2].T, out=distances[pair_ind])
+        distances *= -2
+        distances += sq_norms[first, :, None]
+        distances += sq_norms[second, None, :]
+        if not binary:
+            distances = np.sqrt(np.maximum(distances, 0))
+        scale = stack.shape[-1] if binary else 1
+        distances[~(valid[first, :, None] & valid[second, None, :])] = np.inf
+
+        pairs, rows = np.arange(first.size)[:, None], np.arange(stack.shape[1])[None, :]
+        nearest = np.argmin(distances, axis=2)
+        if cross_check:
+            reverse = np.argmin(distances, axis=1)
+            keep = reverse[pairs, nearest] == rows
+        else:
+            keep = np.ones(nearest.shape, dtype=np.bool_)
+        best = np.float64(distances[pairs, rows, nearest]) / scale
+        keep &= valid[first] & np.isfinite(best)
+        if max_distance < np.inf:
+            keep &= best < max_distance
+        if max_ratio < 1.0:
+            distances[pairs, rows, nearest] = np.inf
+            second_best = np.float64(np.min(distances, axis=2)) / scale
+            second_best[second_best == 0] = np.finfo(np.double).eps
+            with np.errstate(invalid='ignore'):
+                # padded descriptors have infinite distances
+                keep &= best / second_best < max_ratio
+
+        for pair_keep, pair_nearest in zip(keep, nearest):
+            indices1 = np.flatnonzero(pair_keep)
+            matches.append(np.column_stack((indices1, pair_nearest[indices1])))
+
+    return matches
+
+
+def _ransac_pair(src, dst, transform, kwargs):
+    """
+    Robustly estimates the transformation between matched keypoints of two images
+    """
+    return ransac((src, dst), transform, **kwargs)
+
+
 # function is taken as is from scikit-image.
 def _center_and_normalize_points(points):
     """
@@ -620,6 +974,76 @@ class RigidTransform(object):
         return self.params[0:2, 2]
 
 
+def get_chain_matrices(matrices, origin=0):
+    """
+    Composes the transformations between consecutive frames into the transformation between the origin frame and
+    every frame with a single prefix product
+
+    Parameters
+    ----------
+    matrices : array-like
+        (N - 1, 3, 3) homogeneous matrices, each mapping the coordinates of frame k onto those of frame k + 1
+    origin : int, optional
+        Frame that is left untransformed. The chain can be re-anchored to any frame. Default 0
+
+    Returns
+    -------
+    chain : numpy.ndarray
+        (N, 3, 3) homogeneous matrices mapping the coordinates of the origin frame onto those of each frame. These
+        are the inverse maps that warp each frame onto the origin frame
+    """
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3)
+    num_frames = matrices.shape[0] + 1
+    if not 0 <= origin < num_frames:
+        raise ValueError('origin must be between 0 and {}'.format(num_frames - 1))
+
+    cumulative = np.empty((num_frames, 3, 3))
+    cumulative[0] = np.eye(3)
+    for ind, matrix in enumerate(matrices):
+        cumulative[ind + 1] = np.dot(matrix, cumulative[ind])
+
+    return np.matmul(cumulative, np.linalg.inv(cumulative[origin]))
+
+
+def get_chain_transforms(transforms, origin=0, transformation='translation'):
+    """
+    Chains the transformations between consecutive frames into a transformation for every frame relative to the
+    origin frame
+
+    Parameters
+    ----------
+    transforms : list of skimage.GeometricTransform objects
+        Transformation between each pair of consecutive frames in (row, column) coordinates, i.e. mapping the
+        [y, x] keypoints of frame k onto those of frame k + 1 as estimated by findTransformation()
+    origin : int, optional
+        Frame that is left untransformed. Default 0
+    transformation : string, optional
+        'translation' only chains the translations of the transforms while 'rotation' chains the full transforms.
+        Default 'translation'
+
+    Returns
+    -------
+    chainTransforms : list of TranslationTransform or SimilarityTransform objects
+        Transformation of each frame in (x, y) = (column, row) coordinates, as expected by skimage.transform.warp
+    """
+    if transformation == 'translation':
+        matrices = np.tile(np.eye(3), (len(transforms), 1, 1))
+        if len(transforms) > 0:
+            matrices[:, :2, 2] = [trans.translation for trans in transforms]
+        transform_class = TranslationTransform
+    elif transformation == 'rotation':
+        matrices = np.array([trans.params for trans in transforms]).reshape(-1, 3, 3)
+        transform_class = SimilarityTransform
+    else:
+        raise ValueError('transformation must be translation or rotation. Provided: {}'.format(transformation))
+
+    # conjugate by the permutation of rows and columns to go from (row, column) to (x, y) coordinates
+    swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float64)
+    matrices = np.matmul(swap, np.matmul(matrices, swap))
+
+    return [transform_class(matrix=matrix) for matrix in get_chain_matrices(matrices, origin=origin)]
+
+
 # Class to do geometric transformations. This is a wrapper on scikit-image functionality.
 # TODO: io operations for features and optical geometric transformations.
 
@@ -649,16 +1073,18 @@ class geoTransformerParallel(object):
 
         Parameters
         ----------
-        dataset: h5py.dataset
-            The dataset to be corrected
+        dataset: h5py.dataset or numpy.ndarray
+            The dataset to be corrected, with one flattened square frame per row.
+            HDF5 datasets are read a chunk at a time rather than being loaded into memory.
 
         """
-        if not isinstance(dataset, h5py.Dataset):
-            warnings.warn('Error: Data must be an h5 Dataset object')
+        if isinstance(dataset, h5py.Dataset):
+            self.data = _FrameStack(dataset)
+        elif isinstance(dataset, np.ndarray):
+            dim = int(np.sqrt(dataset.shape[-1]))
+            self.data = dataset.reshape(-1, dim, dim)
         else:
-            self.data = dataset
-            dim = int(np.sqrt(self.data.shape[-1]))
-            self.data = self.data.reshape(-1, dim, dim)
+            warnings.warn('Error: Data must be an h5 Dataset object or a numpy array')
 
     def loadFeatures(self, features):
         """
@@ -680,7 +1106,7 @@ class geoTransformerParallel(object):
     def matchFeatures(self, **kwargs):
         """
         This is a Method that computes similarity between keypoints based on their
-        descriptors. Currently only skimage.feature.match_descriptors is implemented.
+        descriptors, by brute force as in skimage.feature.match_descriptors.
         In the future will need to add opencv2.matchers.
 
         Parameters
@@ -690,6 +1116,10 @@ class geoTransformerParallel(object):
         maximum_distance: int, optional
                 maximum_distance (int) of misalignment, default = infinity.
                 Used to filter the matches before optimizing the transformation.
+        max_ratio: float, optional
+                Maximum ratio of the distances to the nearest and second nearest descriptors, default = 1.
+        max_mem_mb : float, optional
+                Memory, in megabytes, for the descriptor distances of each process, default = 1024.
 
         Returns
         -------
@@ -700,30 +1130,20 @@ class geoTransformerParallel(object):
         keypts = self.features[0]
         processes = kwargs.get('processors', 1)
         maxDis = kwargs.get('maximum_distance', np.infty)
+        max_ratio = kwargs.get('max_ratio', 1.0)
+        max_mem_mb = kwargs.get('max_mem_mb', 1024)
 
-        def match(desc):
-            desc1, desc2 = desc[0], desc[1]
-            matches = match_descriptors(desc1, desc2, cross_check=True)
-            return matches
-
-        # start pool of workers
-        pool = mp.Pool(processes)
+        # each process matches a contiguous block of consecutive images
         print('launching %i kernels...' % processes)
-
-        tasks = [(desc1, desc2) for desc1, desc2 in zip(desc[:], desc[1:])]
-        chunk = int(len(desc) / processes)
-        jobs = pool.imap(match, tasks, chunksize=chunk)
-
-        # get matches
         print('Extracting Matches From the Descriptors...')
-
-        matches = []
-        for j in jobs:
-            matches.append(j)
-
-        # close the pool
-        print('Closing down the kernels...\n')
-        pool.close()
+        blocks = gen_batches(len(desc) - 1, max(1, int(np.ceil((len(desc) - 1) / processes))))
+        matches = joblib.Parallel(n_jobs=processes)(
+            joblib.delayed(match_descriptor_pairs)(desc[block.start: block.stop + 1],
+                                                   np.arange(block.stop - block.start),
+                                                   np.arange(1, block.stop - block.start + 1),
+                                                   max_ratio=max_ratio, max_mem_mb=max_mem_mb)
+            for block in blocks)
+        matches = [match for block in matches for match in block]
 
         # impose maximum_distance misalignment constraints on matches
         filt_matches = []
@@ -755,37 +1175,23 @@ class geoTransformerParallel(object):
 
         keypts = self.features[0]
 
-        def optimization(Pts):
-            robustTrans, inliers = ransac((Pts[0], Pts[1]), transform, **kwargs)
-            output = [robustTrans, inliers]
-            return output
-
-            # start pool of workers
-
+        # start pool of workers
         print('launching %i kernels...' % processes)
-        pool = mp.Pool(processes)
-        tasks = [(key1[match[:, 0]], key2[match[:, 1]])
+        print('Extracting Inlier Matches with RANSAC...')
+        tasks = [joblib.delayed(_ransac_pair)(key1[match[:, 0]], key2[match[:, 1]], transform, kwargs)
                  for match, key1, key2 in zip(matches, keypts[:], keypts[1:])]
-        chunk = int(len(keypts) / processes)
-        jobs = pool.imap(optimization, tasks, chunksize=chunk)
 
         # get Transforms and inlier matches
         transforms, trueMatches = [], []
-        print('Extracting Inlier Matches with RANSAC...')
         try:
-            for j in jobs:
-                transforms.append(j[0])
-                trueMatches.append(j[1])
+            for robustTrans, inliers in joblib.Parallel(n_jobs=processes)(tasks):
+                transforms.append(robustTrans)
+                trueMatches.append(inliers)
         except np.linalg.LinAlgError:
             pass
 
-        # close the pool
-        pool.close()
-        print('Closing down the kernels...\n')
-
         return transforms, trueMatches
 
-    # TODO: Need parallel version for transforming stack of images.
     def applyTransformation(self, transforms, **kwargs):
         """
         This is the method that takes the list of transformation found by findTransformation
@@ -795,23 +1201,30 @@ class geoTransformerParallel(object):
         ----------
         transforms: (list of skimage.GeoemetricTransform objects).
              The objects must be inititated with the desired parameters.
+             Each maps the (row, column) coordinates of an image onto those of the next image, as returned by
+             findTransformation for [y, x] keypoints. A shift from correlationTransformation corresponds to
+             TranslationTransform(translation=tuple(-shift)).
         transformation : string, optional.
-             The type of geometric transformation to use (i.e. translation, rigid, etc..)
-             Currently, only translation is implemented.
+             The type of geometric transformation to use, translation or rotation.
+             translation only chains the translations of the transforms while rotation chains the full transforms.
              default, translation.
         origin : int, optional
              The position in the data to take as origin, i.e. don't transform.
              default, center image in the stack.
         processors : int, optional
             Number of processors to use, default = 1.
-            Currently,only one processor is used.
+        output : h5py.Dataset or numpy.ndarray, optional
+            Where the transformed images are written, one chunk at a time. It must hold as many images as the
+            data set, either flattened or 2D. Default, a new numpy array.
+        max_mem_mb : float, optional
+            Memory, in megabytes, for the transformed images held at any one time. default, 1024.
 
         Returns
         -------
-        Transformed images, transformations
+        Transformed images, transformations of each image in (x, y) = (column, row) coordinates
 
         """
-        dic = ['processors', 'origin', 'transformation']
+        dic = ['processors', 'origin', 'transformation', 'output', 'max_mem_mb']
         for key in kwargs.keys():
             if key not in dic:
                 print('%s is not a parameter of this function' % (str(key)))
@@ -819,93 +1232,27 @@ class geoTransformerParallel(object):
         processes = kwargs.get('processors', 1)
         origin = kwargs.get('origin', int(self.data.shape[0] / 2))
         transformation = kwargs.get('transformation', 'translation')
+        output = kwargs.get('output', None)
+        max_mem_mb = kwargs.get('max_mem_mb', 1024)
 
         dset = self.data
-        # For now restricting this to just translation... Straightforward to generalize to other transform objects.
-        if transformation == 'translation':
-
-            YTrans = np.array([trans.translation[0] for trans in transforms])
-            XTrans = np.array([trans.translation[1] for trans in transforms])
-            chainL = []
-            for y, x in zip(range(0, YTrans.size + 1), range(0, XTrans.size + 1)):
-                if y < origin:
-                    ychain = -np.sum(YTrans[y:origin])
-                    xchain = -np.sum(XTrans[x:origin])
-
-                elif y > origin:
-                    ychain = np.sum(YTrans[origin:y])
-                    xchain = np.sum(XTrans[origin:x])
-                else:
-                    ychain = 0
-                    xchain = 0
-
-                chainL.append([xchain, ychain])
-
-            chainTransforms = []
-            for params in chainL:
-                T = TranslationTransform(translation=params)
-                chainTransforms.append(T)
-
-        # Just need a single function that does boths
-        if transformation == 'rotation':
-
-            rotTrans = np.array([trans.rotation for trans in transforms])
-            YTrans = np.array([trans.translation[0] for trans in transforms])
-            XTrans = np.array([trans.translation[1] for trans in transforms])
-            chainL = []
-            for x in range(0, rotTrans.size + 1):
-                if x < origin:
-                    rotchain = -np.sum(rotTrans[x:origin])
-                    ychain = -np.sum(YTrans[x:origin])
-                    xchain = -np.sum(XTrans[x:origin])
-
-                elif x > origin:
-                    rotchain = np.sum(rotTrans[origin:x])
-                    ychain = np.sum(YTrans[origin:x])
-                    xchain = np.sum(XTrans[origin:x])
-                else:
-                    rotchain = 0
-                    ychain = 0
-                    xchain = 0
-
-                chainL.append([rotchain, xchain, ychain])
-
-            chainTransforms = []
-            for params in chainL:
-                T = SimilarityTransform(scale=1.0, rotation=np.deg2rad(params[0]), translation=(params[1], params[2]))
-                chainTransforms.append(T)
+        chainTransforms = get_chain_transforms(transforms, origin=origin, transformation=transformation)
 
         # Use the chain transformations to transform the dataset
-        output_shape = dset[0].shape
+        output_shape = dset.shape[1:]
+        matrices = np.array([np.asarray(trans.params, dtype=np.float64) for trans in chainTransforms])
+        if output is None:
+            output = np.zeros(dset.shape, dtype=dset.dtype)
 
-        #        output_shape = (2048, 2048)
-        def warping(datum):
-            imp, transform = datum[0], datum[1]
-            transimp = warp(imp, inverse_map=transform, output_shape=output_shape,
-                            cval=0, preserve_range=True)
-            return transimp
-
-        #          #start pool of workers
-        #         #somehow wrap function crashes when run in parallel! run sequentially for now.
-        #        pool = mp.Pool(processes)
-        #        print('launching %i kernels...'%(processes))
-        #        tasks = [ (imp, transform) for imp, transform in zip(dset, chainTransforms) ]
-        #        chunk = int(dset.shape[0]/processes)
-        #        jobs = pool.imap(warping, tasks, chunksize = 1)
-        #        #close the pool
-        #        pool.close()
-        #        print('Closing down the kernels... \n')
-        #
-        # get transformed images and pack into 3d np.ndarray
+        # warp the images in parallel and write them out a chunk at a time
         print('Transforming Images...')
-        transImages = np.copy(dset[:])
+        for batch, transImages in _map_frame_batches(_warp_frames, dset, [np.arange(dset.shape[0]), matrices],
+                                                      processes=processes, max_mem_mb=max_mem_mb,
+                                                      output_shape=output_shape):
+            output[batch] = transImages.reshape((-1,) + output.shape[1:])
+            print('Images #%i - #%i' % (batch.start, batch.stop - 1))
 
-        for imp, transform, itm in zip(transImages, chainTransforms, range(0, transImages.shape[0])):
-            transimp = warping([imp, transform])
-            transImages[itm] = transimp
-            print('Image #%i' % itm)
-
-        return transImages, chainTransforms
+        return output, chainTransforms
 
     def correlationTransformation(self, **kwargs):
         """
@@ -913,43 +1260,36 @@ class geoTransformerParallel(object):
 
         Parameters
         ----------
-        processes: int, optional
+        processors: int, optional
             Number of processors to use, default = 1.
+        upsample_factor: int, optional
+            Images will be registered to within 1 / upsample_factor of a pixel, default = 1.
+        reference: int, optional
+            Register every image against this image instead of against the previous image, default = None.
+        max_mem_mb : float, optional
+            Memory, in megabytes, available for staging and correlating images, default = 1024.
 
         Returns
         -------
-        Transformations.
+        Shifts, as (row, column), that register each image with its reference.
 
         """
 
         processes = kwargs.get('processors', 1)
+        upsample_factor = kwargs.get('upsample_factor', 1)
+        reference = kwargs.get('reference', None)
+        max_mem_mb = kwargs.get('max_mem_mb', 1024)
 
-        pool = mp.Pool(processes)
         print('launching %i kernels...' % processes)
 
-        def register(images):
-            imp1, imp2 = images[0], images[1]
-            shifts, _, _ = register_translation(imp1, imp2)
-            return shifts
-
-        dim = int(np.sqrt(self.data.shape[-1]))
-        tasks = [(imp1, imp2)
-                 for imp1, imp2 in zip(self.data[:], self.data[1:])]
-
-        chunk = int((self.data.shape[0] - 1) / processes)
-        jobs = pool.imap(register, tasks, chunksize=chunk)
-
-        # get Transforms and inlier matches
-        results = []
+        # workers receive the indices of the frames to correlate and read the frames themselves
         print('Extracting Translations')
-        try:
-            for j in jobs:
-                results.append(j)
-        except:
-            warnings.warn('Skipped Some Entry... dunno why!!')
-
-        # close the pool
-        pool.close()
+        results = []
+        for _, shifts in _map_frame_batches(register_frame_pairs, self.data,
+                                            _get_registration_pairs(self.data.shape[0], reference=reference),
+                                            processes=processes, max_mem_mb=max_mem_mb, frames_per_task=8,
+                                            upsample_factor=upsample_factor):
+            results += list(shifts)
 
         return results
 
@@ -981,14 +1321,14 @@ class geoTransformerSerial(object):
         Parameters
         ----------
         dataset : h5py.dataset
+            The dataset to be corrected, with one flattened square frame per row.
+            It is read a chunk at a time rather than being loaded into memory.
 
         """
         if not isinstance(dataset, h5py.Dataset):
             warnings.warn('Error: Data must be an h5 Dataset object')
         else:
-            self.data = dataset
-            dim = int(np.sqrt(self.data.shape[-1]))
-            self.data = self.data.reshape(-1, dim, dim)
+            self.data = _FrameStack(dataset)
 
     def loadFeatures(self, features):
         """
@@ -1010,7 +1350,7 @@ class geoTransformerSerial(object):
     def matchFeatures(self, **kwargs):
         """
         This is a Method that computes similarity between keypoints based on their
-        descriptors. Currently only skimage.feature.match_descriptors is implemented.
+        descriptors, by brute force as in skimage.feature.match_descriptors.
         In the future will need to add opencv2.matchers.
 
         Parameters
@@ -1018,6 +1358,10 @@ class geoTransformerSerial(object):
         maximum_distance: int, optional
             maximum_distance (int) of misalignment, default = infinity.
             Used to filter the matches before optimizing the transformation.
+        max_ratio: float, optional
+            Maximum ratio of the distances to the nearest and second nearest descriptors, default = 1.
+        max_mem_mb : float, optional
+            Memory, in megabytes, for the descriptor distances, default = 1024.
 
         Returns
         -------
@@ -1027,31 +1371,12 @@ class geoTransformerSerial(object):
         desc = self.features[-1]
         keypts = self.features[0]
         maxDis = kwargs.get('maximum_distance', np.infty)
-        processes = kwargs.get('processes', 2)
-
-        def match(desc):
-            desc1, desc2 = desc[0], desc[1]
-            matches = match_descriptors(desc1, desc2, cross_check=True)
-            return matches
-
-        # start pool of workers
-        pool = mp.Pool(processes)
-        print('launching %i kernels...' % processes)
+        max_ratio = kwargs.get('max_ratio', 1.0)
+        max_mem_mb = kwargs.get('max_mem_mb', 1024)
 
-        tasks = [(desc1, desc2) for desc1, desc2 in zip(desc[:], desc[1:])]
-        chunk = int(len(desc) / processes)
-        jobs = pool.imap(match, tasks, chunksize=chunk)
-
-        # get matches
         print('Extracting Matches From the Descriptors...')
-
-        matches = []
-        for j in jobs:
-            matches.append(j)
-
-        # close the pool
-        print('Closing down the kernels...\n')
-        pool.close()
+        matches = match_descriptor_pairs(desc, np.arange(len(desc) - 1), np.arange(1, len(desc)),
+                                         max_ratio=max_ratio, max_mem_mb=max_mem_mb)
 
         # impose maximum_distance misalignment constraints on matches
         filt_matches = []
@@ -1110,9 +1435,13 @@ class geoTransformerSerial(object):
         Parameters
          transforms: (list of skimage.GeoemetricTransform objects).
                  The objects must be inititated with the desired parameters.
+                 Each maps the (row, column) coordinates of an image onto those of the next image, as returned
+                 by findTransformation for [y, x] keypoints. A shift from correlationTransformation corresponds
+                 to TranslationTransform(translation=tuple(-shift)).
          transformation: string, optional.
-                 The type of geometric transformation to use (i.e. translation, rigid, etc..)
-                 Currently, only translation is implemented.
+                 The type of geometric transformation to use, translation or rotation.
+                 translation only chains the translations of the transforms while rotation chains the full
+                 transforms.
                  default, translation.
          origin: int, optional
                  The position in the data to take as origin, i.e. don't transform.
@@ -1120,7 +1449,7 @@ class geoTransformerSerial(object):
 
         Returns
         -------
-        Transformed images, transformations
+        Transformed images, transformations of each image in (x, y) = (column, row) coordinates
 
         """
         dic = ['processors', 'origin', 'transformation']
@@ -1133,78 +1462,16 @@ class geoTransformerSerial(object):
         transformation = kwargs.get('transformation', 'translation')
 
         dset = self.data
-        # For now restricting this to just translation... Straightforward to generalize to other transform objects.
-        if transformation == 'translation':
-
-            YTrans = np.array([trans.translation[0] for trans in transforms])
-            XTrans = np.array([trans.translation[1] for trans in transforms])
-            chainL = []
-            for y, x in zip(range(0, YTrans.size + 1), range(0, XTrans.size + 1)):
-                if y < origin:
-                    ychain = -np.sum(YTrans[y:origin])
-                    xchain = -np.sum(XTrans[x:origin])
-
-                elif y > origin:
-                    ychain = np.sum(YTrans[origin:y])
-                    xchain = np.sum(XTrans[origin:x])
-                else:
-                    ychain = 0
-                    xchain = 0
-
-                chainL.append([xchain, ychain])
-
-            chainTransforms = []
-            for params in chainL:
-                T = TranslationTransform(translation=params)
-                chainTransforms.append(T)
-
-        # Just need a single function that does boths
-        if transformation == 'rotation':
-
-            rotTrans = np.array([trans.rotation for trans in transforms])
-            YTrans = np.array([trans.translation[0] for trans in transforms])
-            XTrans = np.array([trans.translation[1] for trans in transforms])
-            chainL = []
-            for x in range(0, rotTrans.size + 1):
-                if x < origin:
-                    rotchain = -np.sum(rotTrans[x:origin])
-                    ychain = -np.sum(YTrans[x:origin])
-                    xchain = -np.sum(XTrans[x:origin])
-
-                elif x > origin:
-                    rotchain = np.sum(rotTrans[origin:x])
-                    ychain = np.sum(YTrans[origin:x])
-                    xchain = np.sum(XTrans[origin:x])
-                else:
-                    rotchain = 0
-                    ychain = 0
-                    xchain = 0
-
-                chainL.append([rotchain, xchain, ychain])
-
-            chainTransforms = []
-            for params in chainL:
-                T = SimilarityTransform(scale=1.0, rotation=np.deg2rad(params[0]), translation=(params[1], params[2]))
-                #                T = SimilarityTransform(rotation = params, translation = (0,0))
-                chainTransforms.append(T)
+        chainTransforms = get_chain_transforms(transforms, origin=origin, transformation=transformation)
 
         # Use the chain transformations to transform the dataset
         output_shape = dset[0].shape
-
-        def warping(datum):
-            imp, transform = datum[0], datum[1]
-            transimp = warp(imp, inverse_map=transform, output_shape=output_shape,
-                            cval=0, preserve_range=True)
-            return transimp
+        matrices = np.array([trans.params for trans in chainTransforms])
 
         # get transformed images and pack into 3d np.ndarray
         print('Transforming Images...')
         transImages = np.copy(dset[:])
-
-        for imp, transform, itm in zip(transImages, chainTransforms, range(0, transImages.shape[0])):
-            transimp = warping([imp, transform])
-            transImages[itm] = transimp
-            print('Image #%i' % itm)
+        transImages[:] = _warp_frames(transImages, np.arange(transImages.shape[0]), matrices, output_shape)
 
         return transImages, chainTransforms
 
@@ -1214,26 +1481,29 @@ class geoTransformerSerial(object):
 
         Parameters
         ----------
-        processes: int, optional
-            Number of processors to use, default = 1.
+        upsample_factor: int, optional
+            Images will be registered to within 1 / upsample_factor of a pixel, default = 1.
+        reference: int, optional
+            Register every image against this image instead of against the previous image, default = None.
+        max_mem_mb : float, optional
+            Memory, in megabytes, available for correlating images, default = 1024.
 
         Returns
         -------
-        Transformations.
+        Shifts, as (row, column), that register each image with its reference.
 
         """
 
-        processes = kwargs.get('processors', 1)
-
-        pool = mp.Pool(processes)
-        print('launching %i kernels...' % processes)
-
-        def register(images):
-            imp1, imp2 = images[0], images[1]
-            shifts, _, _ = register_translation(imp1, imp2)
-            return shifts
+        upsample_factor = kwargs.get('upsample_factor', 1)
+        reference = kwargs.get('reference', None)
+        max_mem_mb = kwargs.get('max_mem_mb', 1024)
 
-        results = [register((imp1, imp2))
-                   for imp1, imp2 in zip(self.data[:], self.data[1:])]
+        # correlate the images a chunk at a time
+        results = []
+        for _, shifts in _map_frame_batches(register_frame_pairs, self.data,
+                                            _get_registration_pairs(self.data.shape[0], reference=reference),
+                                            max_mem_mb=max_mem_mb, frames_per_task=8,
+                                            upsample_factor=upsample_factor):
+            results += list(shifts)
 
         return results
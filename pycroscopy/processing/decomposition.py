@@ -10,6 +10,7 @@ import h5py
 import time
 import numpy as np
 import sklearn.decomposition as dec
+from sklearn.utils import gen_batches
 
 from pyUSID.processing.process import Process
 from pyUSID.io.hdf_utils import reshape_to_n_dims, create_results_group, write_main_dataset, get_attr, \
@@ -25,10 +26,14 @@ class Decomposition(Process):
     Pycroscopy wrapper around the sklearn.decomposition classes
     """
 
-    def __init__(self, h5_main, estimator):
+    def __init__(self, h5_main, estimator, **kwargs):
         """
         Uses the provided (preconfigured) Decomposition object to 
         decompose the provided dataset
+
+        Estimators that support partial_fit (e.g. - IncrementalPCA, MiniBatchDictionaryLearning) are fit by streaming
+        chunks of positions from the HDF5 file and the projection is computed in a second streamed pass. All other
+        estimators read the dataset once and compute the components and projection with a single fit_transform().
         
         Parameters
         ------------
@@ -36,11 +41,14 @@ class Decomposition(Process):
             Main dataset with ancillary spectroscopic, position indices and values datasets
         estimator : sklearn.cluster estimator object
             configured decomposition object to apply to the data
+        kwargs : (Optional). dictionary
+            Please see Process class for additional inputs
         """
         
         allowed_methods = [dec.factor_analysis.FactorAnalysis,
                            dec.fastica_.FastICA,
                            dec.incremental_pca.IncrementalPCA,
+                           dec.MiniBatchDictionaryLearning,
                            dec.sparse_pca.MiniBatchSparsePCA,
                            dec.nmf.NMF,
                            dec.pca.PCA,
@@ -57,7 +65,7 @@ class Decomposition(Process):
             raise NotImplementedError('Cannot work with {} yet'.format(self.method_name))
             
         # Done with decomposition-related checks, now call super init
-        super(Decomposition, self).__init__(h5_main)
+        super(Decomposition, self).__init__(h5_main, **kwargs)
         
         # set up parameters
         self.parms_dict = {'decomposition_algorithm':self.method_name}
@@ -75,6 +83,9 @@ class Decomposition(Process):
         # supercharge h5_main!
         self.h5_main = USIDataset(self.h5_main)
         
+        # Estimators that can learn incrementally are fed the data one chunk of positions at a time
+        self.__streaming = hasattr(self.estimator, 'partial_fit')
+
         self.__components = None
         self.__projection = None
         
@@ -96,21 +107,18 @@ class Decomposition(Process):
         projections : numpy array
             Projections
         """
-        if not override:
-            if isinstance(self.duplicate_h5_groups, list) and len(self.duplicate_h5_groups) > 0:
-                self.h5_results_grp = self.duplicate_h5_groups[-1]
-                print('Returning previously computed results from: {}'.format(self.h5_results_grp.name))
-                print('set the "override" flag to True to recompute results')
-                return USIDataset(self.h5_results_grp['Components']).get_n_dim_form(), \
-                       USIDataset(self.h5_results_grp['Projection']).get_n_dim_form()
-
-        self.h5_results_grp = None
+        if self._get_existing_results(override) is not None:
+            return USIDataset(self.h5_results_grp['Components']).get_n_dim_form(), \
+                   USIDataset(self.h5_results_grp['Projection']).get_n_dim_form()
 
         print('Performing Decomposition on {}.'.format(self.h5_main.name))
 
         t0 = time.time()
-        self._fit()
-        self._transform()
+        if self.__streaming:
+            self._fit()
+            self._transform()
+        else:
+            self._fit_transform()
         print('Took {} to compute {}'.format(format_time(time.time() - t0), self.method_name))
 
         self.__components = stack_real_to_target_dtype(self.estimator.components_, self.h5_main.dtype)
@@ -129,6 +137,28 @@ class Decomposition(Process):
 
         return components_mat, projection_mat
 
+    def _get_existing_results(self, override):
+        """
+        Picks up the latest results group computed with the same parameters, unless asked to recompute
+
+        Parameters
+        ----------
+        override : bool
+            Set to true to ignore prior results
+
+        Returns
+        -------
+        h5_group : HDF5 Group reference or None
+            Group with the prior results. None if the results need to be computed
+        """
+        self.h5_results_grp = None
+        if override or not isinstance(self.duplicate_h5_groups, list) or len(self.duplicate_h5_groups) == 0:
+            return None
+        self.h5_results_grp = self.duplicate_h5_groups[-1]
+        print('Returning previously computed results from: {}'.format(self.h5_results_grp.name))
+        print('set the "override" flag to True to recompute results')
+        return self.h5_results_grp
+
     def delete_results(self):
         """
         Deletes results from memory.
@@ -154,6 +184,17 @@ class Decomposition(Process):
             Reference to the group that contains the decomposition results
         """
         if self.__components is None and self.__projection is None:
+            if self.__streaming:
+                if self._get_existing_results(override) is not None:
+                    return self.h5_results_grp
+                # The projection will be written to the file chunk by chunk instead of being held in memory
+                t0 = time.time()
+                self._fit()
+                self.__components = stack_real_to_target_dtype(self.estimator.components_, self.h5_main.dtype)
+                h5_group = self._write_results_chunk()
+                print('Took {} to compute {}'.format(format_time(time.time() - t0), self.method_name))
+                self.delete_results()
+                return h5_group
             self.test(override=override)
 
         if self.h5_results_grp is None:
@@ -164,17 +205,62 @@ class Decomposition(Process):
 
         return h5_group
 
+    def _read_data(self, pos_slice=None):
+        """
+        Reads the requested positions and converts them to real scalars
+
+        Parameters
+        ----------
+        pos_slice : slice, optional. Default = all positions
+            Positions to read
+
+        Returns
+        -------
+        data : 2D numpy array
+            Real valued data arranged as [position, features]
+        """
+        if pos_slice is None:
+            pos_slice = slice(None)
+        data = self.h5_main[pos_slice]
+        if self.method_name == 'NMF':
+            data = np.abs(data)
+        return self.data_transform_func(data)
+
+    def _get_batches(self):
+        """
+        Returns the slices of positions that can be read into memory at a time.
+
+        Returns
+        -------
+        batches : list of slice objects
+            Contiguous slices of positions
+        """
+        # IncrementalPCA requires that each batch has at least as many samples as components
+        min_batch_size = getattr(self.estimator, 'n_components', None) or 0
+        batch_size = max(self._max_pos_per_read, min_batch_size, 1)
+        return list(gen_batches(self.h5_main.shape[0], batch_size, min_batch_size=min_batch_size))
+
     def _fit(self):
         """
         Fits the provided dataset
         """
         # perform fit on the real dataset
-        if self.method_name == 'NMF':
-            self.estimator.fit(self.data_transform_func(np.abs(self.h5_main)))
+        if self.__streaming:
+            batches = self._get_batches()
+            for ind, pos_slice in enumerate(batches):
+                if self.verbose:
+                    print('Fitting chunk {} of {}'.format(ind + 1, len(batches)))
+                self.estimator.partial_fit(self._read_data(pos_slice))
         else:
-            self.estimator.fit(self.data_transform_func(self.h5_main))
+            self.estimator.fit(self._read_data())
 
-    def _transform(self, data=None):
+    def _fit_transform(self):
+        """
+        Fits the dataset and computes the projection after reading the dataset only once
+        """
+        self.__projection = self.estimator.fit_transform(self._read_data())
+
+    def _transform(self, data=None, h5_projection=None):
         """
         Transforms the original OR provided dataset with previously computed fit
         
@@ -184,12 +270,20 @@ class Decomposition(Process):
             Dataset to apply the transform to. 
             The number of elements in the first axis of this dataset should match that of the original
             dataset that was fitted
+        h5_projection : (optional) HDF5 dataset
+            Dataset to write the projection of the original dataset into, chunk by chunk.
+            Only used for estimators that support partial_fit
         """
         if data is None:
-            if self.method_name == 'NMF':
-                self.__projection = self.estimator.transform(self.data_transform_func(np.abs(self.h5_main)))
+            if self.__streaming:
+                if h5_projection is None:
+                    self.__projection = np.zeros((self.h5_main.shape[0], self.estimator.components_.shape[0]),
+                                                 dtype=np.float32)
+                    h5_projection = self.__projection
+                for pos_slice in self._get_batches():
+                    h5_projection[pos_slice] = self.estimator.transform(self._read_data(pos_slice))
             else:
-                self.__projection = self.estimator.transform(self.data_transform_func(self.h5_main))
+                self.__projection = self.estimator.transform(self._read_data())
         else:
             if isinstance(data, h5py.Dataset):
                 if data.shape[0] == self.h5_main.shape[0]:
@@ -220,9 +314,16 @@ class Decomposition(Process):
                                            h5_spec_vals=self.h5_main.h5_spec_vals)
 
         # equivalent of U - real
-        h5_projections = write_main_dataset(h5_decomp_group, np.float32(self.__projection), 'Projection', 'abundance',
+        if self.__projection is None:
+            # Streamed straight into the file
+            proj_data = (self.h5_main.shape[0], self.__components.shape[0])
+        else:
+            proj_data = np.float32(self.__projection)
+        h5_projections = write_main_dataset(h5_decomp_group, proj_data, 'Projection', 'abundance',
                                             'a.u.', None, decomp_desc, dtype=np.float32,
                                             h5_pos_inds=self.h5_main.h5_pos_inds, h5_pos_vals=self.h5_main.h5_pos_vals)
+        if self.__projection is None:
+            self._transform(h5_projection=h5_projections)
 
         # return the h5 group object
         self.h5_results_grp = h5_decomp_group
@@ -10,7 +10,9 @@ from __future__ import division, print_function, absolute_import
 import numpy as np  # for all array, data operations
 import matplotlib.pyplot as plt  # for all plots
 from scipy.special import erf
-from collections import Iterable
+import os
+import hashlib
+from collections import Iterable, OrderedDict
 from warnings import warn
 
 
@@ -180,6 +182,114 @@ def down_sample(fft_vec, freq_ratio):
 ###############################################################################
 
 
+class FilterCache(object):
+    """
+    Two-tier cache of frequency filter arrays keyed by the filter parameters. Recently used filters are held in memory
+    in least-recently-used order. If a cache directory is provided, filters are also persisted as .npy files so that
+    they can be reused across sessions / scripts.
+    """
+
+    def __init__(self, max_size=32, cache_dir=None):
+        """
+        Parameters
+        ----------
+        max_size : unsigned int, optional. Default = 32
+            Maximum number of filter arrays to hold in memory. Set to 0 to disable the in-memory tier
+        cache_dir : str, optional. Default = None - no on-disk tier
+            Directory in which filter arrays will be stored as .npy files
+        """
+        if max_size % 1 != 0 or max_size < 0:
+            raise ValueError('max_size must be an unsigned integer')
+        self.max_size = int(max_size)
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _get_file_path(self, key):
+        file_name = hashlib.md5(repr(key).encode('utf-8')).hexdigest() + '.npy'
+        return os.path.join(self.cache_dir, file_name)
+
+    def _remember(self, key, value):
+        if self.max_size == 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def fetch(self, key, builder):
+        """
+        Returns a copy of the filter array for the provided key, building it only if it is not available in any tier
+
+        Parameters
+        ----------
+        key : tuple
+            Hashable key that uniquely describes the filter
+        builder : callable
+            Function that takes no arguments and returns the filter array
+
+        Returns
+        -------
+        value : 1D numpy array
+            Copy of the cached filter array
+        """
+        value = self._entries.pop(key, None)
+
+        if value is None and self.cache_dir is not None:
+            file_path = self._get_file_path(key)
+            if os.path.exists(file_path):
+                value = np.load(file_path)
+
+        if value is None:
+            value = np.asarray(builder())
+            if self.cache_dir is not None:
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                np.save(self._get_file_path(key), value)
+
+        value.flags.writeable = False
+        self._remember(key, value)
+
+        return value.copy()
+
+    def clear(self, remove_files=False):
+        """
+        Empties the in-memory tier and optionally deletes the .npy files in the on-disk tier
+
+        Parameters
+        ----------
+        remove_files : bool, optional. Default = False
+            Whether or not to delete the .npy files in the cache directory as well
+        """
+        self._entries.clear()
+        if remove_files and self.cache_dir is not None and os.path.exists(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith('.npy'):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+
+filter_cache = FilterCache()
+"""
+Cache shared by all FrequencyFilter objects and build_composite_freq_filter.
+Set filter_cache.cache_dir to enable the on-disk tier.
+"""
+
+
+def _to_hashable(val):
+    if isinstance(val, np.ndarray):
+        return tuple(val.ravel().tolist())
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, (list, tuple)):
+        return tuple(_to_hashable(item) for item in val)
+    return val
+
+
 class FrequencyFilter(object):
     def __init__(self, signal_length, samp_rate, *args, **kwargs):
         for val, name in zip([signal_length, samp_rate], ['Signal length', 'Sampling rate']):
@@ -192,6 +302,25 @@ class FrequencyFilter(object):
     def get_parms(self):
         return {'samp_rate': self.samp_rate, 'signal_length': self.signal_length}
 
+    def get_cache_key(self):
+        """
+        Returns a hashable key that uniquely identifies this filter based on its parameters and the signal length
+
+        Returns
+        -------
+        key : tuple
+            (class name, signal length, sorted tuple of (parameter name, value) pairs)
+        """
+        parms = self.get_parms()
+        return (self.__class__.__name__, self.signal_length,
+                tuple(sorted((name, _to_hashable(val)) for name, val in parms.items())))
+
+    def _build_value(self):
+        raise NotImplementedError('Subclasses of FrequencyFilter must implement _build_value()')
+
+    def _fetch_value(self):
+        return filter_cache.fetch(self.get_cache_key(), self._build_value)
+
     def is_compatible(self, other):
         assert isinstance(other, FrequencyFilter), "Other object must be a FrequencyFilter object"
         return self.signal_length == other.signal_length and self.samp_rate == other.samp_rate
@@ -219,12 +348,18 @@ def build_composite_freq_filter(frequency_filters):
     if not isinstance(frequency_filters, Iterable):
         frequency_filters = [frequency_filters]
 
-    comp_filter = np.float32(frequency_filters[0].value)
+    def __build_composite():
+        comp_filter = np.float32(frequency_filters[0].value)
 
-    for ind in range(1, len(frequency_filters)):
-        comp_filter *= frequency_filters[ind].value
+        for ind in range(1, len(frequency_filters)):
+            comp_filter *= frequency_filters[ind].value
+
+        return comp_filter
+
+    # The product is independent of the order of the filters:
+    key = ('composite',) + tuple(sorted([filt.get_cache_key() for filt in frequency_filters], key=repr))
 
-    return comp_filter
+    return filter_cache.fetch(key, __build_composite)
 
 
 class NoiseBandFilter(FrequencyFilter):
@@ -257,8 +392,6 @@ class NoiseBandFilter(FrequencyFilter):
         """
         super(NoiseBandFilter, self).__init__(signal_length, samp_rate)
 
-        w_vec = 1
-
         # Making code a little more robust with handling different inputs:
         samp_rate = float(samp_rate)
         freqs = np.array(freqs)
@@ -271,35 +404,39 @@ class NoiseBandFilter(FrequencyFilter):
         self.freqs = freqs
         self.freq_widths = freq_widths
 
-        cent = int(round(0.5 * signal_length))
-
-        noise_filter = np.ones(signal_length, dtype=np.int16)
+        self.value = self._fetch_value()
 
         if show_plots:
             w_vec = np.arange(-0.5 * samp_rate, 0.5 * samp_rate, samp_rate / signal_length)
             fig, ax = plt.subplots(2, 1)
-            ax[0].plot(w_vec, noise_filter)
+            ax[0].plot(w_vec, np.ones(self.signal_length, dtype=np.int16))
             ax[0].set_yscale('log')
             ax[0].axis('tight')
             ax[0].set_xlabel('Freq')
             ax[0].set_title('Before clean up')
+            ax[1].plot(w_vec, self.value)
+            ax[1].set_yscale('log')
+            ax[1].axis('tight')
+            ax[1].set_xlabel('Freq')
+            ax[1].set_title('After clean up')
+            plt.show()
+
+    def _build_value(self):
+        signal_length = self.signal_length
+        samp_rate = float(self.samp_rate)
+
+        cent = int(round(0.5 * signal_length))
+
+        noise_filter = np.ones(signal_length, dtype=np.int16)
 
         # Setting noise freq bands to 0
-        for cur_freq, d_freq in zip(freqs, freq_widths):
+        for cur_freq, d_freq in zip(np.atleast_1d(self.freqs), np.atleast_1d(self.freq_widths)):
             ind = int(round(signal_length * (cur_freq / samp_rate)))
             sz = int(round(cent * d_freq / samp_rate))
             noise_filter[cent - ind - sz:cent - ind + sz + 1] = 0
             noise_filter[cent + ind - sz:cent + ind + sz + 1] = 0
 
-        if show_plots:
-            ax[1].plot(w_vec, noise_filter)
-            ax[1].set_yscale('log')
-            ax[1].axis('tight')
-            ax[1].set_xlabel('Freq')
-            ax[1].set_title('After clean up')
-            plt.show()
-
-        self.value = noise_filter
+        return noise_filter
 
     def get_parms(self):
         basic_parms = super(NoiseBandFilter, self).get_parms()
@@ -340,10 +477,17 @@ class LowPassFilter(FrequencyFilter):
 
         super(LowPassFilter, self).__init__(signal_length, samp_rate)
 
+        self.value = self._fetch_value()
+
+    def _build_value(self):
+        signal_length = self.signal_length
+        samp_rate = self.samp_rate
+        f_cutoff = self.f_cutoff
+
         cent = int(round(0.5 * signal_length))
 
         # BW = 0.1; %MHz - Nothing beyond BW.
-        roll_off *= f_cutoff  # MHz
+        roll_off = self.roll_off * f_cutoff  # MHz
 
         sz = int(np.round(signal_length * (roll_off / samp_rate)))
         ind = int(np.round(signal_length * (f_cutoff / samp_rate)))
@@ -358,7 +502,7 @@ class LowPassFilter(FrequencyFilter):
         lpf[cent - ind + sz:cent + ind - sz + 1] = 1
         lpf[cent + ind - sz + 1:cent + ind + 1] = 1 - smoothing
 
-        self.value = lpf
+        return lpf
 
     def get_parms(self):
         basic_parms = super(LowPassFilter, self).get_parms()
@@ -399,64 +543,50 @@ class HarmonicPassFilter(FrequencyFilter):
 
         super(HarmonicPassFilter, self).__init__(signal_length, samp_rate)
 
-        signal_length = abs(int(signal_length))
-
-        harm_filter = np.ones(signal_length, dtype=np.int16)
-
-        cent = int(round(0.5 * signal_length))
-
         self.first_freq = first_freq
         self.band_width = band_width
         self.num_harm = num_harm
 
-        w_vec = 1
+        # First harmonic
+        ind = int(round(self.signal_length * (first_freq / samp_rate)))
+        if ind >= self.signal_length:
+            raise ValueError('Invalid harmonic frequency')
+
+        self.value = self._fetch_value()
 
         if do_plots:
             print(
                 'OnlyKeepHarmonics: samp_rate = %2.1e Hz, first harmonic = %3.2f Hz, %d harmonics w/- %3.2f Hz bands\n' % (
                     samp_rate, first_freq, num_harm, band_width))
-            w_vec = np.arange(-samp_rate / 2.0, samp_rate / 2.0, samp_rate / signal_length)
+            w_vec = np.arange(-samp_rate / 2.0, samp_rate / 2.0, samp_rate / self.signal_length)
             fig, ax = plt.subplots(figsize=(5, 5))
-            ax.plot(w_vec, harm_filter)
-            ax.set_title('Raw')
+            ax.plot(w_vec, self.value)
+            ax.set_title('Harmonic pass filter')
 
-        sz = int(round(cent * band_width / samp_rate))
+    def _build_value(self):
+        """
+        Builds all the pass bands at once. Each harmonic (on either side of the center) contributes a +1 at the start
+        of its band and a -1 just past the end of its band to a difference array whose cumulative sum is positive
+        only within the (possibly overlapping) bands.
+        """
+        signal_length = self.signal_length
+        samp_rate = self.samp_rate
 
-        # First harmonic
-        ind = int(round(signal_length * (first_freq / samp_rate)))
-        if ind >= signal_length:
-            warn()
-            raise ValueError('Invalid harmonic frequency')
+        cent = int(round(0.5 * signal_length))
+        sz = int(round(cent * self.band_width / samp_rate))
 
-        harm_filter[max(cent - ind + sz + 1, 0):min(signal_length, cent + ind - sz)] = 0
+        harm_inds = np.round(signal_length * (np.arange(1, self.num_harm + 1) * self.first_freq /
+                                              samp_rate)).astype(np.int64)
+        band_centers = np.hstack((cent - harm_inds, cent + harm_inds))
 
-        if do_plots:
-            fig2, ax2 = plt.subplots(figsize=(5, 5))
-            ax2.plot(w_vec, harm_filter)
-            ax2.set_title('Step 1')
+        starts = np.clip(band_centers - sz, 0, signal_length)
+        stops = np.clip(band_centers + sz + 1, 0, signal_length)
 
-        # Last harmonic
-        ind = int(round(signal_length * (num_harm * first_freq / samp_rate)))
-        harm_filter[:cent - ind - sz] = 0
-        harm_filter[cent + ind + sz + 1:] = 0
+        edges = np.zeros(signal_length + 1, dtype=np.int64)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, stops, -1)
 
-        if do_plots:
-            fig3, ax3 = plt.subplots(figsize=(5, 5))
-            ax3.plot(w_vec, harm_filter)
-            ax3.set_title('Step 2')
-
-        if num_harm > 1:
-            for harm_ind in range(1, num_harm):
-                ind = int(round(signal_length * (harm_ind * first_freq / samp_rate)))
-                ind2 = int(round(signal_length * ((harm_ind + 1) * first_freq / samp_rate)))
-                harm_filter[cent - ind2 + sz + 1:cent - ind - sz] = 0
-                harm_filter[cent + ind + sz + 1:cent + ind2 - sz] = 0
-                if do_plots:
-                    fig4, ax4 = plt.subplots(figsize=(5, 5))
-                    ax4.plot(w_vec, harm_filter)
-                    ax4.set_title('Step %d' % (harm_ind + 2))
-
-        self.value = harm_filter
+        return (np.cumsum(edges[:-1]) > 0).astype(np.int16)
 
     def get_parms(self):
         basic_parms = super(HarmonicPassFilter, self).get_parms()
@@ -6,13 +6,6 @@ Created on Mar 1, 2016
 
 from __future__ import division, print_function, absolute_import
 import numpy as np
-import sys
-
-if sys.version_info.major == 3 and sys.version_info.minor == 6:
-    disable_histogram = True
-else:
-    disable_histogram = False
-    from numpy_groupies import aggregate_np
 
 
 def build_histogram(x_hist, data_mat, N_x_bins, N_y_bins, weighting_vec=1, min_resp=None, max_resp=None, func=None,
@@ -64,42 +57,25 @@ def build_histogram(x_hist, data_mat, N_x_bins, N_y_bins, weighting_vec=1, min_r
     if debug:
         print('min_resp', min_resp, 'max_resp', max_resp)
 
-    y_hist = __scale_and_discretize(y_hist, N_y_bins, max_resp, min_resp, debug)
+    y_hist = _scale_and_discretize(y_hist, N_y_bins, max_resp, min_resp, debug)
 
-    '''
-    Combine x_hist and y_hist into one matrix
-    '''
     if debug:
         print(np.shape(x_hist))
         print(np.shape(y_hist))
 
-    try:
-        group_idx = np.zeros((2, x_hist.size), dtype=np.int32)
-        group_idx[0, :] = x_hist
-        group_idx[1, :] = y_hist
-    except:
-        raise
-
     '''
     Aggregate matrix for histogram of current chunk
     '''
     if debug:
-        print(np.shape(group_idx))
         print(np.shape(weighting_vec))
         print(N_x_bins, N_y_bins)
 
-    try:
-        if not disable_histogram:
-            pixel_hist = aggregate_np(group_idx, weighting_vec, func='sum', size=(N_x_bins, N_y_bins), dtype=np.int32)
-        else:
-            pixel_hist = None
-    except:
-        raise
+    pixel_hist = np.int32(_bin_2d(x_hist, y_hist, N_x_bins, N_y_bins, weighting_vec))
 
     return pixel_hist
 
 
-def __scale_and_discretize(y_hist, N_y_bins, max_resp, min_resp, debug=False):
+def _scale_and_discretize(y_hist, N_y_bins, max_resp, min_resp, debug=False):
     """
     Normalizes and discretizes the `y_hist` array 
     
@@ -122,8 +98,119 @@ def __scale_and_discretize(y_hist, N_y_bins, max_resp, min_resp, debug=False):
     '''
     Discretize y_hist
     '''
-    y_hist = np.rint(y_hist * (N_y_bins - 1))
+    y_hist = np.rint(y_hist * (N_y_bins - 1)).astype(np.intp)
     if debug:
         print('ymin', min(y_hist), 'ymax', max(y_hist))
 
     return y_hist
+
+
+def _bin_2d(x_inds, y_inds, N_x_bins, N_y_bins, weighting_vec=1):
+    """
+    Counts the occurrences of each (x, y) bin pair by linearizing the bin indices
+
+    Parameters
+    ----------
+    x_inds : numpy.ndarray
+        x-bin of each value
+    y_inds : numpy.ndarray
+        y-bin of each value
+    N_x_bins : int
+    N_y_bins : int
+    weighting_vec : numpy.ndarray or float
+        weights. If setting all to one value, can be a scalar
+
+    Returns
+    -------
+    hist : 2D numpy.ndarray
+        histogram arranged as [x-bin, y-bin]
+    """
+    lin_inds = np.ravel(x_inds).astype(np.intp) * N_y_bins + np.ravel(y_inds)
+    if np.isscalar(weighting_vec):
+        hist = np.bincount(lin_inds, minlength=N_x_bins * N_y_bins)
+        if weighting_vec != 1:
+            hist = hist * weighting_vec
+    else:
+        hist = np.bincount(lin_inds, weights=np.ravel(weighting_vec), minlength=N_x_bins * N_y_bins)
+    return hist.reshape(N_x_bins, N_y_bins)
+
+
+class HistogramAccumulator(object):
+    """
+    Builds a 2D histogram with fixed bins from chunks of data that are added one at a time.
+    Histograms accumulated from different chunks of the same dataset (for example by parallel workers) can be merged.
+    """
+
+    def __init__(self, N_x_bins, N_y_bins, min_resp, max_resp, func=None, dtype=np.int64):
+        """
+        Parameters
+        ----------
+        N_x_bins : integer
+            number of bins in the x-direction
+        N_y_bins : integer
+            number of bins in the y-direction
+        min_resp : float
+            minimum value for y binning. Smaller values are counted in the first bin
+        max_resp : float
+            maximum value for y binning. Larger values are counted in the last bin
+        func : function, optional
+            function applied to each chunk of data before binning. Example - np.abs
+        dtype : numpy.dtype, optional
+            data type of the histogram. Default - np.int64
+        """
+        self.N_x_bins = int(N_x_bins)
+        self.N_y_bins = int(N_y_bins)
+        self.min_resp = min_resp
+        self.max_resp = max_resp
+        self.func = func
+        self.histogram = np.zeros((self.N_x_bins, self.N_y_bins), dtype=dtype)
+
+    def add(self, x_inds, data_mat, weighting_vec=1):
+        """
+        Adds a chunk of data to the histogram
+
+        Parameters
+        ----------
+        x_inds : numpy.ndarray
+            x-bin of each element in data_mat. A 1D array is used for every row of a 2D data_mat
+        data_mat : numpy.ndarray
+            data to be binned along the y-axis
+        weighting_vec : numpy.ndarray or float
+            weights. If setting all to one value, can be a scalar
+
+        Returns
+        -------
+        self : HistogramAccumulator
+        """
+        data_mat = np.asarray(data_mat)
+        if self.func is not None:
+            data_mat = self.func(data_mat)
+        x_inds = np.broadcast_to(x_inds, data_mat.shape)
+        y_inds = _scale_and_discretize(data_mat, self.N_y_bins, self.max_resp, self.min_resp)
+        self.histogram += _bin_2d(x_inds, y_inds, self.N_x_bins, self.N_y_bins,
+                                  weighting_vec).astype(self.histogram.dtype, copy=False)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram with the same bins to this histogram
+
+        Parameters
+        ----------
+        other : HistogramAccumulator or numpy.ndarray
+            partial histogram to add
+
+        Returns
+        -------
+        self : HistogramAccumulator
+        """
+        if isinstance(other, HistogramAccumulator):
+            if (other.N_x_bins, other.N_y_bins, other.min_resp, other.max_resp) != \
+                    (self.N_x_bins, self.N_y_bins, self.min_resp, self.max_resp):
+                raise ValueError('Cannot merge histograms with different bins')
+            other = other.histogram
+        if np.shape(other) != self.histogram.shape:
+            raise ValueError('Cannot merge histogram of shape {} with one of shape {}'
+                             ''.format(np.shape(other), self.histogram.shape))
+        self.histogram += other
+        return self
@@ -10,6 +10,7 @@ from multiprocessing import cpu_count
 from warnings import warn
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from scipy.optimize import leastsq
 from scipy.signal import blackman
 from sklearn.utils import gen_batches
@@ -22,6 +23,7 @@ from pyUSID.io.write_utils import make_indices_matrix, get_aux_dset_slicing, IND
 from ..io.hdf_writer import HDFwriter
 from ..io.virtual_data import VirtualGroup, VirtualDataset
 from .svd_utils import get_component_slice
+from .fft import FilterCache
 
 windata32 = np.dtype({'names': ['Image Data'],
                       'formats': [np.float32]})
@@ -155,46 +157,39 @@ class ImageWindow(object):
             self.h5_wins = h5_wins
             return h5_wins
 
+        '''
+        The window size may have been adjusted to fit the image
+        '''
+        win_x = int(h5_wins.parent.attrs['win_x'])
+        win_y = int(h5_wins.parent.attrs['win_y'])
         n_wins = win_pos_mat.shape[0]
         win_pix = win_x * win_y
 
         '''
-        Create slice object from the positions
+        View of every possible window in the image. No data is copied until a batch of windows is gathered
         '''
-        win_slices = [[slice(x, x + win_x), slice(y, y + win_y)] for x, y in win_pos_mat]
+        win_view = get_window_view(image, win_x, win_y)
 
         '''
         Calculate the size of a given batch that will fit in the available memory
+        Each window is held as the image data, the FFT temporaries and the output
         '''
-        mem_per_win = win_x * win_y * h5_wins.dtype.itemsize
+        mem_per_win = win_pix * (image.itemsize + 2 * np.complex128(0).itemsize + h5_wins.dtype.itemsize)
         if self.cores is None:
             free_mem = self.max_memory - image.size * image.itemsize
         else:
             free_mem = self.max_memory * 2 - image.size * image.itemsize
-        batch_size = int(free_mem / mem_per_win)
+        batch_size = max(1, int(free_mem / mem_per_win))
         batch_slices = gen_batches(n_wins, batch_size)
 
-        for ibatch, batch in enumerate(batch_slices):
-            batch_wins = np.zeros([batch.stop - batch.start, win_pix], dtype=win_type)
+        for batch in batch_slices:
+            print('Windowing Image...{}% --windows {}-{}'.format(np.rint(100 * batch.start / n_wins),
+                                                                 batch.start, batch.stop - 1))
             '''
-            Read each slice and write it to the dataset
+            Gather the batch of windows, transform them all at once and write them to the dataset
             '''
-            for islice, this_slice in enumerate(win_slices[batch]):
-                iwin = ibatch * batch_size + islice
-                selected = iwin % np.rint(n_wins / 10) == 0
-
-                if selected:
-                    per_done = np.rint(100 * iwin / n_wins)
-                    print('Windowing Image...{}% --pixels {}-{}, step # {}'.format(per_done,
-                                                                                   (this_slice[0].start,
-                                                                                    this_slice[1].start),
-                                                                                   (this_slice[0].stop,
-                                                                                    this_slice[1].stop),
-                                                                                   islice))
-
-                batch_wins[islice] = win_func(image[this_slice]).flatten()
-
-            h5_wins[batch] = batch_wins
+            batch_wins = win_view[win_pos_mat[batch, 0], win_pos_mat[batch, 1]]
+            h5_wins[batch] = win_func(batch_wins).reshape(-1, win_pix)
             self.hdf.flush()
 
         self.h5_wins = h5_wins
@@ -461,7 +456,8 @@ class ImageWindow(object):
         Parameters
         ----------
         image : numpy.ndarray
-            Windowed image to take the FFT of
+            Windowed image to take the FFT of. Stacks of windows arranged as [window, x, y] are transformed
+            window by window
 
         Returns
         -------
@@ -471,7 +467,7 @@ class ImageWindow(object):
 
         """
         windows = np.empty_like(image, dtype=absfft32)
-        windows['FFT Magnitude'] = np.abs(np.fft.fftshift(np.fft.fft2(image)))
+        windows['FFT Magnitude'] = np.abs(np.fft.fftshift(np.fft.fft2(image), axes=(-2, -1)))
 
         return windows
 
@@ -483,7 +479,8 @@ class ImageWindow(object):
         Parameters
         ----------
         image : numpy.ndarray
-            Windowed image to take the FFT of
+            Windowed image to take the FFT of. Stacks of windows arranged as [window, x, y] are transformed
+            window by window
 
         Returns
         -------
@@ -494,7 +491,7 @@ class ImageWindow(object):
         """
         windows = np.empty_like(image, dtype=winabsfft32)
         windows['Image Data'] = image
-        windows['FFT Magnitude'] = np.abs(np.fft.fftshift(np.fft.fft2(image)))
+        windows['FFT Magnitude'] = np.abs(np.fft.fftshift(np.fft.fft2(image), axes=(-2, -1)))
 
         return windows
 
@@ -506,7 +503,8 @@ class ImageWindow(object):
         Parameters
         ----------
         image : numpy.ndarray
-            Windowed image to take the FFT of
+            Windowed image to take the FFT of. Stacks of windows arranged as [window, x, y] are transformed
+            window by window
 
         Returns
         -------
@@ -516,7 +514,7 @@ class ImageWindow(object):
         """
         windows = np.empty_like(image, dtype=wincompfft32)
         windows['Image Data'] = image
-        win_fft = np.fft.fftshift(np.fft.fft2(image))
+        win_fft = np.fft.fftshift(np.fft.fft2(image), axes=(-2, -1))
         windows['FFT Real'] = win_fft.real
         windows['FFT Imag'] = win_fft.imag
 
@@ -552,49 +550,46 @@ class ImageWindow(object):
         win_x = h5_win.parent.attrs['win_x']
         win_y = h5_win.parent.attrs['win_y']
         win_step_x = h5_win.parent.attrs['win_step_x']
-        win_step_y = h5_win.parent.attrs['win_step_x']
+        win_step_y = h5_win.parent.attrs['win_step_y']
 
         '''
-        Calculate the steps taken to create original windows
+        Get the origins of the windows. Fall back on the steps taken to create the original windows
         '''
-        x_steps = np.arange(0, im_x - win_x + 1, win_step_x)
-        y_steps = np.arange(0, im_y - win_y + 1, win_step_y)
-
-        '''
-        Initialize arrays to hold summed windows and counts for each position
-        '''
-        counts = np.zeros([im_x, im_y], np.uint8)
-        accum = np.zeros([im_x, im_y], np.float32)
-
-        nx = len(x_steps)
-        ny = len(y_steps)
-        n_wins = nx * ny
+        if 'Position_Indices' in h5_win.attrs.keys():
+            win_pos = h5_win.file[h5_win.attrs['Position_Indices']][()]
+        else:
+            x_steps = np.arange(0, im_x - win_x + 1, win_step_x)
+            y_steps = np.arange(0, im_y - win_y + 1, win_step_y)
+            win_pos = np.array([np.repeat(x_steps, len(y_steps)), np.tile(y_steps, len(x_steps))]).T
+        n_wins = win_pos.shape[0]
 
         '''
-        Create slice object from the positions
+        Calculate the size of a given batch that will fit in the available memory
+        Each window is held as read, as float64 weights and as flat image indices
         '''
-        win_slices = [[slice(x, x + win_x), slice(y, y + win_y)] for x, y in np.array([np.tile(x_steps, nx),
-                                                                                       np.repeat(y_steps, ny)]).T]
+        mem_per_win = win_x * win_y * (h5_win.dtype.itemsize + 3 * np.float64(0).itemsize)
+        free_mem = self.max_memory - 3 * im_x * im_y * np.float64(0).itemsize
+        batch_size = max(1, int(free_mem / mem_per_win))
 
         '''
-        Loop over all windows.  Increment counts for window positions and 
-        add current window to total.
+        Stream the windows from the file in batches and add each batch into the image at once
         '''
-        ones = np.ones([win_x, win_y], dtype=counts.dtype)
-        for islice, this_slice in enumerate(win_slices):
-            selected = islice % np.rint(n_wins / 10) == 0
-            if selected:
-                per_done = np.rint(100 * islice / n_wins)
-                print('Reconstructing Image...{}% -- step # {}'.format(per_done, islice))
-            counts[this_slice] += ones
-
-            accum[this_slice] += h5_win[islice].reshape(win_x, win_y)
+        accum, counts = None, None
+        for batch in gen_batches(n_wins, batch_size):
+            print('Reconstructing Image...{}% -- windows {}-{}'.format(np.rint(100 * batch.start / n_wins),
+                                                                       batch.start, batch.stop - 1))
+            batch_wins = h5_win[batch]
+            if h5_win.dtype.names is not None:
+                batch_wins = batch_wins['Image Data']
+            batch_wins = batch_wins.reshape(-1, win_x, win_y)
+            accum, counts = overlap_add_windows(batch_wins, win_pos[batch], (im_x, im_y), accum=accum,
+                                                counts=counts)
 
-        clean_image = accum / counts
+        clean_image = np.float32(accum / counts)
 
         clean_image[np.isnan(clean_image)] = 0
 
-        clean_grp = VirtualGroup('Cleaned_Image', h5_win.parent.name[1:])
+        clean_grp = VirtualGroup('Cleaned_Image_', h5_win.parent.name[1:])
 
         ds_clean = VirtualDataset('Cleaned_Image', clean_image)
 
@@ -799,7 +794,7 @@ class ImageWindow(object):
 
         print('Cleaning the image by removing unwanted components.')
 
-        comp_slice = get_component_slice(components)
+        comp_slice, _ = get_component_slice(components)
 
         '''
         Read the 1st n_comp components from the SVD results
@@ -831,56 +826,43 @@ class ImageWindow(object):
         win_y = h5_win.parent.attrs['win_y']
 
         '''
-        Initialize arrays to hold summed windows and counts for each position
-        '''
-        counts = np.zeros([im_x, im_y], np.uint32)
-        accum = np.zeros([im_x, im_y], np.float32)
-
-        '''
-        Create slice object from the positions
+        Get the origins of the windows
         '''
         ds_win_pos = h5_win.file[h5_win.attrs['Position_Indices']][()]
-        win_slices = [[slice(x, x + win_x), slice(y, y + win_y)] for x, y in ds_win_pos]
         n_wins = ds_win_pos.shape[0]
         '''
-        Create a matrix to add when counting.
         h5_V is usually small so go ahead and take S.V
         '''
-        ones = np.ones([win_x, win_y], dtype=counts.dtype)
         ds_V = np.dot(np.diag(h5_S[comp_slice]), h5_V['Image Data'][comp_slice, :])
 
         '''
         Calculate the size of a given batch that will fit in the available memory
+        Each rebuilt window is held along with its float64 weights and flat image indices
         '''
-        mem_per_win = ds_V.itemsize * ds_V.shape[1]
+        mem_per_win = ds_V.shape[1] * (ds_V.itemsize + 3 * np.float64(0).itemsize)
         if self.cores is None:
             free_mem = self.max_memory - ds_V.size * ds_V.itemsize
         else:
             free_mem = self.max_memory * 2 - ds_V.size * ds_V.itemsize
-        batch_size = int(free_mem / mem_per_win)
+        batch_size = max(1, int(free_mem / mem_per_win))
         batch_slices = gen_batches(n_wins, batch_size)
 
         print('Reconstructing in batches of {} windows.'.format(batch_size))
 
         '''
-        Loop over all batches.  Increment counts for window positions and
-        add current window to total.
+        Loop over all batches.  Rebuild the windows in each batch and add them into the image at once
         '''
-        for ibatch, batch in enumerate(batch_slices):
+        accum, counts = None, None
+        for batch in batch_slices:
+            print('Reconstructing Image...{}% -- windows {}-{}'.format(np.rint(100 * batch.start / n_wins),
+                                                                       batch.start, batch.stop - 1))
             ds_U = h5_U[batch, comp_slice]
             batch_wins = np.dot(ds_U, ds_V).reshape([-1, win_x, win_y])
             del ds_U
-            for islice, this_slice in enumerate(win_slices[batch]):
-                iwin = ibatch * batch_size + islice
-                if iwin % np.rint(n_wins / 10) == 0:
-                    per_done = np.rint(100 * iwin / n_wins)
-                    print('Reconstructing Image...{}% -- step # {}'.format(per_done, islice))
-
-                counts[this_slice] += ones
-
-                accum[this_slice] += batch_wins[islice]
+            accum, counts = overlap_add_windows(batch_wins, ds_win_pos[batch], (im_x, im_y), accum=accum,
+                                                counts=counts)
 
-        clean_image = np.divide(accum, counts)
+        clean_image = np.float32(np.divide(accum, counts))
 
         clean_image[np.isnan(clean_image)] = 0
 
@@ -1002,10 +984,9 @@ class ImageWindow(object):
         win_y = h5_win.parent.attrs['win_y']
 
         '''
-        Create slice object from the positions
+        Get the origins of the windows
         '''
         ds_win_pos = h5_win.file[h5_win.attrs['Position_Indices']][()]
-        win_slices = [[slice(x, x + win_x), slice(y, y + win_y), slice(None)] for x, y in ds_win_pos]
         n_wins = len(ds_win_pos)
 
         '''
@@ -1015,17 +996,11 @@ class ImageWindow(object):
         ds_V = np.dot(np.diag(h5_S[comp_slice]), h5_V['Image Data'][comp_slice, :]).T
         num_comps = ds_V.shape[1]
 
-        '''
-        Initialize arrays to hold summed windows and counts for each position
-        '''
-        ones = np.ones([win_x, win_y, num_comps], dtype=np.uint32)
-        counts = np.zeros([im_x, im_y, num_comps], dtype=np.uint32)
-        clean_image = np.zeros([im_x, im_y, num_comps], dtype=np.float32)
-
         '''
         Calculate the size of a given batch that will fit in the available memory
+        Each window holds every component along with the float64 weights and flat image indices
         '''
-        mem_per_win = ds_V.itemsize * (num_comps + ds_V.size)
+        mem_per_win = ds_V.size * (ds_V.itemsize + 3 * np.float64(0).itemsize)
         if self.cores is None:
             free_mem = self.max_memory - ds_V.size * ds_V.itemsize
         else:
@@ -1037,26 +1012,21 @@ class ImageWindow(object):
 
         print('Reconstructing in batches of {} windows.'.format(batch_size))
         '''
-        Loop over all batches.  Increment counts for window positions and
-        add current window to total.
+        Loop over all batches.  Rebuild each component of the windows in the batch and add them into the image at once
         '''
-        for ibatch, batch in enumerate(batch_slices):
+        accum, counts = None, None
+        for batch in batch_slices:
+            print('Reconstructing Image...{}% -- windows {}-{}'.format(np.rint(100 * batch.start / n_wins),
+                                                                       batch.start, batch.stop - 1))
             ds_U = h5_U[batch, comp_slice]
-            batch_wins = ds_U[:, None, :] * ds_V[None, :, :]
-            for islice, this_slice in enumerate(win_slices[batch]):
-                iwin = ibatch * batch_size + islice
-                if iwin % np.rint(n_wins / 10) == 0:
-                    per_done = np.rint(100 * iwin / n_wins)
-                    print('Reconstructing Image...{}% -- step # {}'.format(per_done, iwin))
-
-                counts[this_slice] += ones
-
-                clean_image[this_slice] += batch_wins[islice].reshape(win_x, win_y, num_comps)
+            batch_wins = (ds_U[:, None, :] * ds_V[None, :, :]).reshape(-1, win_x, win_y, num_comps)
+            accum, counts = overlap_add_windows(batch_wins, ds_win_pos[batch], (im_x, im_y), accum=accum,
+                                                counts=counts)
 
         del ds_U, ds_V
 
-        clean_image /= counts
-        del counts
+        clean_image = np.float32(accum / counts[:, :, None])
+        del accum, counts
         clean_image[np.isnan(clean_image)] = 0
 
         '''
@@ -1193,6 +1163,12 @@ class ImageWindow(object):
         psf_width : int
             Estimate atom spacing in pixels
 
+        Notes
+        -----
+        The radius in the FFT is measured from its zero frequency pixel. Previously, images with an odd
+        number of pixels were measured from a point half a pixel away from it, so their radial maxima, and possibly the
+        estimated window size, may differ slightly from earlier results.
+
         """
 
         def __gauss_fit(p, x):
@@ -1266,9 +1242,6 @@ class ImageWindow(object):
         im2 = image - np.mean(image)
         fim = np.fft.fftshift(np.fft.fft2(__hamming(im2)))
 
-        imrange = np.arange(-im_shape / 2, im_shape / 2)
-        uu, vv = np.meshgrid(imrange, imrange)
-
         '''
         Find max at each radial distance from the center
         '''
@@ -1277,16 +1250,7 @@ class ImageWindow(object):
         r_max = im_shape / 2
         r_vec = np.linspace(r_min, r_max, r_n, dtype=np.float32).transpose()
 
-        r_mat = np.abs(uu + 1j * vv)
-
-        fimabs = np.abs(fim)
-        fimabs_max = np.zeros(r_n - 1)
-
-        for k in range(r_n - 1):
-            r1 = r_vec[k]
-            r2 = r_vec[k + 1]
-            r_ind = np.where(np.logical_and(r_mat >= r1, r_mat <= r2))
-            fimabs_max[k] = np.max(fimabs[r_ind])
+        fimabs_max = radial_profile(np.abs(fim), r_vec)[1]
 
         r_vec = r_vec[:-1] + (r_max - r_min) / (r_n - 1.0) / 2.0
 
@@ -1432,70 +1396,269 @@ class ImageWindow(object):
         # plt.close(fig)
 
 
+def get_window_view(image, win_x, win_y):
+    """
+    Returns a read-only view of every (win_x x win_y) window in the image without copying any data
+
+    Parameters
+    ----------
+    image : 2D numpy array
+        Image to be windowed
+    win_x : uint
+        Size of the window in the x-direction.
+    win_y : uint
+        Size of the window in the y-direction.
+
+    Returns
+    -------
+    win_view : 4D numpy array
+        Windows arranged as [origin x, origin y, x, y]. For example, win_view[3, 5] is image[3:3 + win_x, 5:5 + win_y]
+    """
+    image = np.asarray(image)
+    im_x, im_y = image.shape
+    if win_x > im_x or win_y > im_y:
+        raise ValueError('Window of size {}x{} does not fit in image of size {}x{}'.format(win_x, win_y, im_x, im_y))
+    return as_strided(image, shape=(im_x - win_x + 1, im_y - win_y + 1, win_x, win_y),
+                      strides=image.strides * 2, writeable=False)
+
+
+def get_window_flat_indices(win_pos, win_x, win_y, im_y):
+    """
+    Returns the flattened image index of every pixel in every window
+
+    Parameters
+    ----------
+    win_pos : 2D numpy array
+        Origins of the windows arranged as [window, (x, y)]
+    win_x : uint
+        Size of the window in the x-direction.
+    win_y : uint
+        Size of the window in the y-direction.
+    im_y : uint
+        Size of the image in the y-direction.
+
+    Returns
+    -------
+    flat_inds : 2D numpy array
+        Indices into the raveled image arranged as [window, pixel within the window]
+    """
+    win_pos = np.asarray(win_pos, dtype=np.intp)
+    origins = win_pos[:, 0] * im_y + win_pos[:, 1]
+    offsets = (np.arange(win_x, dtype=np.intp)[:, None] * im_y + np.arange(win_y, dtype=np.intp)).ravel()
+    return origins[:, None] + offsets
+
+
+def overlap_add_windows(windows, win_pos, image_shape, accum=None, counts=None):
+    """
+    Adds a batch of windows into an image at their positions and counts the number of windows covering each pixel.
+    Call repeatedly with the returned arrays to reconstruct an image from windows read in blocks
+
+    Parameters
+    ----------
+    windows : numpy array
+        Windows arranged as [window, x, y] or [window, x, y, component]
+    win_pos : 2D numpy array
+        Origins of the windows arranged as [window, (x, y)]
+    image_shape : tuple of uint
+        Size of the image as (x, y)
+    accum : numpy array, optional
+        Sum of windows so far, arranged as [x, y] or [x, y, component]. Default - new array of zeros
+    counts : 2D numpy array, optional
+        Number of windows added to each pixel so far. Default - new array of zeros
+
+    Returns
+    -------
+    accum : numpy array
+        Sum of all windows added into the image
+    counts : 2D numpy unsigned int array
+        Number of windows covering each pixel
+    """
+    windows = np.asarray(windows)
+    win_x, win_y = windows.shape[1:3]
+    comp_shape = windows.shape[3:]
+    num_comps = int(np.prod(comp_shape))
+    im_x, im_y = image_shape
+    if accum is None:
+        accum = np.zeros((im_x, im_y) + comp_shape, dtype=np.float64)
+    if counts is None:
+        counts = np.zeros((im_x, im_y), dtype=np.uint32)
+
+    win_pos = np.asarray(win_pos, dtype=np.intp)
+    flat_inds = get_window_flat_indices(win_pos, win_x, win_y, im_y).ravel()
+    windows = windows.reshape(flat_inds.size, num_comps)
+    accum = accum.reshape(im_x * im_y, num_comps)
+    for comp in range(num_comps):
+        accum[:, comp] += np.bincount(flat_inds, weights=windows[:, comp], minlength=im_x * im_y)
+    accum = accum.reshape((im_x, im_y) + comp_shape)
+
+    '''
+    Coverage is a box sum of the window origins so it only needs one entry per window
+    '''
+    cover = np.bincount(win_pos[:, 0] * im_y + win_pos[:, 1], minlength=im_x * im_y)
+    cover = cover.reshape(im_x, im_y).cumsum(axis=0)
+    cover[win_x:] -= cover[:-win_x].copy()
+    cover = cover.cumsum(axis=1)
+    cover[:, win_y:] -= cover[:, :-win_y].copy()
+    counts += cover.astype(counts.dtype)
+
+    return accum, counts
+
+
+_radial_bin_cache = FilterCache()
+
+
+def get_radial_bins(shape, r_edges, normalized=False):
+    """
+    Assigns every pixel of an image to a radial bin around the center of the image. The assignment is computed once
+    for each combination of shape and bins and held in a FilterCache for subsequent calls.
+
+    Parameters
+    ----------
+    shape : tuple of uint
+        Shape of the image as (x, y)
+    r_edges : 1D array-like
+        Increasing edges of the radial bins. Each bin includes its lower edge and the last bin also includes its
+        upper edge
+    normalized : Boolean, optional
+        If True, the radius is measured in coordinates that run from -1 to 1 along each axis of the image.
+        Otherwise, the radius is measured in pixels from the zero frequency pixel of np.fft.fftshift, i.e. pixel
+        N // 2 along an axis of N pixels.
+        Default False
+
+    Returns
+    -------
+    pix_order : 1D numpy array
+        Flattened indices of the pixels that fall within the bins, grouped by bin
+    bin_inds : 1D numpy array
+        Bin of each pixel in pix_order
+    bin_counts : 1D numpy array
+        Number of pixels in each bin
+    """
+    r_edges = np.asarray(r_edges, dtype=np.float64)
+    shape = tuple(int(dim) for dim in shape)
+    num_bins = r_edges.size - 1
+
+    def __assign_bins():
+        if normalized:
+            x_vec = np.linspace(-1, 1, shape[0])
+            y_vec = np.linspace(-1, 1, shape[1])
+        else:
+            x_vec = np.arange(shape[0]) - shape[0] // 2
+            y_vec = np.arange(shape[1]) - shape[1] // 2
+        r_vec = np.sqrt(x_vec[:, None] ** 2 + y_vec[None, :] ** 2).ravel()
+
+        bin_inds = np.searchsorted(r_edges, r_vec, side='right') - 1
+        bin_inds[r_vec == r_edges[-1]] = num_bins - 1
+        pix_order = np.flatnonzero(np.logical_and(bin_inds >= 0, bin_inds < num_bins))
+        pix_order = pix_order[np.argsort(bin_inds[pix_order], kind='mergesort')]
+        return np.vstack((pix_order, bin_inds[pix_order]))
+
+    key = ('radial_bins', shape, tuple(r_edges.tolist()), bool(normalized))
+    pix_order, bin_inds = _radial_bin_cache.fetch(key, __assign_bins)
+    bin_counts = np.bincount(bin_inds, minlength=num_bins)
+
+    return pix_order, bin_inds, bin_counts
+
+
+def radial_profile(images, r_edges, normalized=False):
+    """
+    Calculates the radial average, maximum, minimum and standard deviation of an image or a stack of images about
+    the center of the image
+
+    Parameters
+    ----------
+    images : numpy array
+        Image or stack of images with the image axes last
+    r_edges : 1D array-like
+        Increasing edges of the radial bins. Each bin includes its lower edge and the last bin also includes its
+        upper edge
+    normalized : Boolean, optional
+        If True, the radius is measured in coordinates that run from -1 to 1 along each axis of the image.
+        Otherwise, the radius is measured in pixels from the zero frequency pixel of np.fft.fftshift.
+        Default False
+
+    Returns
+    -------
+    rad_avg : numpy array
+        Average value within each radial bin, arranged as [image, ..., bin]
+    rad_max : numpy array
+        Maximum value within each radial bin
+    rad_min : numpy array
+        Minimum value within each radial bin
+    rad_std : numpy array
+        Standard deviation within each radial bin
+
+    Notes
+    -----
+    Bins that contain no pixels are set to NaN
+    """
+    images = np.asarray(images)
+    pix_order, bin_inds, bin_counts = get_radial_bins(images.shape[-2:], r_edges, normalized=normalized)
+    num_bins = bin_counts.size
+    out_shape = images.shape[:-2] + (num_bins,)
+    num_images = int(np.prod(images.shape[:-2]))
+
+    binned = images.reshape(num_images, -1)[:, pix_order]
+
+    '''
+    Give every image in the stack its own set of bins so that a single bincount covers the whole stack
+    '''
+    stack_bins = (np.arange(num_images)[:, None] * num_bins + bin_inds).ravel()
+
+    def __bin_sums(weights):
+        return np.bincount(stack_bins, weights=weights.ravel(),
+                           minlength=num_images * num_bins).reshape(num_images, num_bins)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rad_avg = __bin_sums(binned) / bin_counts
+        rad_std = np.sqrt(__bin_sums((binned - rad_avg[:, bin_inds]) ** 2) / bin_counts)
+
+    rad_max = np.full((num_images, num_bins), np.nan)
+    rad_min = np.full((num_images, num_bins), np.nan)
+    filled = bin_counts > 0
+    if np.any(filled):
+        bin_starts = (np.cumsum(bin_counts) - bin_counts)[filled]
+        rad_max[:, filled] = np.maximum.reduceat(binned, bin_starts, axis=1)
+        rad_min[:, filled] = np.minimum.reduceat(binned, bin_starts, axis=1)
+
+    return tuple(stat.reshape(out_shape) for stat in [rad_avg, rad_max, rad_min, rad_std])
+
+
 def radially_average_correlation(data_mat, num_r_bin):
     """
-    Calculates the radially average correlation functions for a given 2D image
+    Calculates the radially average correlation functions for a given 2D image or a stack of images
 
     Parameters
     ----------
-    data_mat : 2D real numpy array
-        Image to analyze
+    data_mat : real numpy array
+        Image or stack of images to analyze with the image axes last
     num_r_bin : unsigned int
         Number of spatial bins to analyze
 
     Returns
     --------
-    a_mat : 2D real numpy array
-        Noise spectrum of the image
-    a_rad_avg_vec : 1D real numpy array
+    a_mat : real numpy array
+        Noise spectrum of the image(s)
+    a_rad_avg_vec : real numpy array
         Average value of the correlation as a function of feature size
-    a_rad_max_vec : 1D real numpy array
+    a_rad_max_vec : real numpy array
         Maximum value of the correlation as a function of feature size
-    a_rad_min_vec : 1D real numpy array
+    a_rad_min_vec : real numpy array
         Minimum value of the correlation as a function of feature size
-    a_rad_std_vec : 1D real numpy array
+    a_rad_std_vec : real numpy array
         Standard deviation of the correlation as a function of feature size
 
     """
-    x_size = data_mat.shape[0]
-    y_size = data_mat.shape[1]
-
-    x_mesh, y_mesh = np.meshgrid(np.linspace(-1, 1, x_size),
-                                 np.linspace(-1, 1, y_size))
-    r_vec = np.sqrt(x_mesh ** 2 + y_mesh ** 2).flatten()
+    s_mat = (np.abs(np.fft.fftshift(np.fft.fft2(data_mat), axes=(-2, -1)))) ** 2
+    a_mat = np.abs(np.fft.fftshift(np.fft.ifft2(s_mat), axes=(-2, -1)))
 
-    s_mat = (np.abs(np.fft.fftshift(np.fft.fft2(data_mat)))) ** 2
-    a_mat = np.abs(np.fft.fftshift((np.fft.ifft2(s_mat))))
-
-    min_a = np.min(a_mat)
-    a_mat = a_mat - min_a
-    max_a = np.max(a_mat)
-    a_mat = a_mat / max_a
-
-    a_vec = a_mat.flatten()
+    a_mat = a_mat - np.min(a_mat, axis=(-2, -1), keepdims=True)
+    a_mat = a_mat / np.max(a_mat, axis=(-2, -1), keepdims=True)
 
     # bin results based on r
-    a_rad_avg_vec = np.zeros(num_r_bin)
-    a_rad_max_vec = np.zeros(a_rad_avg_vec.shape)
-    a_rad_min_vec = np.zeros(a_rad_avg_vec.shape)
-    a_rad_std_vec = np.zeros(a_rad_avg_vec.shape)
-    r_bin_vec = np.zeros(a_rad_avg_vec.shape)
-
     step = 1 / (num_r_bin * 1.0 - 1)
-    for k, r_bin in enumerate(np.linspace(0, 1, num_r_bin)):
-        b = np.where((r_vec < r_bin + step) and (r_vec > r_bin))[0]
-
-        if b.size == 0:
-            a_rad_avg_vec[k] = np.nan
-            a_rad_min_vec[k] = np.nan
-            a_rad_max_vec[k] = np.nan
-            a_rad_std_vec[k] = np.nan
-        else:
-            a_bin = a_vec[b]
-            a_rad_avg_vec[k] = np.mean(a_bin)
-            a_rad_min_vec[k] = np.min(a_bin)
-            a_rad_max_vec[k] = np.max(a_bin)
-            a_rad_std_vec[k] = np.std(a_bin)
-        r_bin_vec[k] = r_bin + 0.5 * step
+    r_edges = np.arange(num_r_bin + 1) * step
+
+    a_rad_avg_vec, a_rad_max_vec, a_rad_min_vec, a_rad_std_vec = radial_profile(a_mat, r_edges, normalized=True)
 
     return a_mat, a_rad_avg_vec, a_rad_max_vec, a_rad_min_vec, a_rad_std_vec
@@ -8,9 +8,12 @@ Created on Mon Mar 28 09:45:08 2016
 from __future__ import division, print_function, absolute_import
 import time
 from multiprocessing import cpu_count
+import h5py
 import numpy as np
-from sklearn.utils import gen_batches
-from sklearn.utils.extmath import randomized_svd
+from scipy import linalg
+from joblib import Parallel, delayed
+from sklearn.utils import gen_batches, check_random_state
+from sklearn.utils.extmath import randomized_svd, svd_flip
 
 from pyUSID.processing.process import Process
 from .proc_utils import get_component_slice
@@ -25,9 +28,22 @@ from pyUSID import USIDataset
 
 class SVD(Process):
 
-    def __init__(self, h5_main, num_components=None):
+    def __init__(self, h5_main, num_components=None, **kwargs):
+        """
+        Computes the randomized SVD of the provided dataset. Datasets that do not fit within the memory budget are
+        decomposed out-of-core using streamed_randomized_svd()
 
-        super(SVD, self).__init__(h5_main)
+        Parameters
+        ----------
+        h5_main : h5py.Dataset object
+            Dataset to decompose
+        num_components : (Optional) uint
+            Number of components to compute. Default - min(n_samples, n_features)
+        kwargs : (Optional). dictionary
+            Please see Process class for additional inputs
+        """
+
+        super(SVD, self).__init__(h5_main, **kwargs)
         self.process_name = 'SVD'
 
         '''
@@ -37,6 +53,7 @@ class SVD(Process):
         '''
         n_samples, n_features = h5_main.shape
         self.data_transform_func, is_complex, is_compound, n_features, type_mult = check_dtype(h5_main)
+        self.__data_mem_mb = n_samples * h5_main.shape[1] * type_mult / 1E+6
 
         if num_components is None:
             num_components = min(n_samples, n_features)
@@ -52,6 +69,7 @@ class SVD(Process):
         self.__u = None
         self.__v = None
         self.__s = None
+        self.__svd_method = None
 
     def test(self, override=False):
         """
@@ -93,8 +111,18 @@ class SVD(Process):
 
         t1 = time.time()
 
-        self.__u, self.__s, self.__v = randomized_svd(self.data_transform_func(self.h5_main), self.num_components,
-                                                      n_iter=3)
+        if self.__data_mem_mb < self._max_mem_mb:
+            self.__svd_method = 'sklearn-randomized'
+            self.__u, self.__s, self.__v = randomized_svd(self.data_transform_func(self.h5_main),
+                                                          self.num_components, n_iter=3)
+        else:
+            if self.verbose:
+                print('Data ({} MB) does not fit within the memory budget ({} MB). Streaming randomized SVD'
+                      ''.format(self.__data_mem_mb, self._max_mem_mb))
+            self.__svd_method = 'streamed-randomized'
+            self.__u, self.__s, self.__v = streamed_randomized_svd(self.h5_main, self.num_components, n_iter=3,
+                                                                   max_mem_mb=self._max_mem_mb,
+                                                                   verbose=self.verbose)
         self.__v = stack_real_to_target_dtype(self.__v, self.h5_main.dtype)
 
         print('Took {} to compute randomized SVD'.format(format_time(time.time() - t1)))
@@ -160,7 +188,7 @@ class SVD(Process):
         self.h5_results_grp = h5_svd_group
 
         write_simple_attrs(h5_svd_group, self.parms_dict)
-        write_simple_attrs(h5_svd_group, {'svd_method': 'sklearn-randomized', 'last_pixel': self.h5_main.shape[0]})
+        write_simple_attrs(h5_svd_group, {'svd_method': self.__svd_method, 'last_pixel': self.h5_main.shape[0]})
 
         h5_u = write_main_dataset(h5_svd_group, np.float32(self.__u), 'U', 'Abundance', 'a.u.', None, comp_dim,
                                   h5_pos_inds=self.h5_main.h5_pos_inds, h5_pos_vals=self.h5_main.h5_pos_vals,
@@ -194,37 +222,238 @@ class SVD(Process):
 ###############################################################################
 
 
-def simplified_kpca(kpca, source_data):
+def streamed_randomized_svd(h5_main, num_components, n_oversamples=10, n_iter=3, power_iteration_normalizer='auto',
+                            random_state=0, max_mem_mb=1024, col_slice=None, verbose=False):
+    """
+    Out-of-core equivalent of sklearn.utils.extmath.randomized_svd that never holds more than a block of rows of the
+    dataset in memory. The random projection, power iterations and the projection onto the range basis are all
+    computed by reading h5_main in blocks of rows. Complex and compound datasets are flattened to real values block
+    by block.
+
+    Given the same random_state, the results match those of randomized_svd on the flattened dataset to within
+    floating point precision.
+
+    Parameters
+    ----------
+    h5_main : h5py.Dataset object
+        2D dataset arranged as [position, spectral]
+    num_components : uint
+        Number of singular values and vectors to compute
+    n_oversamples : uint, optional. Default = 10
+        Additional number of random vectors used to sample the range of the dataset
+    n_iter : uint, optional. Default = 3
+        Number of power iterations
+    power_iteration_normalizer : str, optional. Default = 'auto'
+        'auto', 'QR', 'LU', or 'none'. 'auto' uses 'none' if n_iter <= 2 and 'LU' otherwise
+    random_state : int, RandomState instance or None, optional. Default = 0
+        Seed for the random projection
+    max_mem_mb : uint, optional. Default = 1024
+        Memory budget (in MB) that determines the number of rows read at a time
+    col_slice : slice, optional. Default = all columns
+        Subset of the spectral columns of h5_main to decompose
+    verbose : bool, optional. Default = False
+        Whether or not to print debugging statements
+
+    Returns
+    -------
+    U : 2D numpy array
+        Abundance matrix arranged as [position, component]
+    S : 1D numpy array
+        Singular values
+    V : 2D real numpy array
+        Eigenvector matrix arranged as [component, spectral]. Call stack_real_to_target_dtype() to restore the
+        data-type of h5_main
+    """
+    func, is_complex, is_compound, n_features, type_mult = check_dtype(h5_main)
+    if col_slice is None:
+        col_slice = slice(None)
+    n_samples = h5_main.shape[0]
+    n_random = num_components + n_oversamples
+
+    # Each row of the dataset and of the two projected matrices:
+    bytes_per_row = h5_main.shape[1] * type_mult + 2 * n_random * np.float64(0).itemsize
+    rows_per_block = max(1, int(max_mem_mb * 1024 ** 2 // bytes_per_row))
+    batches = list(gen_batches(n_samples, rows_per_block))
+
+    if verbose:
+        print('Streaming randomized SVD in {} blocks of up to {} rows'.format(len(batches), rows_per_block))
+
+    first_row = np.asarray(func(h5_main[:1, col_slice]))
+    data_dtype = first_row.dtype
+    n_features = first_row.shape[1]
+
+    def __dot(mat):
+        # A . mat
+        prod = None
+        for batch in batches:
+            block = np.dot(func(h5_main[batch, col_slice]), mat)
+            if prod is None:
+                prod = np.zeros((n_samples, mat.shape[1]), dtype=block.dtype)
+            prod[batch] = block
+        return prod
+
+    def __t_dot(mat):
+        # A.T . mat
+        prod = None
+        for batch in batches:
+            block = np.dot(func(h5_main[batch, col_slice]).T, mat[batch])
+            if prod is None:
+                prod = block
+            else:
+                prod += block
+        return prod
+
+    # Same heuristic as randomized_svd: the factorized matrix M should have fewer columns than rows
+    transpose = n_samples < n_features
+    if transpose:
+        m_dot, m_t_dot, m_cols = __t_dot, __dot, n_samples
+    else:
+        m_dot, m_t_dot, m_cols = __dot, __t_dot, n_features
+
+    if power_iteration_normalizer == 'auto':
+        power_iteration_normalizer = 'none' if n_iter <= 2 else 'LU'
+
+    random_state = check_random_state(random_state)
+    q_mat = random_state.normal(size=(m_cols, n_random))
+    if data_dtype.kind == 'f':
+        q_mat = q_mat.astype(data_dtype, copy=False)
+
+    for _ in range(n_iter):
+        if power_iteration_normalizer == 'none':
+            q_mat = m_t_dot(m_dot(q_mat))
+        elif power_iteration_normalizer == 'LU':
+            q_mat, _ = linalg.lu(m_dot(q_mat), permute_l=True)
+            q_mat, _ = linalg.lu(m_t_dot(q_mat), permute_l=True)
+        elif power_iteration_normalizer == 'QR':
+            q_mat, _ = linalg.qr(m_dot(q_mat), mode='economic')
+            q_mat, _ = linalg.qr(m_t_dot(q_mat), mode='economic')
+        else:
+            raise ValueError('Unknown power_iteration_normalizer: {}'.format(power_iteration_normalizer))
+
+    q_mat, _ = linalg.qr(m_dot(q_mat), mode='economic')
+
+    # B = Q.T . M = (M.T . Q).T
+    u_hat, s_vec, v_mat = linalg.svd(m_t_dot(q_mat).T, full_matrices=False)
+    u_mat = np.dot(q_mat, u_hat)
+
+    if not transpose:
+        u_mat, v_mat = svd_flip(u_mat, v_mat)
+        return u_mat[:, :num_components], s_vec[:num_components], v_mat[:num_components, :]
+
+    u_mat, v_mat = svd_flip(u_mat, v_mat, u_based_decision=False)
+    return v_mat[:num_components, :].T, s_vec[:num_components], u_mat[:, :num_components].T
+
+
+def simplified_kpca(kpca, source_data, num_landmarks=1000, landmark_threshold=5000, random_state=0,
+                    max_mem_mb=1024, verbose=False):
     """
     Performs kernel PCA on the provided dataset and returns the familiar
     eigenvector, eigenvalue, and scree matrices.
 
-    Note that the positions in the eigenvalues may need to be transposed
+    The kernel is only computed and decomposed once. Datasets with more than landmark_threshold positions are
+    decomposed using the Nystrom approximation: kpca is fit to num_landmarks randomly chosen positions and every
+    position is then projected onto the kernel principal components chunk by chunk. The eigenvectors in the original
+    space are the projection-weighted sums of the data, which reduce to the V matrix of the SVD for a linear kernel.
+
+    If source_data is a USID main dataset, the results are written to a 'Kernel_PCA' group with the same U, S, V
+    layout as the SVD results, and the projection is written to the file one chunk at a time.
 
     Parameters
     ----------
     kpca : KernelPCA object
         configured Kernel PCA object ready to perform analysis
-    source_data : 2D numpy array
+    source_data : 2D numpy array or h5py.Dataset
         Data arranged as [iteration, features] example - [position, time]
+    num_landmarks : uint, optional. Default = 1000
+        Number of positions used to approximate the kernel
+    landmark_threshold : uint, optional. Default = 5000
+        Datasets with more positions than this are decomposed using the landmarks. Set to None to always compute
+        the exact kernel PCA
+    random_state : int, RandomState instance or None, optional. Default = 0
+        Seed used to choose the landmarks
+    max_mem_mb : uint, optional. Default = 1024
+        Memory budget (in MB) that determines the number of positions projected at a time
+    verbose : bool, optional. Default = False
+        Whether or not to print debugging statements
 
     Returns
     -------
-    eigenvalues : 2D numpy array
-        Eigenvalues in the original space arranged as [component,iteration]
+    eigenvalues : 2D numpy array or h5py.Dataset
+        Projection of each position onto the kernel principal components arranged as [iteration, component]. This is
+        the 'U' dataset in the results group if source_data is a HDF5 dataset
     scree : 1D numpy array
-        S component
+        Eigenvalues of the centered kernel matrix
     eigenvector : 2D numpy array
         Eigenvectors in the original space arranged as [component,features]
-
     """
-    X_kpca = kpca.fit(source_data.T)
-    eigenvectors = X_kpca.alphas_.T
-    eigenvalues = X_kpca.fit_transform(source_data)
-    # kpca_explained_variance = np.var(kpca.fit_transform(source_data), axis=0)
-    # information_content = kpca_explained_variance / np.sum(kpca_explained_variance)
-    scree = kpca.lambdas_
-    return eigenvalues, scree, eigenvectors
+    is_h5 = isinstance(source_data, h5py.Dataset)
+    if is_h5:
+        data_transform_func, _, _, _, type_mult = check_dtype(source_data)
+    else:
+        source_data = np.asarray(source_data)
+        data_transform_func = np.asarray
+        type_mult = source_data.dtype.itemsize
+    n_samples = source_data.shape[0]
+
+    use_landmarks = landmark_threshold is not None and n_samples > landmark_threshold and num_landmarks < n_samples
+
+    t0 = time.time()
+    if use_landmarks:
+        landmarks = np.sort(check_random_state(random_state).choice(n_samples, size=num_landmarks, replace=False))
+        if verbose:
+            print('Fitting kernel PCA to {} of {} positions'.format(num_landmarks, n_samples))
+        kpca.fit(data_transform_func(source_data[landmarks]))
+        # Eigenvalues of the landmark kernel scale with the number of positions
+        scree = kpca.lambdas_ * n_samples / num_landmarks
+        fit_data = None
+    else:
+        fit_data = data_transform_func(source_data[()])
+        kpca.fit(fit_data)
+        scree = kpca.lambdas_
+    if verbose:
+        print('Took {} to fit kernel PCA'.format(format_time(time.time() - t0)))
+
+    num_comps = scree.size
+    num_fit = kpca.alphas_.shape[0]
+
+    if is_h5:
+        h5_main = USIDataset(source_data)
+        h5_kpca_group = create_results_group(h5_main, 'Kernel_PCA')
+        write_simple_attrs(h5_kpca_group, kpca.get_params())
+        write_simple_attrs(h5_kpca_group, {'num_landmarks': num_fit, 'last_pixel': n_samples})
+        comp_dim = Dimension('Principal Component', 'a. u.', num_comps)
+        projection = write_main_dataset(h5_kpca_group, (n_samples, num_comps), 'U', 'Abundance', 'a.u.', None,
+                                        comp_dim, h5_pos_inds=h5_main.h5_pos_inds, h5_pos_vals=h5_main.h5_pos_vals,
+                                        dtype=np.float32, chunks=calc_chunks((n_samples, num_comps),
+                                                                             np.float32(0).itemsize))
+    else:
+        projection = np.zeros((n_samples, num_comps), dtype=np.float64)
+
+    # A chunk of the data, its kernel with the fitted positions and its projection:
+    bytes_per_row = source_data.shape[1] * type_mult + (num_fit + num_comps) * np.float64(0).itemsize
+    rows_per_chunk = max(1, int(max_mem_mb * 1024 ** 2 // bytes_per_row))
+
+    loadings = None
+    for pos_slice in gen_batches(n_samples, rows_per_chunk):
+        if use_landmarks:
+            data_chunk = data_transform_func(source_data[pos_slice])
+            proj_chunk = kpca.transform(data_chunk)
+        else:
+            data_chunk = fit_data[pos_slice]
+            proj_chunk = kpca.alphas_[pos_slice] * np.sqrt(kpca.lambdas_)
+        projection[pos_slice] = proj_chunk
+        chunk_loadings = np.dot(proj_chunk.T, data_chunk)
+        loadings = chunk_loadings if loadings is None else loadings + chunk_loadings
+
+    eigenvector = loadings / np.where(scree > 0, scree, np.inf)[:, None]
+
+    if is_h5:
+        eigenvector = stack_real_to_target_dtype(eigenvector, h5_main.dtype)
+        _ = write_main_dataset(h5_kpca_group, eigenvector, 'V', get_attr(h5_main, 'quantity')[0], 'a.u.', comp_dim,
+                               None, h5_spec_inds=h5_main.h5_spec_inds, h5_spec_vals=h5_main.h5_spec_vals)
+        _ = h5_kpca_group.create_dataset('S', data=np.float32(scree))
+
+    return projection, scree, eigenvector
 
 
 def rebuild_svd(h5_main, components=None, cores=None, max_RAM_mb=1024):
@@ -232,6 +461,11 @@ def rebuild_svd(h5_main, components=None, cores=None, max_RAM_mb=1024):
     Rebuild the Image from the SVD results on the windows
     Optionally, only use components less than n_comp.
 
+    The rebuilt dataset is preallocated in the HDF5 file and filled in batches of positions that are computed
+    concurrently on threads (numpy releases the GIL during the matrix products). The number of positions written so
+    far is stored in the 'last_pixel' attribute of the Rebuilt_Data group. Calling this function again with the same
+    components resumes an interrupted reconstruction from that position.
+
     Parameters
     ----------
     h5_main : hdf5 Dataset
@@ -266,13 +500,11 @@ def rebuild_svd(h5_main, components=None, cores=None, max_RAM_mb=1024):
     max_cores = max(1, cpu_count() - 2)
     #         print('max_cores',max_cores)
     if cores is not None:
-        cores = min(round(abs(cores)), max_cores)
+        cores = int(max(1, min(round(abs(cores)), max_cores)))
     else:
         cores = max_cores
 
     max_memory = min(max_RAM_mb * 1024 ** 2, 0.75 * get_available_memory())
-    if cores != 1:
-        max_memory = int(max_memory / 2)
 
     '''
     Get the handles for the SVD results
@@ -291,54 +523,79 @@ def rebuild_svd(h5_main, components=None, cores=None, max_RAM_mb=1024):
 
     func, is_complex, is_compound, n_features, type_mult = check_dtype(h5_V)
 
+    ds_V = np.dot(np.diag(h5_S[comp_slice]), func(h5_V[comp_slice, :]))
+
     '''
-    Calculate the size of a single batch that will fit in the available memory
+    Calculate the size of a single batch that will fit in the available memory.
+    Each thread holds a block of U, the real-valued product and the product in the target dtype.
     '''
     n_comps = h5_S[comp_slice].size
-    mem_per_pix = (h5_U.dtype.itemsize + h5_V.dtype.itemsize * h5_V.shape[1]) * n_comps
-    fixed_mem = h5_main.size * h5_main.dtype.itemsize
-
-    if cores is None:
-        free_mem = max_memory - fixed_mem
-    else:
-        free_mem = max_memory * 2 - fixed_mem
+    mem_per_pix = h5_U.dtype.itemsize * n_comps + ds_V.dtype.itemsize * ds_V.shape[1] + \
+        h5_V.dtype.itemsize * h5_V.shape[1]
+    free_mem = max(max_memory - ds_V.nbytes, mem_per_pix * cores)
 
-    batch_size = int(round(float(free_mem) / mem_per_pix))
-    batch_slices = gen_batches(h5_U.shape[0], batch_size)
+    num_pos = h5_main.shape[0]
+    batch_size = max(1, min(num_pos, int(float(free_mem) / (mem_per_pix * cores))))
 
-    print('Reconstructing in batches of {} positions.'.format(batch_size))
-    print('Batchs should be {} Mb each.'.format(mem_per_pix * batch_size / 1024.0 ** 2))
+    if isinstance(comp_slice, slice):
+        components_used = '{}-{}'.format(comp_slice.start, comp_slice.stop)
+    else:
+        components_used = components
 
     '''
-    Loop over all batches.
+    Resume a partially rebuilt dataset with the same components if one exists.
+    Otherwise, create the Group and preallocate the dataset to hold the rebuilt data
     '''
-    ds_V = np.dot(np.diag(h5_S[comp_slice]), func(h5_V[comp_slice, :]))
-    rebuild = np.zeros((h5_main.shape[0], ds_V.shape[1]))
-    for ibatch, batch in enumerate(batch_slices):
-        rebuild[batch, :] += np.dot(h5_U[batch, comp_slice], ds_V)
+    h5_rebuilt = None
+    start_pos = 0
+    for grp_name in sorted(h5_svd_group.keys()):
+        if not grp_name.startswith('Rebuilt_Data_'):
+            continue
+        h5_grp = h5_svd_group[grp_name]
+        if not np.array_equal(get_attr(h5_grp, 'components_used'), components_used):
+            continue
+        if 'last_pixel' in h5_grp.attrs and h5_grp.attrs['last_pixel'] < num_pos:
+            rebuilt_grp = h5_grp
+            h5_rebuilt = h5_grp['Rebuilt_Data']
+            start_pos = int(h5_grp.attrs['last_pixel'])
+
+    if h5_rebuilt is None:
+        rebuilt_grp = create_indexed_group(h5_svd_group, 'Rebuilt_Data')
+        h5_rebuilt = write_main_dataset(rebuilt_grp, h5_main.shape, 'Rebuilt_Data',
+                                        get_attr(h5_main, 'quantity'), get_attr(h5_main, 'units'),
+                                        None, None,
+                                        h5_pos_inds=h5_main.h5_pos_inds, h5_pos_vals=h5_main.h5_pos_vals,
+                                        h5_spec_inds=h5_main.h5_spec_inds, h5_spec_vals=h5_main.h5_spec_vals,
+                                        dtype=h5_V.dtype, chunks=h5_main.chunks, compression=h5_main.compression)
+        rebuilt_grp.attrs['components_used'] = components_used
+        rebuilt_grp.attrs['last_pixel'] = 0
+        copy_attributes(h5_main, h5_rebuilt, skip_refs=False)
+        h5_main.file.flush()
+    else:
+        print('Resuming reconstruction in {} from position {}.'.format(rebuilt_grp.name, start_pos))
 
-    rebuild = stack_real_to_target_dtype(rebuild, h5_V.dtype)
+    batch_slices = [slice(batch_start, min(batch_start + batch_size, num_pos))
+                    for batch_start in range(start_pos, num_pos, batch_size)]
 
-    print('Completed reconstruction of data from SVD results.  Writing to file.')
-    '''
-    Create the Group and dataset to hold the rebuild data
-    '''
-    rebuilt_grp = create_indexed_group(h5_svd_group, 'Rebuilt_Data')
-    h5_rebuilt = write_main_dataset(rebuilt_grp, rebuild, 'Rebuilt_Data',
-                                    get_attr(h5_main, 'quantity'), get_attr(h5_main, 'units'),
-                                    None, None,
-                                    h5_pos_inds=h5_main.h5_pos_inds, h5_pos_vals=h5_main.h5_pos_vals,
-                                    h5_spec_inds=h5_main.h5_spec_inds, h5_spec_vals=h5_main.h5_spec_vals,
-                                    chunks=h5_main.chunks, compression=h5_main.compression)
-
-    if isinstance(comp_slice, slice):
-        rebuilt_grp.attrs['components_used'] = '{}-{}'.format(comp_slice.start, comp_slice.stop)
-    else:
-        rebuilt_grp.attrs['components_used'] = components
+    print('Reconstructing in batches of {} positions using {} threads.'.format(batch_size, cores))
+    print('Batchs should be {} Mb each.'.format(mem_per_pix * batch_size / 1024.0 ** 2))
 
-    copy_attributes(h5_main, h5_rebuilt, skip_refs=False)
+    def __rebuild_batch(batch):
+        h5_rebuilt[batch] = stack_real_to_target_dtype(np.dot(h5_U[batch, comp_slice], ds_V), h5_V.dtype)
 
-    h5_main.file.flush()
+    '''
+    Loop over all batches, one set of concurrent batches at a time so that the checkpoint always marks a
+    contiguous block of completed positions.
+    '''
+    with Parallel(n_jobs=cores, backend='threading') as parallel:
+        for set_start in range(0, len(batch_slices), cores):
+            cur_batches = batch_slices[set_start: set_start + cores]
+            if cores == 1:
+                __rebuild_batch(cur_batches[0])
+            else:
+                parallel(delayed(__rebuild_batch)(batch) for batch in cur_batches)
+            rebuilt_grp.attrs['last_pixel'] = cur_batches[-1].stop
+            h5_main.file.flush()
 
     print('Done writing reconstructed data to file.')
 
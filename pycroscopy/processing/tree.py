@@ -158,3 +158,166 @@ class ClusterTree(object):
         String representation of the tree structure
         """
         return str(self.tree)
+
+
+class LinkageTree(object):
+    """
+    Array-backed tree representation of a scipy linkage pairing. Useful for clustering.
+
+    Unlike ClusterTree, no Node objects are created. Nodes are referred to by their index in the linkage convention:
+    leaves are numbered 0 to N-1 and the node created by row i of the linkage pairing is numbered N + i. Leaves are
+    laid out such that the leaves under any node are contiguous in leaf_order. Positions are sorted by the rank of
+    their leaf in leaf_order such that the positions within any node are a contiguous slice of one permutation array.
+    """
+
+    def __init__(self, linkage_pairing, labels, distances=None, centroids=None):
+        """
+        Parameters
+        ----------
+        linkage_pairing : 2D unsigned int numpy array or list
+            Linkage pairing that describes a tree structure. Only the first two columns (children) are used.
+            The matrix should result in a single tree apex.
+        labels : 1D unsigned int numpy array or list
+            Labels assigned to each of the positions in the main dataset. Eg. Labels from clustering
+        distances : (Optional) 1D numpy float array or list
+            Distances between clusters
+        centroids : (Optional) 2D numpy array
+            Mean responses for each of the clusters. These will be propagated up
+        """
+        linkage_pairing = np.atleast_2d(linkage_pairing)
+        self.num_leaves = linkage_pairing.shape[0] + 1
+        self.num_nodes = 2 * self.num_leaves - 1
+        self.root = self.num_nodes - 1
+
+        # children of node N + i are in row i
+        self.children = np.array(linkage_pairing[:, :2], dtype=np.int64)
+        self.distances = None if distances is None else np.array(distances)
+
+        self.parents = -1 * np.ones(self.num_nodes, dtype=np.int64)
+        self.parents[self.children.ravel()] = np.repeat(np.arange(self.num_leaves, self.num_nodes), 2)
+
+        # Number of leaves and height of each node. Children always precede their parents in the linkage pairing
+        self.leaf_counts = np.ones(self.num_nodes, dtype=np.int64)
+        self.levels = np.zeros(self.num_nodes, dtype=np.int64)
+        for row, (left, right) in enumerate(self.children):
+            node = row + self.num_leaves
+            self.leaf_counts[node] = self.leaf_counts[left] + self.leaf_counts[right]
+            self.levels[node] = max(self.levels[left], self.levels[right]) + 1
+
+        # Offset of the first leaf of each node within leaf_order. Walk from the apex downwards
+        self.leaf_offsets = np.zeros(self.num_nodes, dtype=np.int64)
+        for row in range(self.children.shape[0] - 1, -1, -1):
+            left, right = self.children[row]
+            offset = self.leaf_offsets[row + self.num_leaves]
+            self.leaf_offsets[left] = offset
+            self.leaf_offsets[right] = offset + self.leaf_counts[left]
+        self.leaf_order = np.zeros(self.num_leaves, dtype=np.int64)
+        self.leaf_order[self.leaf_offsets[:self.num_leaves]] = np.arange(self.num_leaves)
+
+        # now the labels is a giant list of labels assigned for each of the positions.
+        self.labels = np.array(labels, dtype=np.uint32).ravel()
+        leaf_sizes = np.bincount(self.labels, minlength=self.num_leaves)
+        if leaf_sizes.size > self.num_leaves:
+            raise ValueError('labels contain more clusters than the leaves in the linkage pairing')
+
+        # Positions sorted by the rank of their cluster in leaf_order:
+        self.permutation = np.argsort(self.leaf_offsets[self.labels], kind='mergesort')
+        self.__pos_offsets = np.hstack(([0], np.cumsum(leaf_sizes[self.leaf_order])))
+        self.starts = self.__pos_offsets[self.leaf_offsets]
+        self.stops = self.__pos_offsets[self.leaf_offsets + self.leaf_counts]
+
+        self.centroids = None
+        if centroids is not None:
+            self.centroids = self.__propagate_centroids(np.array(centroids), leaf_sizes)
+
+    def __propagate_centroids(self, centroids, leaf_sizes):
+        """
+        Computes the weighted mean of the centroids of the leaves under every node using prefix sums over leaf_order
+        """
+        weighted = centroids[self.leaf_order] * leaf_sizes[self.leaf_order].reshape(-1, *([1] * (centroids.ndim - 1)))
+        prefix = np.concatenate((np.zeros((1,) + centroids.shape[1:], dtype=weighted.dtype),
+                                 np.cumsum(weighted, axis=0)), axis=0)
+        node_sums = prefix[self.leaf_offsets + self.leaf_counts] - prefix[self.leaf_offsets]
+        node_sizes = self.sizes.reshape(-1, *([1] * (centroids.ndim - 1)))
+        node_vals = node_sums / np.maximum(node_sizes, 1)
+        # leaves keep the provided centroids as is
+        node_vals[:self.num_leaves] = centroids
+        return node_vals
+
+    @property
+    def sizes(self):
+        """
+        Number of positions within each node
+        """
+        return self.stops - self.starts
+
+    def get_members(self, node):
+        """
+        Returns the positions within the specified node
+
+        Parameters
+        ----------
+        node : unsigned int
+            Index of the node
+
+        Returns
+        -------
+        members : 1D unsigned int numpy array
+            Positions within this node. These are sorted within each leaf but not across leaves
+        """
+        return self.permutation[self.starts[node]:self.stops[node]]
+
+    def get_leaves(self, node):
+        """
+        Returns the leaves (clusters) under the specified node
+
+        Parameters
+        ----------
+        node : unsigned int
+            Index of the node
+
+        Returns
+        -------
+        leaves : 1D unsigned int numpy array
+            Leaves under this node
+        """
+        return self.leaf_order[self.leaf_offsets[node]:self.leaf_offsets[node] + self.leaf_counts[node]]
+
+    def get_children(self, node):
+        """
+        Returns the children of the specified node
+
+        Parameters
+        ----------
+        node : unsigned int
+            Index of the node
+
+        Returns
+        -------
+        children : 1D unsigned int numpy array
+            Indices of the two children of this node. Empty for leaves
+        """
+        if node < self.num_leaves:
+            return np.array([], dtype=np.int64)
+        return self.children[node - self.num_leaves]
+
+    def get_top_down_order(self):
+        """
+        Returns the order in which nodes should be visited such that each node is visited before its children
+
+        Returns
+        -------
+        order : 1D unsigned int numpy array
+            Node indices starting from the apex of the tree
+        """
+        return np.arange(self.num_nodes)[::-1]
+
+    def __str__(self):
+        """
+        Prints the names of the apex and its children.
+
+        Returns
+        --------
+        String representation of the tree structure
+        """
+        return '({}) --> {},{}'.format(self.root, *self.get_children(self.root))
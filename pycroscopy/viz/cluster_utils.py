@@ -14,6 +14,7 @@ from pyUSID import USIDataset
 from pyUSID.io.hdf_utils import get_attr
 from pyUSID.viz.plot_utils import plot_complex_spectra, plot_map_stack, default_cmap, plot_map, \
     discrete_cmap, plot_line_family, make_scalar_mappable, plot_curves
+from ..processing.cluster import get_cluster_sums
 
 
 def plot_cluster_h5_group(h5_group, labels_kwargs=None, centroids_kwargs=None):
@@ -343,14 +344,9 @@ def plot_cluster_dendrogram(label_mat, e_vals, num_comp, num_cluster, mode='Full
     elif sort_type == 'distance':
         d_sort = sort_mode
 
-    centroid_mat = np.zeros([num_cluster, num_comp])
-    for k1 in range(num_cluster):
-        [i_x, i_y] = np.where(label_mat == k1)
-        u_stack = np.zeros([len(i_x), num_comp])
-        for k2 in range(len(i_x)):
-            u_stack[k2, :] = np.abs(e_vals[i_x[k2], i_y[k2], :num_comp])
-
-        centroid_mat[k1, :] = np.mean(u_stack, 0)
+    sums, counts = get_cluster_sums(np.ravel(label_mat),
+                                    np.abs(e_vals[:, :, :num_comp]).reshape(-1, num_comp), num_cluster)
+    centroid_mat = sums / np.maximum(counts, 1)[:, None]
 
     # Get the distance between cluster means
     distance_mat = scipy.spatial.distance.pdist(centroid_mat)
@@ -360,7 +356,8 @@ def plot_cluster_dendrogram(label_mat, e_vals, num_comp, num_cluster, mode='Full
     linkage_pairing[:, 3] = linkage_pairing[:, 3] / max(linkage_pairing[:, 3])
 
     fig = plt.figure()
-    scipy.cluster.hierarchy.dendrogram(linkage_pairing, p=last, truncate_mode=mode,
+    # p is ignored for full dendrograms but must still be a number
+    scipy.cluster.hierarchy.dendrogram(linkage_pairing, p=last if last else 30, truncate_mode=mode,
                                        count_sort=c_sort, distance_sort=d_sort,
                                        leaf_rotation=90)
 
@@ -32,8 +32,6 @@ requirements = ['numpy>=1.13.0',
                 'pyqt5;python_version>="3.5"',
                 'pyqtgraph>=0.10',
 
-                'numpy_groupies==0.9.7',  # New build of 0.9.8.4 appears to cause build problems
-
                 'numba',
                 'pyUSID',
 
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:19:23 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis.utils.atom_finding import get_nearest_neighbors, fit_atom_positions_parallel, \
+    _map_atom_blocks
+
+rand_state = np.random.RandomState(0)
+
+
+def _sorted_distances(positions, query_positions):
+    distances = np.linalg.norm(query_positions[:, None, :] - positions[None, :, :], axis=-1)
+    return np.argsort(distances, axis=1, kind='mergesort')
+
+
+class TestGetNearestNeighbors(unittest.TestCase):
+
+    def test_matches_distance_matrix(self):
+        # a shuffled lattice has many atoms at equal distances
+        lattice = np.float32(np.indices((9, 11)).reshape(2, -1).T * 2.5)[rand_state.permutation(99)]
+        for positions in [rand_state.rand(200, 2) * 50, lattice]:
+            expected = _sorted_distances(positions, positions)
+            for num_neighbors in [1, 6, 10]:
+                neighbors = get_nearest_neighbors(positions, num_neighbors)
+                self.assertTrue(np.array_equal(neighbors, expected[:, 1:num_neighbors + 1]))
+
+    def test_query_positions(self):
+        lattice = np.indices((5, 5)).reshape(2, -1).T * 2.0
+        query_positions = np.array([[1., 1.], [3.2, 4.9], [20., 20.]])
+        neighbors = get_nearest_neighbors(lattice, 4, query_positions=query_positions)
+        self.assertTrue(np.array_equal(neighbors, _sorted_distances(lattice, query_positions)[:, :4]))
+
+    def test_few_atoms(self):
+        neighbors = get_nearest_neighbors(np.array([[0., 0.], [0., 1.], [3., 0.]]), 6)
+        self.assertTrue(np.array_equal(neighbors, [[1, 2], [0, 2], [0, 1]]))
+
+
+def _block_sums(atom_inds, image, offset):
+    return image[atom_inds].sum(axis=1) + offset
+
+
+class TestFitAtomPositions(unittest.TestCase):
+
+    def test_shared_blocks(self):
+        image = rand_state.rand(23, 5)
+        outputs = _map_atom_blocks(_block_sums, 23, {'image': image}, num_cores=2, offset=1.5)
+        self.assertEqual(len(outputs), 8)
+        results = np.zeros(23)
+        for atom_inds, block_sums in outputs:
+            results[atom_inds] = block_sums
+        self.assertTrue(np.allclose(results, image.sum(axis=1) + 1.5))
+
+    def test_lattice(self):
+        positions = np.indices((4, 4)).reshape(2, -1).T * 7.0 + 5.0
+        rows, cols = np.indices((32, 32))
+        image = np.sum([np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / 4.0) for row, col in positions], axis=0)
+        guesses = positions + rand_state.uniform(-0.5, 0.5, size=positions.shape)
+        parm_dict = {'atom_pos_guess': guesses,
+                     'nearest_neighbors': get_nearest_neighbors(guesses, 2),
+                     'cropped_cleaned_image': image}
+        fitting_parms = {'fit_region_size': 9, 'gauss_width_guess': 2, 'num_nearest_neighbors': 2,
+                         'min_amplitude': 0, 'max_amplitude': 2, 'position_range': 2, 'max_function_evals': 100,
+                         'min_gauss_width_ratio': 0.5, 'max_gauss_width_ratio': 2}
+        guess_parms, fit_parms = fit_atom_positions_parallel(parm_dict, fitting_parms, num_cores=1)
+        self.assertEqual(fit_parms.shape, (16, 3))
+        self.assertTrue(np.allclose(guess_parms[:, 0]['x'], guesses[:, 0]))
+        # interior atoms see all of their neighbors within the fit region
+        interior = np.all(np.logical_and(positions > 5, positions < 26), axis=1)
+        self.assertTrue(np.allclose(fit_parms[interior, 0]['x'], positions[interior, 0], atol=0.05))
+        self.assertTrue(np.allclose(fit_parms[interior, 0]['y'], positions[interior, 1], atol=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
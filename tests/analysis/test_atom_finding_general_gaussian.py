@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:49:19 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis.utils.atom_finding_general_gaussian import gauss2d, gauss2d_stack, fit_gauss2d_stack, \
+    _fit_atom_block
+
+rand_state = np.random.RandomState(0)
+x_vec = np.arange(11, dtype=np.float64)
+x_data = np.broadcast_to(x_vec[None, :, None], (3, 11, 11)).copy()
+y_data = np.broadcast_to(x_vec[None, None, :], (3, 11, 11)).copy()
+
+
+def _get_coeffs(num_regions, num_gauss):
+    # amplitude, x, y, sigma_x, sigma_y, theta, background
+    coeffs = np.zeros((num_regions, num_gauss, 7))
+    coeffs[:, :, 0] = rand_state.uniform(0.5, 1.5, size=(num_regions, num_gauss))
+    coeffs[:, :, 1:3] = rand_state.uniform(3, 7, size=(num_regions, num_gauss, 2))
+    coeffs[:, :, 3:5] = rand_state.uniform(1, 2, size=(num_regions, num_gauss, 2))
+    coeffs[:, :, 5] = rand_state.uniform(0, np.pi, size=(num_regions, num_gauss))
+    coeffs[:, :, 6] = rand_state.uniform(0, 0.1, size=(num_regions, num_gauss))
+    return coeffs
+
+
+class TestGauss2dStack(unittest.TestCase):
+
+    def test_matches_gauss2d(self):
+        coeffs = _get_coeffs(3, 2)
+        model = gauss2d_stack(x_data, y_data, coeffs)
+        for reg_ind in range(3):
+            expected = gauss2d(x_data[reg_ind], y_data[reg_ind], *coeffs[reg_ind], symmetric=False, background=True)
+            self.assertTrue(np.allclose(model[reg_ind], expected))
+
+    def __check_jacobian(self, symmetric):
+        coeffs = _get_coeffs(3, 2)
+        _, jac = gauss2d_stack(x_data, y_data, coeffs, symmetric=symmetric, jacobian=True)
+        for gauss_ind in range(2):
+            for parm_ind in range(7):
+                delta = np.zeros(coeffs.shape)
+                delta[:, gauss_ind, parm_ind] = 1E-6
+                numeric = (gauss2d_stack(x_data, y_data, coeffs + delta, symmetric=symmetric) -
+                           gauss2d_stack(x_data, y_data, coeffs - delta, symmetric=symmetric)) / 2E-6
+                self.assertTrue(np.allclose(jac[:, gauss_ind, parm_ind], numeric, atol=1E-7))
+
+    def test_jacobian(self):
+        self.__check_jacobian(False)
+
+    def test_jacobian_symmetric(self):
+        self.__check_jacobian(True)
+
+
+class TestFitGauss2dStack(unittest.TestCase):
+
+    def test_recovers_coefficients(self):
+        truth = _get_coeffs(3, 1)
+        fit_regions = gauss2d_stack(x_data, y_data, truth)
+        guesses = truth + np.array([0.2, 0.5, -0.5, 0.3, -0.2, 0.1, 0.02])
+        lower_bounds = np.tile([0, 0, 0, 0.5, 0.5, -np.pi, -1], (3, 1, 1))
+        upper_bounds = np.tile([5, 10, 10, 5, 5, 2 * np.pi, 1], (3, 1, 1))
+        coeffs = fit_gauss2d_stack(fit_regions, x_data, y_data, guesses, lower_bounds, upper_bounds)
+        self.assertTrue(np.allclose(gauss2d_stack(x_data, y_data, coeffs), fit_regions, atol=1E-6))
+        self.assertTrue(np.allclose(coeffs[:, :, :3], truth[:, :, :3], atol=1E-4))
+
+    def test_weights_and_bounds(self):
+        truth = _get_coeffs(3, 1)
+        truth[:, :, 4:6] = 0
+        fit_regions = gauss2d_stack(x_data, y_data, truth, symmetric=True)
+        # padding that does not follow the model should be ignored
+        weights = np.ones(fit_regions.shape)
+        weights[:, 9:] = 0
+        fit_regions[:, 9:] = 5
+        guesses = truth + np.array([-0.2, 0.3, 0.3, 0.2, 0, 0, 0])
+        lower_bounds = np.tile([0, 0, 0, 0.5, 0, 0, -1], (3, 1, 1))
+        upper_bounds = np.tile([5, 10, 10, 5, 0, 0, 1], (3, 1, 1))
+        # the amplitude of the first region cannot reach its true value
+        upper_bounds[0, 0, 0] = truth[0, 0, 0] - 0.1
+        coeffs = fit_gauss2d_stack(fit_regions, x_data, y_data, guesses, lower_bounds, upper_bounds,
+                                   weights=weights, symmetric=True)
+        self.assertTrue(np.all(coeffs >= lower_bounds) and np.all(coeffs <= upper_bounds))
+        self.assertAlmostEqual(coeffs[0, 0, 0], upper_bounds[0, 0, 0])
+        self.assertTrue(np.allclose(coeffs[1:], truth[1:], atol=1E-4))
+
+
+class TestFitAtomBlock(unittest.TestCase):
+
+    def setUp(self):
+        self.truth = np.array([[[1, 10, 11, 1.5, 1.5, 0, 0.05]]])
+        rows, cols = np.meshgrid(np.arange(21.), np.arange(21.), indexing='ij')
+        self.image = gauss2d_stack(rows[None], cols[None], self.truth)[0]
+        self.positions = np.array([[10., 11.]])
+        self.guesses = self.truth + np.array([0.2, 0.5, -0.5, 0.3, 0, 0, 0.02])
+        self.lower_bounds = np.array([[[0, 5, 5, 0.5, 0.5, 0, -1]]])
+        self.upper_bounds = np.array([[[5, 15, 15, 5, 5, 0, 1]]])
+
+    def __fit(self, fitting_parms):
+        fitting_parms.update({'fit_region_size': 6, 'symmetric': True})
+        return _fit_atom_block([0], self.positions, self.guesses, self.lower_bounds, self.upper_bounds, self.image,
+                               fitting_parms)
+
+    def test_function_evals_budget(self):
+        # the only function evaluation allowed is at the guess
+        self.assertTrue(np.allclose(self.__fit({'max_function_evals': 1}), self.guesses))
+        self.assertTrue(np.allclose(self.__fit({'max_function_evals': 100}), self.truth, atol=1E-5))
+
+    def test_max_iterations(self):
+        coeffs = self.__fit({'max_function_evals': 1, 'max_iterations': 100})
+        self.assertTrue(np.allclose(coeffs, self.truth, atol=1E-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:53:46 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import pdist, squareform
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis.contrib.atom_finding import label_clusters_2d, cluster_2d_centers, cluster_2d_oleg, \
+    cluster_2d_oleg_return_geo_center, wiener_filter, gaussian_corr_filter, binarize_images, fun_2d_gaussian, \
+    iter_atom_patches, atom_patch_svd, write_atom_patch_scores, run_PCA_atoms
+
+file_path = 'test_contrib_atom_finding.h5'
+
+rand_state = np.random.RandomState(0)
+
+
+def _pairwise_clusters(points, dist_val):
+    # Links every pair of pixels within dist_val of each other
+    links = squareform(pdist(points, 'cityblock')) <= dist_val
+    return connected_components(links, directed=False)[1]
+
+
+class TestLabelClusters2d(unittest.TestCase):
+
+    def test_matches_pairwise_linking(self):
+        for dist_val in [0.5, 1, 1.5, 2, 3, 4.7]:
+            image = rand_state.rand(30, 25) < 0.15
+            points, labels, num_clusters = label_clusters_2d(image, dist_val)
+            self.assertTrue(np.array_equal(points, np.argwhere(image)))
+            expected = _pairwise_clusters(points, dist_val)
+            self.assertEqual(num_clusters, expected.max() + 1)
+            # same partition of the pixels, with clusters numbered by their first pixel
+            _, first_inds = np.unique(expected, return_index=True)
+            self.assertTrue(np.array_equal(labels[np.sort(first_inds)], np.arange(num_clusters)))
+            self.assertTrue(np.array_equal(labels[:, None] == labels[None, :], expected[:, None] == expected[None, :]))
+
+    def test_centers_and_sizes(self):
+        image = np.zeros((9, 10))
+        image[1:3, 1:4] = 1
+        image[1, 5] = 1
+        image[6, 2] = 1
+        image[7, 3:5] = 1
+        image[8, 9] = 1
+        centers, sizes = cluster_2d_centers(image, 2)
+        self.assertTrue(np.array_equal(sizes, [7, 3, 1]))
+        self.assertTrue(np.allclose(centers, [[10 / 7, 17 / 7], [20 / 3, 3], [8, 9]]))
+
+        clusters = cluster_2d_oleg(image, 2)
+        self.assertEqual([len(clust) for clust in clusters], [7, 3, 1])
+        self.assertEqual(clusters[2], [[8, 9]])
+        self.assertTrue(np.allclose(cluster_2d_oleg_return_geo_center(image, 2), centers[:2]))
+
+    def test_empty_image(self):
+        centers, sizes = cluster_2d_centers(np.zeros((5, 5)), 3)
+        self.assertEqual(centers.shape, (0, 2))
+        self.assertEqual(sizes.size, 0)
+        self.assertEqual(cluster_2d_oleg(np.zeros((5, 5)), 3), [])
+
+
+class TestWienerFilter(unittest.TestCase):
+
+    def test_matches_full_fft(self):
+        image = rand_state.rand(12, 9) + 10
+        blur_mat = (1.1 / 2 * np.pi) ** (-1.1 * np.sqrt(np.arange(12)[:, None] ** 2 + np.arange(9)[None, :] ** 2))
+        blur_fft = np.fft.fft2(blur_mat / np.sum(blur_mat))
+        filtered = []
+        for noise in np.linspace(.001, 1, 100):
+            filtered.append(np.abs(np.fft.ifft2(np.conj(blur_fft) / (np.abs(blur_fft) ** 2 + noise) *
+                                                np.fft.fft2(image))))
+        expected = filtered[np.argmin([np.std(mat) for mat in filtered])]
+        self.assertTrue(np.allclose(wiener_filter(image), expected))
+
+    def test_stack(self):
+        stack = rand_state.rand(2, 3, 12, 9)
+        filtered = wiener_filter(stack, noise_levels=[0.01, 0.1, 1])
+        self.assertEqual(filtered.shape, stack.shape)
+        self.assertTrue(np.allclose(filtered[1, 2], wiener_filter(stack[1, 2], noise_levels=[0.01, 0.1, 1])))
+
+
+class TestGaussianCorrFilter(unittest.TestCase):
+
+    def test_matches_corrcoef(self):
+        image = rand_state.rand(11, 8) + 100
+        box = 3
+        corr = gaussian_corr_filter(image, 1.5, box)
+        for row in range(11):
+            for col in range(8):
+                rows = np.arange(max(row - box, 0), min(row + box + 1, 11))
+                cols = np.arange(max(col - box, 0), min(col + box + 1, 8))
+                gaus = fun_2d_gaussian(cols[None, :] - col, rows[:, None] - row, [1, 0, 0, 1.5, 1.5, 0])
+                expected = np.corrcoef(gaus.ravel(), image[np.ix_(rows, cols)].ravel())[0, 1]
+                self.assertAlmostEqual(corr[row, col], expected)
+
+    def test_stack(self):
+        stack = rand_state.rand(3, 11, 8)
+        corr = gaussian_corr_filter(stack, 2, 4)
+        for image, expected in zip(stack, corr):
+            self.assertTrue(np.allclose(gaussian_corr_filter(image, 2, 4), expected))
+
+
+class TestBinarizeImages(unittest.TestCase):
+
+    def test_thresholds(self):
+        image = rand_state.rand(6, 5)
+        thresholds = [0.2, 0.5, 0.9]
+        binary = binarize_images(image, thresholds)
+        self.assertEqual(binary.shape, (3, 6, 5))
+        for thresh, mat in zip(thresholds, binary):
+            self.assertTrue(np.array_equal(mat, image > thresh))
+
+
+class TestAtomPatchPCA(unittest.TestCase):
+
+    def setUp(self):
+        self.image = rand_state.rand(30, 26)
+        inner = np.vstack((rand_state.uniform(3, 27, size=40), rand_state.uniform(3, 23, size=40))).T
+        self.positions = np.vstack((inner, [[1.2, 5], [28.7, 25.6]]))
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __get_patches(self, box_width):
+        padded = np.pad(self.image, box_width, mode='constant')
+        patches = []
+        for row, col in np.round(self.positions).astype(int) + box_width:
+            patches.append(padded[row - box_width: row + box_width, col - box_width: col + box_width].ravel())
+        return np.array(patches)
+
+    def test_patches(self):
+        batches = list(iter_atom_patches(self.image, self.positions, 3, batch_size=15))
+        self.assertEqual([batch.shape for batch in batches], [(15, 6, 6), (15, 6, 6), (12, 6, 6)])
+        self.assertTrue(np.array_equal(np.vstack(batches).reshape(42, -1), self.__get_patches(3)))
+
+    def test_matches_svd(self):
+        patches = self.__get_patches(2)
+        S, V = atom_patch_svd(self.image, self.positions, 2, batch_size=10)
+        exp_u, exp_s, exp_v = np.linalg.svd(patches, full_matrices=False)
+        self.assertTrue(np.allclose(S, exp_s))
+        # singular vectors are only defined up to their sign
+        signs = np.sign(np.sum(V * exp_v, axis=1))
+        self.assertTrue(np.allclose(V * signs[:, None], exp_v))
+
+        scores = np.zeros((42, 16))
+        write_atom_patch_scores(scores, self.image, self.positions, 2, S, V, batch_size=10)
+        self.assertTrue(np.allclose(scores * signs, exp_u))
+
+    def test_ideal_lattice(self):
+        # every window of a perfect lattice is identical, so only one component is meaningful
+        x_vec = np.arange(30)
+        lattice = np.cos(2 * np.pi * x_vec[:, None] / 5) * np.cos(2 * np.pi * x_vec[None, :] / 5) + 2
+        rows, cols = np.meshgrid(np.arange(5, 26, 5), np.arange(5, 26, 5), indexing='ij')
+        positions = np.vstack((rows.ravel(), cols.ravel())).T
+        S, V = atom_patch_svd(lattice, positions, 3, batch_size=7)
+        patch = lattice[2:8, 2:8].ravel()
+        self.assertAlmostEqual(S[0], np.linalg.norm(patch) * 5)
+        self.assertTrue(np.all(S[1:] == 0))
+
+        scores = np.zeros((25, 25))
+        write_atom_patch_scores(scores, lattice, positions, 3, S, V, batch_size=7)
+        self.assertTrue(np.allclose(np.abs(scores[:, 0]), 0.2))
+        self.assertTrue(np.all(scores[:, 1:] == 0))
+        self.assertTrue(np.allclose(np.dot(scores * S, V), np.tile(patch, (25, 1))))
+
+    def __write_frame(self, h5_f):
+        num_rows, num_cols = self.image.shape
+        h5_chan = h5_f.create_group('Frame_0000/Channel_Current/Filter_Step_0000')
+        h5_pos_inds = h5_chan.create_dataset('Position_Indices', data=np.vstack(np.unravel_index(
+            np.arange(num_rows * num_cols), self.image.shape)).T + 1)
+        h5_spec_inds = h5_chan.create_dataset('Spectroscopic_Indices', data=[1])
+        h5_image = h5_chan.create_dataset('Filtered_Image', data=self.image.reshape(-1, 1))
+        h5_image.attrs['Position_Indices'] = h5_pos_inds.ref
+        h5_image.attrs['Position_Indices_Region'] = h5_pos_inds.regionref[0:num_rows * num_cols, 0:2]
+        h5_image.attrs['Spectroscopic_Indices'] = h5_spec_inds.ref
+        h5_image.attrs['Spectroscopic_Indices_Region'] = h5_spec_inds.regionref[0:1]
+        h5_f.create_group('Frame_0000/Channel_Finished/Filter_Step_0000/Lattice')
+        h5_f['Frame_0000/Channel_Finished/Filter_Step_0000/Lattice/Positions'] = self.positions
+
+    def test_run_pca_atoms(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            self.__write_frame(h5_f)
+        run_PCA_atoms(file_path, 0, 3, batch_size=8)
+        with h5py.File(file_path, mode='r') as h5_f:
+            h5_grp = h5_f['Frame_0000/Channel_Finished/Filter_Step_0000/Lattice/Analysis_0000']
+            scores = h5_grp['Analysis_Data_01_U'][()]
+            S = h5_grp['Analysis_Data_02_S'][()]
+            V = h5_grp['Analysis_Data_03_V'][()]
+            atom_inds = h5_grp['Position_Indices_01'][()]
+        # only the atoms whose windows fit within the image
+        self.assertTrue(np.array_equal(atom_inds[:, 0], np.arange(1, 41)))
+        self.assertEqual(scores.shape, (40, 36))
+        self.assertEqual(V.shape, (36, 36))
+        self.assertTrue(np.allclose(np.dot(scores * S, V), self.__get_patches(3)[:40]))
+
+
+if __name__ == '__main__':
+    unittest.main()
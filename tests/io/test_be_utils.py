@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:37:32 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset, link_h5_objects_as_attrs
+from pyUSID.io.write_utils import Dimension
+from pycroscopy.io.translators.df_utils.be_utils import BEHistogram, group_bins_by_step, get_bins_for_steps
+
+file_path = 'test_be_utils.h5'
+
+num_freqs = 8
+num_steps = 5
+num_pos = 60
+
+
+def _write_be_dataset(h5_f):
+    rand_state = np.random.RandomState(0)
+    data = rand_state.randn(num_pos, num_freqs * num_steps) + 1j * rand_state.randn(num_pos, num_freqs * num_steps)
+    h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+    h5_main = write_main_dataset(h5_grp, np.complex64(data), 'Raw_Data', 'Piezoresponse', 'V',
+                                 Dimension('X', 'm', num_pos),
+                                 [Dimension('Frequency', 'Hz', num_freqs), Dimension('UDVS_Step', 'a.u.', num_steps)])
+    h5_udvs_inds = h5_grp.create_dataset('UDVS_Indices', data=np.repeat(np.arange(num_steps), num_freqs))
+    h5_bin_freqs = h5_grp.create_dataset('Bin_Frequencies', data=np.tile(np.arange(num_freqs, dtype=np.float32),
+                                                                         num_steps))
+    link_h5_objects_as_attrs(h5_main, [h5_udvs_inds, h5_bin_freqs])
+    return h5_main
+
+
+class TestBEHistogram(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_plot_group_hist(self):
+        active_bins = np.arange(num_freqs, 4 * num_freqs)
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = _write_be_dataset(h5_f)
+            data = h5_main[()]
+            hist = BEHistogram()
+            # tiny memory budget to force several blocks of pixels
+            hist_mat, hist_labels, hist_indices, _ = hist.buildPlotGroupHist(h5_main, active_bins, max_mem_mb=0.002,
+                                                                             num_samples=num_pos, cores=2)
+
+        max_resp = np.amax(np.abs(data), axis=0)
+        min_resp = np.amin(np.abs(data), axis=0)
+        max_resp = np.mean(max_resp) + 3 * np.std(max_resp)
+        min_resp = np.mean(min_resp) - 3 * np.std(min_resp)
+
+        # Brute force histogram of the phase for comparison
+        exp_phase = np.zeros((num_freqs, hist.N_y_bins), dtype=np.int32)
+        for bin_ind in active_bins:
+            y_inds = np.rint((np.angle(data[:, bin_ind]) + np.pi) / (2 * np.pi) * (hist.N_y_bins - 1)).astype(int)
+            np.add.at(exp_phase[bin_ind % num_freqs], y_inds, 1)
+
+        self.assertEqual(hist_labels, ['Amplitude', 'Phase', 'Real Part', 'Imaginary Part'])
+        self.assertTrue(np.allclose([hist.max_response, hist.min_response], [max_resp, min_resp]))
+        self.assertTrue(np.all(np.sum(hist_mat, axis=1) == num_pos * active_bins.size))
+        self.assertTrue(np.array_equal(hist_mat[1], exp_phase.ravel()))
+        self.assertTrue(np.array_equal(hist_indices[0], np.tile(np.arange(hist.N_y_bins), num_freqs)))
+        self.assertTrue(np.array_equal(hist_indices[1], np.repeat(np.arange(num_freqs), hist.N_y_bins)))
+
+    def test_add_be_hist(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = _write_be_dataset(h5_f)
+            # plot group made of UDVS steps 1 to 3. Other steps are empty (NaN) cells in the UDVS table
+            udvs = np.full((num_steps, 2), np.nan)
+            udvs[:, 0] = np.arange(num_steps)
+            udvs[1:4, 1] = 1
+            h5_udvs = h5_main.parent.create_dataset('UDVS', data=udvs)
+            h5_udvs.attrs['in_field'] = h5_udvs.regionref[:, 1]
+            h5_plot_grp = h5_main.parent.create_group('Spectroscopic_Plot_Group_000')
+            h5_plot_grp.attrs['Name'] = 'in_field'
+            h5_plot_grp.create_dataset('Mean_Spectrogram', data=np.zeros((3, num_freqs)))
+            exp_hist = BEHistogram().buildPlotGroupHist(h5_main, np.arange(num_freqs, 4 * num_freqs), cores=1)[0]
+
+        BEHistogram().addBEHist(file_path, show_plot=False, save_plot=False, cores=1)
+
+        with h5py.File(file_path, mode='r') as h5_f:
+            hist_mat = h5_f['Measurement_000/Channel_000/Spectroscopic_Plot_Group_000/Histograms'][()]
+        self.assertTrue(np.all(np.sum(hist_mat, axis=1) == num_pos * 3 * num_freqs))
+        self.assertTrue(np.array_equal(hist_mat, exp_hist))
+
+
+class TestStepBinGroups(unittest.TestCase):
+
+    def test_matches_where(self):
+        udvs_inds = np.repeat(np.arange(num_steps), num_freqs)
+        step_bin_groups = group_bins_by_step(udvs_inds)
+        steps = [1, 3, 4]
+        expected = np.hstack([np.where(udvs_inds == step)[0] for step in steps])
+        self.assertTrue(np.array_equal(get_bins_for_steps(step_bin_groups, steps), expected))
+
+    def test_unsorted_and_missing_steps(self):
+        step_bin_groups = group_bins_by_step(np.array([3, 1, 3, 1, 5, 3, 0]))
+        self.assertTrue(np.array_equal(get_bins_for_steps(step_bin_groups, [3, 2, 1, 7]), [0, 2, 5, 1, 3]))
+        self.assertEqual(get_bins_for_steps(step_bin_groups, []).size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:26:38 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+from sklearn.cluster import AgglomerativeClustering, KMeans, MiniBatchKMeans
+from sklearn.feature_extraction.image import grid_to_graph
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pycroscopy.processing.cluster import Cluster, get_grid_connectivity, get_cluster_statistics, \
+    reorder_clusters, get_cluster_sums
+
+file_path = 'test_cluster.h5'
+
+num_rows = 12
+num_cols = 10
+num_spec = 16
+
+
+def _get_domain_data():
+    # Left and right halves of the map have distinct responses
+    rand_state = np.random.RandomState(0)
+    responses = np.vstack((np.sin(np.linspace(0, np.pi, num_spec)), np.linspace(-1, 1, num_spec)))
+    domains = np.zeros((num_rows, num_cols), dtype=np.int64)
+    domains[:, num_cols // 2:] = 1
+    data = responses[domains.ravel()] + 0.05 * rand_state.randn(num_rows * num_cols, num_spec)
+    return np.float32(data), domains.ravel()
+
+
+class TestGetGridConnectivity(unittest.TestCase):
+
+    def test_matches_grid_to_graph(self):
+        rows, cols = np.unravel_index(np.arange(num_rows * num_cols), (num_rows, num_cols))
+        conn = get_grid_connectivity(np.vstack((cols, rows)).T)
+        expected = grid_to_graph(num_rows, num_cols).tocsr()
+        expected.setdiag(0)
+        expected.eliminate_zeros()
+        self.assertTrue(np.array_equal(conn.toarray() > 0, expected.toarray() > 0))
+
+    def test_shuffled_and_missing_positions(self):
+        pos_inds = np.array([[2, 0], [0, 0], [1, 0], [0, 1], [2, 1]])
+        conn = get_grid_connectivity(pos_inds).toarray()
+        expected_pairs = {(0, 2), (1, 2), (1, 3), (0, 4)}
+        pairs = set(zip(*np.nonzero(np.triu(conn))))
+        self.assertEqual(pairs, expected_pairs)
+        self.assertTrue(np.array_equal(conn, conn.T))
+
+
+class TestSpatialCluster(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __write_dataset(self, h5_f):
+        data, domains = _get_domain_data()
+        h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+        h5_main = write_main_dataset(h5_grp, data, 'Raw_Data', 'Current', 'nA',
+                                     [Dimension('X', 'm', num_cols), Dimension('Y', 'm', num_rows)],
+                                     Dimension('Bias', 'V', num_spec))
+        return h5_main, data, domains
+
+    def test_spatial_ward_with_svd(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main, data, domains = self.__write_dataset(h5_f)
+            proc = Cluster(h5_main, AgglomerativeClustering(n_clusters=2), spatial_connectivity=True,
+                           num_svd_comps=4)
+            h5_grp = proc.compute()
+            labels = np.squeeze(h5_grp['Labels'][()])
+            mean_resp = h5_grp['Mean_Response'][()]
+            self.assertEqual(h5_grp.attrs['connectivity'], 'position_grid')
+            self.assertEqual(h5_grp.attrs['svd_components'], 4)
+
+        # Each domain maps to exactly one cluster
+        self.assertEqual(len(np.unique(labels[domains == 0])), 1)
+        self.assertEqual(len(np.unique(labels[domains == 1])), 1)
+        self.assertNotEqual(labels[domains == 0][0], labels[domains == 1][0])
+        for clust_ind in range(2):
+            self.assertTrue(np.allclose(mean_resp[clust_ind], np.mean(data[labels == clust_ind], axis=0),
+                                        atol=1E-5))
+
+    def test_connectivity_only_for_agglomerative(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main, _, _ = self.__write_dataset(h5_f)
+            with self.assertRaises(TypeError):
+                _ = Cluster(h5_main, KMeans(n_clusters=2), spatial_connectivity=True)
+
+
+class TestStreamedCluster(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __write_dataset(self, h5_f):
+        # 4 kB per position so that 1 MB holds 256 of the 300 positions
+        rand_state = np.random.RandomState(0)
+        responses = rand_state.rand(4, 1024)
+        domains = rand_state.randint(0, 4, size=300)
+        data = np.float32(responses[domains] + 0.5 * rand_state.randn(300, 1024))
+        h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+        return write_main_dataset(h5_grp, data, 'Raw_Data', 'Current', 'nA',
+                                  [Dimension('X', 'm', 20), Dimension('Y', 'm', 15)],
+                                  Dimension('Bias', 'V', 1024))
+
+    def test_matches_in_memory(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = self.__write_dataset(h5_f)
+            exp_labels, exp_mean_resp = Cluster(h5_main, KMeans(n_clusters=4, random_state=0)).test()
+            proc = Cluster(h5_main, MiniBatchKMeans(n_clusters=4, batch_size=20, random_state=0), max_mem_mb=1,
+                           cores=1)
+            self.assertEqual(len(list(proc._get_batches())), 2)
+            labels, mean_resp = proc.test()
+
+        # same clusters, possibly numbered differently
+        labels = labels.ravel()
+        exp_labels = exp_labels.ravel()
+        self.assertTrue(np.array_equal(labels[:, None] == labels[None, :], exp_labels[:, None] == exp_labels[None, :]))
+        for clust_ind in range(4):
+            exp_ind = exp_labels[labels == clust_ind][0]
+            self.assertTrue(np.allclose(mean_resp[clust_ind], exp_mean_resp[exp_ind], atol=1E-5))
+
+
+class TestReorderClusters(unittest.TestCase):
+
+    def test_matches_linkage_order(self):
+        rand_state = np.random.RandomState(0)
+        mean_resp = rand_state.rand(9, 5)
+        labels = rand_state.randint(0, 9, size=300).astype(np.uint32)
+        new_labels, new_mean_resp = reorder_clusters(labels, mean_resp)
+
+        linkage_pairing = linkage(pdist(mean_resp), 'weighted')
+        order = [int(ind) for ind in linkage_pairing[:, :2].ravel() if ind < 9]
+        self.assertEqual(new_labels.dtype, labels.dtype)
+        for new_ind, old_ind in enumerate(order):
+            self.assertTrue(np.array_equal(new_labels == new_ind, labels == old_ind))
+            self.assertTrue(np.array_equal(new_mean_resp[new_ind], mean_resp[old_ind]))
+
+
+class TestGetClusterStatistics(unittest.TestCase):
+
+    def setUp(self):
+        rand_state = np.random.RandomState(0)
+        self.labels = rand_state.randint(0, 6, size=500)
+        self.data = rand_state.randn(500, 8) + self.labels[:, None]
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __check(self, counts, mean_resp, std_resp, distances):
+        # Cluster 6 is empty
+        self.assertEqual(counts[6], 0)
+        for clust_ind in range(6):
+            members = self.data[self.labels == clust_ind]
+            self.assertEqual(counts[clust_ind], members.shape[0])
+            self.assertTrue(np.allclose(mean_resp[clust_ind], np.mean(members, axis=0)))
+            self.assertTrue(np.allclose(std_resp[clust_ind], np.std(members, axis=0)))
+        self.assertTrue(np.allclose(distances, np.linalg.norm(self.data - mean_resp[self.labels], axis=1)))
+
+    def test_in_memory(self):
+        self.__check(*get_cluster_statistics(self.labels, self.data, num_clusters=7))
+
+    def test_float_labels(self):
+        self.__check(*get_cluster_statistics(np.float64(self.labels), self.data, num_clusters=7))
+        sums, counts = get_cluster_sums(np.array([0., 1., 2., 1.]), np.arange(8.).reshape(4, 2), 3)
+        self.assertTrue(np.array_equal(counts, [1, 2, 1]))
+        self.assertTrue(np.array_equal(sums, [[0, 1], [8, 10], [4, 5]]))
+        with self.assertRaises(ValueError):
+            _ = get_cluster_sums(np.array([0., 1.5]), np.ones((2, 2)), 3)
+
+    def test_h5_chunks(self):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_labels = h5_f.create_dataset('Labels', data=self.labels.reshape(-1, 1))
+            h5_data = h5_f.create_dataset('Data', data=self.data)
+            # tiny memory budget to force several chunks
+            self.__check(*get_cluster_statistics(h5_labels, h5_data, num_clusters=7, max_mem_mb=0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 00:27:24 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+from sklearn.decomposition import IncrementalPCA, PCA, NMF
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pycroscopy.processing.decomposition import Decomposition
+
+file_path = 'test_decomposition.h5'
+
+num_rows = 20
+num_cols = 15
+num_spec = 1024
+num_comps = 3
+
+
+def _get_low_rank_data():
+    # Positive mixtures of a few endmembers so that a handful of components describe the data exactly
+    rand_state = np.random.RandomState(0)
+    endmembers = rand_state.rand(num_comps, num_spec)
+    abundances = rand_state.rand(num_rows * num_cols, num_comps)
+    return np.float32(np.dot(abundances, endmembers))
+
+
+def _get_signs(components, expected):
+    # components are only defined up to their sign
+    return np.sign(np.sum(components * expected, axis=1))
+
+
+class TestDecomposition(unittest.TestCase):
+
+    def setUp(self):
+        self.data = _get_low_rank_data()
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+            write_main_dataset(h5_grp, self.data, 'Raw_Data', 'Current', 'nA',
+                               [Dimension('X', 'm', num_cols), Dimension('Y', 'm', num_rows)],
+                               Dimension('Bias', 'V', num_spec))
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_streamed_compute(self):
+        expected = PCA(n_components=num_comps).fit(self.data)
+        with h5py.File(file_path, mode='r+') as h5_f:
+            h5_main = h5_f['Measurement_000/Channel_000/Raw_Data']
+            # 1 MB holds 256 of the 4 kB positions, so the dataset is read in two chunks
+            proc = Decomposition(h5_main, IncrementalPCA(n_components=num_comps), max_mem_mb=1, cores=1)
+            self.assertEqual(len(proc._get_batches()), 2)
+            h5_grp = proc.compute()
+            components = h5_grp['Components'][()]
+            projection = h5_grp['Projection'][()]
+
+        signs = _get_signs(components, expected.components_)
+        self.assertTrue(np.allclose(components * signs[:, None], expected.components_, atol=1E-4))
+        self.assertTrue(np.allclose(projection * signs, expected.transform(self.data), atol=1E-3))
+
+    def test_streamed_test(self):
+        expected = PCA(n_components=num_comps).fit(self.data)
+        with h5py.File(file_path, mode='r+') as h5_f:
+            h5_main = h5_f['Measurement_000/Channel_000/Raw_Data']
+            proc = Decomposition(h5_main, IncrementalPCA(n_components=num_comps), max_mem_mb=1, cores=1)
+            components, projection = proc.test()
+        self.assertEqual(components.shape, (num_comps, num_spec))
+        self.assertEqual(projection.shape, (num_cols, num_rows, num_comps))
+        signs = _get_signs(components, expected.components_)
+        # the N-dimensional form is arranged as [X, Y, component] while X varies fastest in the file
+        projection = np.swapaxes(projection, 0, 1).reshape(-1, num_comps)
+        self.assertTrue(np.allclose(projection * signs, expected.transform(self.data), atol=1E-3))
+
+    def test_single_pass_nmf(self):
+        expected = NMF(n_components=num_comps, random_state=0)
+        exp_projection = expected.fit_transform(self.data)
+        with h5py.File(file_path, mode='r+') as h5_f:
+            h5_main = h5_f['Measurement_000/Channel_000/Raw_Data']
+            proc = Decomposition(h5_main, NMF(n_components=num_comps, random_state=0), max_mem_mb=1, cores=1)
+            h5_grp = proc.compute()
+            components = h5_grp['Components'][()]
+            projection = h5_grp['Projection'][()]
+        self.assertTrue(np.allclose(components, expected.components_, rtol=1E-4, atol=1E-5))
+        self.assertTrue(np.allclose(projection, exp_projection, rtol=1E-3, atol=1E-4))
+
+    def test_existing_results(self):
+        with h5py.File(file_path, mode='r+') as h5_f:
+            h5_main = h5_f['Measurement_000/Channel_000/Raw_Data']
+            h5_grp = Decomposition(h5_main, IncrementalPCA(n_components=num_comps), max_mem_mb=1,
+                                   cores=1).compute()
+            proc = Decomposition(h5_main, IncrementalPCA(n_components=num_comps), max_mem_mb=1, cores=1)
+            self.assertEqual(proc.compute().name, h5_grp.name)
+            components, _ = proc.test()
+            self.assertTrue(np.array_equal(components, h5_grp['Components'][()]))
+            self.assertNotEqual(proc.compute(override=True).name, h5_grp.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Created on Sun Oct 18 22:03:29 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import sys
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.processing import fft
+
+
+class TestFilterCache(unittest.TestCase):
+
+    def setUp(self):
+        fft.filter_cache.clear()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        fft.filter_cache.clear()
+        fft.filter_cache.cache_dir = None
+        shutil.rmtree(self.cache_dir)
+
+    def test_lru_eviction(self):
+        cache = fft.FilterCache(max_size=2)
+        for ind in range(3):
+            _ = cache.fetch(('key', ind), lambda: np.arange(4))
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(('key', 0) in cache)
+        self.assertTrue(('key', 2) in cache)
+
+    def test_fetch_returns_copies(self):
+        cache = fft.FilterCache()
+        first = cache.fetch('key', lambda: np.ones(4))
+        first[0] = 5
+        second = cache.fetch('key', lambda: np.zeros(4))
+        self.assertTrue(np.allclose(second, np.ones(4)))
+
+    def test_disk_tier(self):
+        cache = fft.FilterCache(max_size=0, cache_dir=self.cache_dir)
+        _ = cache.fetch('key', lambda: np.arange(4))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        value = cache.fetch('key', lambda: np.zeros(4))
+        self.assertTrue(np.allclose(value, np.arange(4)))
+        cache.clear(remove_files=True)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 0)
+
+    def test_filter_reused(self):
+        lpf_1 = fft.LowPassFilter(1000, 1E+4, 2E+3)
+        lpf_2 = fft.LowPassFilter(1000, 1E+4, 2E+3)
+        self.assertEqual(lpf_1.get_cache_key(), lpf_2.get_cache_key())
+        self.assertEqual(len(fft.filter_cache), 1)
+        self.assertTrue(np.allclose(lpf_1.value, lpf_2.value))
+
+    def test_composite_order_independent(self):
+        lpf = fft.LowPassFilter(1000, 1E+4, 2E+3)
+        nbf = fft.NoiseBandFilter(1000, 1E+4, [1E+3], [1E+2])
+        comp_1 = fft.build_composite_freq_filter([lpf, nbf])
+        comp_2 = fft.build_composite_freq_filter([nbf, lpf])
+        self.assertEqual(len(fft.filter_cache), 3)
+        self.assertTrue(np.allclose(comp_1, lpf.value * nbf.value))
+        self.assertTrue(np.allclose(comp_1, comp_2))
+
+
+class TestHarmonicPassFilter(unittest.TestCase):
+
+    def test_bands(self):
+        signal_length = 1000
+        hpf = fft.HarmonicPassFilter(signal_length, 1E+4, 1E+3, 2E+2, 3)
+        cent = signal_length // 2
+        sz = int(round(cent * 2E+2 / 1E+4))
+        expected = np.zeros(signal_length, dtype=np.int16)
+        for harm_ind in range(1, 4):
+            ind = int(round(signal_length * harm_ind * 1E+3 / 1E+4))
+            expected[cent - ind - sz: cent - ind + sz + 1] = 1
+            expected[cent + ind - sz: cent + ind + sz + 1] = 1
+        self.assertEqual(hpf.value.dtype, np.int16)
+        self.assertTrue(np.array_equal(hpf.value, expected))
+
+    def test_invalid_first_harmonic(self):
+        with self.assertRaises(ValueError):
+            _ = fft.HarmonicPassFilter(1000, 1E+4, 2E+4, 2E+2, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:34:08 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.processing.histogram import build_histogram, HistogramAccumulator
+
+num_pos = 40
+num_x_bins = 12
+num_y_bins = 9
+rand_state = np.random.RandomState(0)
+data = rand_state.randn(num_pos, num_x_bins) + 1j * rand_state.randn(num_pos, num_x_bins)
+
+
+def _loop_histogram(x_inds, values, min_resp, max_resp):
+    hist = np.zeros((num_x_bins, num_y_bins), dtype=np.int64)
+    scaled = (np.clip(values, min_resp, max_resp) - min_resp) / (max_resp - min_resp)
+    for x_ind, y_val in zip(np.ravel(x_inds), np.ravel(scaled)):
+        hist[x_ind, int(np.rint(y_val * (num_y_bins - 1)))] += 1
+    return hist
+
+
+class TestBuildHistogram(unittest.TestCase):
+
+    def test_counts(self):
+        x_inds = np.tile(np.arange(num_x_bins), num_pos)
+        hist = build_histogram(x_inds, data, num_x_bins, num_y_bins, 1, 0, 2.5, np.abs)
+        self.assertEqual(hist.dtype, np.int32)
+        self.assertTrue(np.array_equal(hist, _loop_histogram(x_inds, np.abs(data), 0, 2.5)))
+
+    def test_scalar_weight(self):
+        x_inds = np.tile(np.arange(num_x_bins), num_pos)
+        hist = build_histogram(x_inds, data, num_x_bins, num_y_bins, 2, -np.pi, np.pi, np.angle)
+        self.assertTrue(np.array_equal(hist, 2 * _loop_histogram(x_inds, np.angle(data), -np.pi, np.pi)))
+
+
+class TestHistogramAccumulator(unittest.TestCase):
+
+    def test_chunks_and_merge(self):
+        expected = _loop_histogram(np.tile(np.arange(num_x_bins), num_pos), np.real(data), -2, 2)
+
+        accum = HistogramAccumulator(num_x_bins, num_y_bins, -2, 2, func=np.real)
+        for start in range(0, num_pos, 15):
+            accum.add(np.arange(num_x_bins), data[start: start + 15])
+        self.assertTrue(np.array_equal(accum.histogram, expected))
+
+        # Partial histograms from two workers
+        first = HistogramAccumulator(num_x_bins, num_y_bins, -2, 2, func=np.real).add(np.arange(num_x_bins),
+                                                                                       data[:10])
+        second = HistogramAccumulator(num_x_bins, num_y_bins, -2, 2, func=np.real).add(np.arange(num_x_bins),
+                                                                                        data[10:])
+        self.assertTrue(np.array_equal(first.merge(second).histogram, expected))
+
+    def test_merge_different_bins(self):
+        accum = HistogramAccumulator(num_x_bins, num_y_bins, -2, 2)
+        with self.assertRaises(ValueError):
+            accum.merge(HistogramAccumulator(num_x_bins, num_y_bins, -1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:41:57 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pycroscopy.processing.image_processing import ImageWindow, get_window_view, overlap_add_windows, \
+    radial_profile
+from pycroscopy.processing.svd_utils import SVD
+
+file_path = 'test_image_processing.h5'
+
+rand_state = np.random.RandomState(0)
+image = rand_state.rand(20, 17)
+
+
+class TestGetWindowView(unittest.TestCase):
+
+    def test_windows(self):
+        win_view = get_window_view(image, 6, 4)
+        self.assertEqual(win_view.shape, (15, 14, 6, 4))
+        for x_ind, y_ind in [(0, 0), (3, 5), (14, 13)]:
+            self.assertTrue(np.array_equal(win_view[x_ind, y_ind], image[x_ind:x_ind + 6, y_ind:y_ind + 4]))
+        self.assertFalse(win_view.flags.writeable)
+
+    def test_window_too_large(self):
+        with self.assertRaises(ValueError):
+            _ = get_window_view(image, 21, 4)
+
+
+class TestWindowFFT(unittest.TestCase):
+
+    def test_stack_matches_single(self):
+        win_stack = get_window_view(image, 6, 4)[::5, ::5].reshape(-1, 6, 4)
+        stacked = ImageWindow.win_comp_fft_func(win_stack)
+        for win_ind, window in enumerate(win_stack):
+            single = ImageWindow.win_comp_fft_func(window)
+            for field in single.dtype.names:
+                self.assertTrue(np.allclose(stacked[win_ind][field], single[field]))
+
+
+class TestOverlapAddWindows(unittest.TestCase):
+
+    def setUp(self):
+        x_steps = np.arange(0, 20 - 6 + 1, 2)
+        y_steps = np.arange(0, 17 - 4 + 1, 3)
+        self.win_pos = np.array([np.repeat(x_steps, len(y_steps)), np.tile(y_steps, len(x_steps))]).T
+        self.windows = rand_state.rand(self.win_pos.shape[0], 6, 4, 2)
+
+    def __loop_overlap_add(self, windows):
+        accum = np.zeros((20, 17) + windows.shape[3:])
+        counts = np.zeros((20, 17), dtype=np.uint32)
+        for (x_ind, y_ind), window in zip(self.win_pos, windows):
+            accum[x_ind:x_ind + 6, y_ind:y_ind + 4] += window
+            counts[x_ind:x_ind + 6, y_ind:y_ind + 4] += 1
+        return accum, counts
+
+    def test_matches_loop(self):
+        exp_accum, exp_counts = self.__loop_overlap_add(self.windows[..., 0])
+        accum, counts = overlap_add_windows(self.windows[..., 0], self.win_pos, (20, 17))
+        self.assertTrue(np.allclose(accum, exp_accum))
+        self.assertTrue(np.array_equal(counts, exp_counts))
+
+    def test_batches_with_components(self):
+        exp_accum, exp_counts = self.__loop_overlap_add(self.windows)
+        accum, counts = None, None
+        for start in range(0, self.win_pos.shape[0], 7):
+            accum, counts = overlap_add_windows(self.windows[start:start + 7], self.win_pos[start:start + 7],
+                                                (20, 17), accum=accum, counts=counts)
+        self.assertTrue(np.allclose(accum, exp_accum))
+        self.assertTrue(np.array_equal(counts, exp_counts))
+
+
+class TestRadialProfile(unittest.TestCase):
+
+    def test_stack_matches_masks(self):
+        stack = rand_state.rand(2, 3, 15, 12)
+        r_edges = np.linspace(0, 6, 7)
+        rad_avg, rad_max, rad_min, rad_std = radial_profile(stack, r_edges)
+        self.assertEqual(rad_avg.shape, (2, 3, 6))
+
+        r_mat = np.sqrt((np.arange(15) - 7)[:, None] ** 2 + (np.arange(12) - 6)[None, :] ** 2)
+        for bin_ind in range(6):
+            mask = np.logical_and(r_mat >= r_edges[bin_ind], r_mat < r_edges[bin_ind + 1])
+            if bin_ind == 5:
+                mask = np.logical_or(mask, r_mat == r_edges[-1])
+            vals = stack[..., mask]
+            self.assertTrue(np.allclose(rad_avg[..., bin_ind], np.mean(vals, axis=-1)))
+            self.assertTrue(np.allclose(rad_max[..., bin_ind], np.max(vals, axis=-1)))
+            self.assertTrue(np.allclose(rad_min[..., bin_ind], np.min(vals, axis=-1)))
+            self.assertTrue(np.allclose(rad_std[..., bin_ind], np.std(vals, axis=-1)))
+
+    def test_empty_bins(self):
+        rad_avg, rad_max, _, _ = radial_profile(image, [0, 0.5, 0.9, 1])
+        self.assertTrue(np.all(np.isnan(rad_avg[1])) and np.all(np.isnan(rad_max[1])))
+        self.assertEqual(rad_avg[0], image[10, 8])
+
+    def test_odd_size_fft(self):
+        # the radius is measured from the zero frequency pixel for both even and odd sizes
+        r_edges = np.arange(-0.5, 20)
+        for size in [64, 65]:
+            x_vec = np.arange(size)
+            lattice = np.cos(2 * np.pi * x_vec[:, None] * 8 / size) + np.cos(2 * np.pi * x_vec[None, :] * 5 / size)
+            fft_abs = np.abs(np.fft.fftshift(np.fft.fft2(lattice)))
+            rad_max = radial_profile(fft_abs, r_edges)[1]
+            self.assertTrue(np.allclose(rad_max[[5, 8]], size ** 2 / 2))
+            self.assertTrue(np.allclose(np.delete(rad_max, [5, 8]), 0, atol=1E-8))
+
+
+class TestWindowSizeExtract(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_odd_size(self):
+        results = []
+        for size in [64, 65]:
+            x_vec = np.arange(size)
+            lattice = np.cos(2 * np.pi * x_vec[:, None] / 8) + np.cos(2 * np.pi * x_vec[None, :] / 8)
+            with h5py.File(file_path, mode='w') as h5_f:
+                h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+                h5_main = write_main_dataset(h5_grp, lattice.reshape(-1, 1), 'Raw_Data', 'Height', 'nm',
+                                             [Dimension('X', 'm', size), Dimension('Y', 'm', size)],
+                                             Dimension('arb', 'a.u.', 1))
+                results.append(ImageWindow(h5_main, reset=False, cores=1).window_size_extract(save_plots=False))
+        # an extra row and column do not change the estimate for the same lattice
+        self.assertEqual(results[0][0], 16)
+        self.assertEqual(results[1][0], 16)
+        self.assertAlmostEqual(results[0][1], results[1][1], places=5)
+
+
+class TestWindowRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.size_x, self.size_y = 40, 34
+        self.win_x, self.win_y, self.step = 8, 6, 3
+        x_vec = np.arange(self.size_x)
+        y_vec = np.arange(self.size_y)
+        self.image = np.cos(2 * np.pi * x_vec[:, None] / 6) + np.cos(2 * np.pi * y_vec[None, :] / 6) + \
+            0.1 * rand_state.rand(self.size_x, self.size_y)
+        # the step does not divide the image so the last rows and columns are not covered by any window
+        self.cover_x = (self.size_x - self.win_x) // self.step * self.step + self.win_x
+        self.cover_y = (self.size_y - self.win_y) // self.step * self.step + self.win_y
+        self.h5_f = h5py.File(file_path, mode='w')
+        self.h5_f.attrs['normalized'] = False
+        h5_grp = self.h5_f.create_group('Measurement_000/Channel_000')
+        h5_main = write_main_dataset(h5_grp, self.image.reshape(-1, 1), 'Raw_Data', 'Height', 'nm',
+                                     [Dimension('X', 'm', self.size_x), Dimension('Y', 'm', self.size_y)],
+                                     Dimension('arb', 'a.u.', 1))
+        self.win_proc = ImageWindow(h5_main, reset=False, cores=1)
+        self.h5_wins = self.win_proc.do_windowing(win_x=self.win_x, win_y=self.win_y, win_step_x=self.step,
+                                                  win_step_y=self.step, save_plots=False)
+
+    def tearDown(self):
+        self.h5_f.close()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __check_rebuilt(self, rebuilt, atol=1E-6):
+        rebuilt = np.reshape(rebuilt, (self.size_x, self.size_y))
+        self.assertTrue(np.allclose(rebuilt[:self.cover_x, :self.cover_y],
+                                    self.image[:self.cover_x, :self.cover_y], atol=atol))
+        self.assertTrue(np.all(rebuilt[self.cover_x:] == 0))
+        self.assertTrue(np.all(rebuilt[:, self.cover_y:] == 0))
+
+    def test_windows(self):
+        n_x = (self.size_x - self.win_x) // self.step + 1
+        n_y = (self.size_y - self.win_y) // self.step + 1
+        self.assertEqual(self.h5_wins.shape, (n_x * n_y, self.win_x * self.win_y))
+        self.assertEqual(self.h5_wins.parent.attrs['win_step_y'], self.step)
+        win_pos = self.h5_f[self.h5_wins.attrs['Position_Indices']][()]
+        for win_ind in [0, n_y - 1, n_y, n_x * n_y - 1]:
+            x_ind, y_ind = win_pos[win_ind]
+            self.assertTrue(np.allclose(self.h5_wins[win_ind]['Image Data'].reshape(self.win_x, self.win_y),
+                                        self.image[x_ind:x_ind + self.win_x, y_ind:y_ind + self.win_y]))
+
+    def test_build_clean_image(self):
+        # a small memory limit forces the windows to be streamed in several batches
+        self.win_proc.max_memory = 20000
+        h5_clean = self.win_proc.build_clean_image(self.h5_wins)
+        self.__check_rebuilt(h5_clean[()])
+
+    def test_build_clean_image_default_positions(self):
+        # windows without position indices fall back on the grid of origins from the window steps
+        h5_plain = self.h5_wins.parent.create_dataset('Plain_Windows', data=self.h5_wins[()]['Image Data'])
+        self.win_proc.max_memory = 20000
+        h5_clean = self.win_proc.build_clean_image(h5_plain)
+        self.__check_rebuilt(h5_clean[()])
+
+    def test_clean_and_build(self):
+        num_comps = self.win_x * self.win_y
+        SVD(self.h5_wins, num_components=num_comps).compute()
+        self.win_proc.max_memory = 200000
+        h5_clean = self.win_proc.clean_and_build_batch(self.h5_wins)
+        self.__check_rebuilt(h5_clean[()], atol=1E-4)
+        h5_comps = self.win_proc.clean_and_build_separate_components(self.h5_wins)
+        self.assertEqual(h5_comps.shape, (self.size_x * self.size_y, num_comps))
+        self.__check_rebuilt(h5_comps[()].sum(axis=1), atol=1E-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:57:41 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+from scipy.ndimage import shift, gaussian_filter
+sys.path.append("../../../pycroscopy/")
+from skimage.feature import register_translation, match_descriptors, ORB
+from skimage.transform import SimilarityTransform, EuclideanTransform
+from pycroscopy.processing.contrib.image_transformation import geoTransformerParallel, TranslationTransform, \
+    get_chain_matrices, get_chain_transforms, register_frame_pairs, FeatureExtractor, match_descriptor_pairs
+
+file_path = 'test_image_transformation.h5'
+cache_path = 'test_image_transformation_cache.h5'
+
+num_frames = 6
+dim = 32
+
+
+def _get_drift_series():
+    rand_state = np.random.RandomState(0)
+    base = gaussian_filter(rand_state.rand(dim + 16, dim + 16), 2)
+    drift = np.round(np.cumsum(rand_state.randn(num_frames, 2), axis=0))
+    frames = np.array([shift(base, offset)[8:-8, 8:-8] for offset in drift])
+    return np.float32(frames), drift
+
+
+class TestGeoTransformerParallel(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_correlation_processes(self):
+        frames, drift = _get_drift_series()
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_frames = h5_f.create_dataset('Frames', data=frames.reshape(num_frames, -1))
+            trans = geoTransformerParallel()
+            trans.loadData(h5_frames)
+            shifts = trans.correlationTransformation(processors=2)
+        self.assertEqual(len(shifts), num_frames - 1)
+        self.assertTrue(np.allclose(shifts, drift[:-1] - drift[1:]))
+
+    def test_apply_to_h5(self):
+        frames, _ = _get_drift_series()
+        # content moves by 1 row and -2 columns from each frame to the next
+        translations = [(1, -2)] * (num_frames - 1)
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_frames = h5_f.create_dataset('Frames', data=frames.reshape(num_frames, -1))
+            h5_output = h5_f.create_dataset('Aligned', shape=h5_frames.shape, dtype=h5_frames.dtype)
+            trans = geoTransformerParallel()
+            trans.loadData(h5_frames)
+            # tiny memory budget to force several chunks
+            _, chain = trans.applyTransformation([TranslationTransform(translation=offset) for offset in translations],
+                                                 output=h5_output, origin=0, max_mem_mb=0.01)
+            aligned = h5_output[()].reshape(num_frames, dim, dim)
+
+        self.assertEqual(len(chain), num_frames)
+        for frame_ind in range(num_frames):
+            expected = shift(frames[frame_ind], (-frame_ind, 2 * frame_ind), order=1)
+            self.assertTrue(np.allclose(aligned[frame_ind, 12:-12, 12:-12], expected[12:-12, 12:-12], atol=1E-5))
+
+
+class TestAlignDriftSeries(unittest.TestCase):
+
+    def setUp(self):
+        # frames drifting by a known 3 rows and -5 columns per frame
+        rand_state = np.random.RandomState(0)
+        base = gaussian_filter(rand_state.rand(144, 144), 2)
+        self.frames = np.array([shift(base, (3 * ind, -5 * ind), order=1)[24:-24, 24:-24] for ind in range(5)])
+        self.trans = geoTransformerParallel()
+        self.trans.loadData(self.frames.reshape(5, -1))
+
+    def __check_aligned(self, aligned, origin, atol):
+        for frame in aligned:
+            self.assertTrue(np.allclose(frame[20:-20, 20:-20], self.frames[origin, 20:-20, 20:-20], atol=atol))
+
+    def test_features(self):
+        extractor = FeatureExtractor('ORB', 'skimage', n_keypoints=100)
+        extractor.load_data(self.frames.reshape(5, -1))
+        self.trans.loadFeatures(extractor.getFeatures())
+        _, matches = self.trans.matchFeatures()
+        transforms, _ = self.trans.findTransformation(EuclideanTransform, matches, 1, min_samples=3,
+                                                      residual_threshold=2, max_trials=200)
+        # keypoints are [y, x] so the estimated translations are (row, column)
+        self.assertTrue(np.allclose([trans.translation for trans in transforms], (3, -5), atol=0.2))
+        aligned, _ = self.trans.applyTransformation(transforms, origin=0)
+        self.__check_aligned(aligned, 0, 0.1)
+
+    def test_correlation(self):
+        shifts = self.trans.correlationTransformation()
+        aligned, _ = self.trans.applyTransformation([TranslationTransform(translation=tuple(-offset))
+                                                     for offset in shifts], origin=2)
+        self.__check_aligned(aligned, 2, 1E-10)
+
+
+class TestRegisterFramePairs(unittest.TestCase):
+
+    def test_matches_register_translation(self):
+        rand_state = np.random.RandomState(0)
+        # non-square frames with subpixel drift
+        frames = gaussian_filter(rand_state.rand(4, 27, 20), (0, 1.5, 1.5))
+        ref_inds, mov_inds = np.array([3, 0, 0, 2]), np.array([1, 1, 2, 0])
+        for upsample_factor in [1, 20]:
+            shifts = register_frame_pairs(frames, ref_inds, mov_inds, upsample_factor=upsample_factor)
+            expected = [register_translation(frames[ref], frames[mov], upsample_factor=upsample_factor)[0]
+                        for ref, mov in zip(ref_inds, mov_inds)]
+            self.assertTrue(np.allclose(shifts, expected))
+
+    def test_against_reference_frame(self):
+        frames, drift = _get_drift_series()
+        trans = geoTransformerParallel()
+        trans.loadData(frames.reshape(num_frames, -1))
+        shifts = trans.correlationTransformation(reference=2, max_mem_mb=0.05)
+        self.assertEqual(len(shifts), num_frames)
+        self.assertTrue(np.allclose(shifts, drift[2] - drift))
+
+
+class TestFeatureExtractor(unittest.TestCase):
+
+    def tearDown(self):
+        for path in [file_path, cache_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_features_cached(self):
+        frames = gaussian_filter(np.random.RandomState(0).rand(3, 80, 80), (0, 1, 1))
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_frames = h5_f.create_dataset('Frames', data=frames.reshape(3, -1))
+            extractor = FeatureExtractor('ORB', 'skimage', cache_path=cache_path, n_keypoints=20, downscale=1.5,
+                                         n_scales=2)
+            extractor.load_data(h5_frames)
+            keypts, descs = extractor.getFeatures()
+
+            detector = ORB(n_keypoints=20, downscale=1.5, n_scales=2)
+            image = (frames[2] - frames[2].mean()) / np.std(frames[2])
+            image[image < 0] = 0
+            detector.detect_and_extract(image)
+            self.assertTrue(np.array_equal(keypts[2], detector.keypoints.astype('int')))
+            self.assertTrue(np.array_equal(descs[2], detector.descriptors))
+
+            # features are read back from the cache, but only for the same detector parameters
+            cached_keypts, cached_descs = extractor.getFeatures()
+            for frame_ind in range(3):
+                self.assertTrue(np.array_equal(cached_keypts[frame_ind], keypts[frame_ind]))
+                self.assertTrue(np.array_equal(cached_descs[frame_ind], descs[frame_ind]))
+            extractor = FeatureExtractor('ORB', 'skimage', cache_path=cache_path, n_keypoints=10, downscale=1.5,
+                                         n_scales=2)
+            extractor.load_data(h5_frames)
+            self.assertEqual(len(extractor.getFeatures()[0][0]), 10)
+        with h5py.File(cache_path, mode='r') as h5_cache:
+            self.assertEqual(len(h5_cache.keys()), 2)
+
+    def test_cache_shared_by_datasets(self):
+        rand_state = np.random.RandomState(1)
+        frames = [gaussian_filter(rand_state.rand(2, 80, 80), (0, 1, 1)).reshape(2, -1) for _ in range(3)]
+        with h5py.File(file_path, mode='w') as h5_f:
+            sources = [h5_f.create_dataset('Frames_{}'.format(ind), data=frames[ind]) for ind in range(2)]
+            # arrays are identified by their contents rather than by the object holding them
+            sources += [frames[2], frames[2].copy(), frames[0]]
+            all_keypts = []
+            for source in sources:
+                extractor = FeatureExtractor('ORB', 'skimage', cache_path=cache_path, n_keypoints=20,
+                                             downscale=1.5, n_scales=2)
+                extractor.load_data(source)
+                all_keypts.append(extractor.getFeatures()[0])
+        with h5py.File(cache_path, mode='r') as h5_cache:
+            self.assertEqual(len(h5_cache.keys()), 4)
+
+        # features of frames with the same shape are never read from the cache entry of another dataset
+        for source_ind, frames_ind in enumerate([0, 1, 2, 2, 0]):
+            extractor = FeatureExtractor('ORB', 'skimage', n_keypoints=20, downscale=1.5, n_scales=2)
+            extractor.load_data(frames[frames_ind])
+            for cached, fresh in zip(all_keypts[source_ind], extractor.getFeatures()[0]):
+                self.assertTrue(np.array_equal(cached, fresh))
+
+
+class TestMatchDescriptorPairs(unittest.TestCase):
+
+    def test_matches_match_descriptors(self):
+        rand_state = np.random.RandomState(0)
+        for descs in [[rand_state.rand(num_desc, 32) > 0.5 for num_desc in [30, 45, 0, 25]],
+                      [rand_state.randn(num_desc, 8) for num_desc in [30, 45, 0, 25]]]:
+            ref_inds, mov_inds = np.array([0, 1, 3, 2]), np.array([1, 3, 0, 1])
+            for kwargs in [dict(), dict(max_ratio=0.8), dict(cross_check=False)]:
+                # tiny memory budget to force several batches of pairs
+                matches = match_descriptor_pairs(descs, ref_inds, mov_inds, max_mem_mb=0.01, **kwargs)
+                for match, ref, mov in zip(matches[:3], ref_inds, mov_inds):
+                    self.assertTrue(np.array_equal(match, match_descriptors(descs[ref], descs[mov], **kwargs)))
+                self.assertEqual(matches[3].shape[0], 0)
+
+
+class TestChainTransforms(unittest.TestCase):
+
+    def test_translation_prefix_sums(self):
+        rand_state = np.random.RandomState(0)
+        steps = rand_state.randn(9, 2)
+        transforms = [TranslationTransform(translation=list(step)) for step in np.float32(steps)]
+        for origin in [0, 4, 9]:
+            chain = get_chain_transforms(transforms, origin=origin)
+            self.assertEqual(len(chain), 10)
+            for frame_ind, trans in enumerate(chain):
+                if frame_ind >= origin:
+                    expected = np.sum(steps[origin:frame_ind], axis=0)
+                else:
+                    expected = -np.sum(steps[frame_ind:origin], axis=0)
+                # (row, column) steps become (x, y) = (column, row) translations
+                self.assertTrue(np.allclose(trans.translation, expected[::-1], atol=1E-5))
+
+    def test_matrices_compose_in_order(self):
+        rand_state = np.random.RandomState(1)
+        transforms = [SimilarityTransform(rotation=rot, translation=trans)
+                      for rot, trans in zip(rand_state.randn(5) * 0.1, rand_state.randn(5, 2))]
+        chain = get_chain_matrices([trans.params for trans in transforms], origin=2)
+        self.assertTrue(np.allclose(chain[2], np.eye(3)))
+        self.assertTrue(np.allclose(chain[5], np.dot(transforms[4].params,
+                                                     np.dot(transforms[3].params, transforms[2].params))))
+        self.assertTrue(np.allclose(chain[0], np.linalg.inv(np.dot(transforms[1].params, transforms[0].params))))
+
+        # the chained transforms are the same maps expressed in (x, y) instead of (row, column) coordinates
+        swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
+        chain_transforms = get_chain_transforms(transforms, origin=2, transformation='rotation')
+        self.assertTrue(np.allclose([np.dot(swap, np.dot(trans.params, swap)) for trans in chain_transforms], chain))
+
+    def test_invalid_inputs(self):
+        with self.assertRaises(ValueError):
+            _ = get_chain_matrices(np.tile(np.eye(3), (3, 1, 1)), origin=4)
+        with self.assertRaises(ValueError):
+            _ = get_chain_transforms([TranslationTransform(translation=[1, 2])], transformation='shear')
+
+
+if __name__ == '__main__':
+    unittest.main()
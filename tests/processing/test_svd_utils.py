@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:05:32 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import sys
+import h5py
+import numpy as np
+from sklearn.utils.extmath import randomized_svd
+from sklearn.decomposition import KernelPCA
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pyUSID.io.dtype_utils import check_dtype
+from pyUSID import USIDataset
+from pycroscopy.processing.svd_utils import streamed_randomized_svd, rebuild_svd, simplified_kpca, SVD
+
+file_path = 'test_svd_utils.h5'
+
+
+def _write_low_rank_dataset(h5_f, data):
+    h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+    return write_main_dataset(h5_grp, data, 'Raw_Data', 'Current', 'nA', Dimension('X', 'm', data.shape[0]),
+                              Dimension('Bias', 'V', data.shape[1]))
+
+
+def _get_low_rank_matrix(num_rows, num_cols):
+    rand_state = np.random.RandomState(42)
+    weights = np.diag(np.linspace(10, 1, num=8))
+    return np.dot(np.dot(rand_state.randn(num_rows, 8), weights), rand_state.randn(8, num_cols))
+
+
+class TestStreamedRandomizedSVD(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def __compare_with_in_memory(self, data):
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = _write_low_rank_dataset(h5_f, data)
+            func = check_dtype(h5_main)[0]
+            exp_u, exp_s, exp_v = randomized_svd(func(h5_main[()]), 5, n_iter=3)
+            # tiny memory budget to force several blocks
+            u_mat, s_vec, v_mat = streamed_randomized_svd(h5_main, 5, n_iter=3, max_mem_mb=0.005)
+        self.assertTrue(np.allclose(exp_s, s_vec, rtol=1E-4))
+        self.assertTrue(np.allclose(exp_u, u_mat, atol=1E-4))
+        self.assertTrue(np.allclose(exp_v, v_mat, atol=1E-4))
+
+    def test_real_tall(self):
+        self.__compare_with_in_memory(_get_low_rank_matrix(400, 50))
+
+    def test_real_wide(self):
+        self.__compare_with_in_memory(_get_low_rank_matrix(30, 200))
+
+    def test_complex(self):
+        data = _get_low_rank_matrix(400, 50)
+        self.__compare_with_in_memory(data[:, :25] + 1j * data[:, 25:])
+
+    def test_compound(self):
+        data = _get_low_rank_matrix(400, 50)
+        struc_data = np.zeros(shape=(400, 25), dtype=np.dtype([('amp', np.float32), ('phase', np.float32)]))
+        struc_data['amp'] = data[:, :25]
+        struc_data['phase'] = data[:, 25:]
+        self.__compare_with_in_memory(struc_data)
+
+
+class TestRebuildSVD(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_rebuild_and_resume(self):
+        data = np.float32(_get_low_rank_matrix(2000, 64))
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = USIDataset(_write_low_rank_dataset(h5_f, data))
+            SVD(h5_main, num_components=8).compute()
+
+            h5_rebuilt = rebuild_svd(h5_main, components=8, cores=2, max_RAM_mb=1)
+            self.assertEqual(h5_rebuilt.dtype, np.float32)
+            self.assertEqual(h5_rebuilt.parent.attrs['last_pixel'], data.shape[0])
+            self.assertTrue(np.allclose(h5_rebuilt[()], data, atol=1E-3))
+
+            # Simulate an interrupted reconstruction:
+            h5_rebuilt.parent.attrs['last_pixel'] = 500
+            h5_rebuilt[500:] = 0
+            h5_resumed = rebuild_svd(h5_main, components=8, cores=2, max_RAM_mb=1)
+            self.assertEqual(h5_resumed.name, h5_rebuilt.name)
+            self.assertEqual(h5_resumed.parent.attrs['last_pixel'], data.shape[0])
+            self.assertTrue(np.allclose(h5_resumed[()], data, atol=1E-3))
+
+
+class TestSimplifiedKPCA(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_linear_kernel_matches_svd(self):
+        data = _get_low_rank_matrix(500, 40)
+        proj, scree, eig_vecs = simplified_kpca(KernelPCA(n_components=5, kernel='linear'), data,
+                                                landmark_threshold=None)
+        _, s_vec, v_mat = np.linalg.svd(data - np.mean(data, axis=0), full_matrices=False)
+        self.assertEqual(proj.shape, (500, 5))
+        self.assertTrue(np.allclose(scree, s_vec[:5] ** 2))
+        self.assertTrue(np.allclose(np.abs(eig_vecs), np.abs(v_mat[:5]), atol=1E-6))
+
+    def test_landmarks_written_to_h5(self):
+        data = np.float32(_get_low_rank_matrix(2000, 32))
+        exp_proj, exp_scree, _ = simplified_kpca(KernelPCA(n_components=2, kernel='linear'), data,
+                                                 landmark_threshold=None)
+        with h5py.File(file_path, mode='w') as h5_f:
+            h5_main = _write_low_rank_dataset(h5_f, data)
+            h5_u, scree, eig_vecs = simplified_kpca(KernelPCA(n_components=2, kernel='linear'), h5_main,
+                                                    num_landmarks=400, landmark_threshold=1000, max_mem_mb=0.01)
+            h5_grp = h5_u.parent
+            self.assertEqual(h5_u.shape, (2000, 2))
+            self.assertEqual(h5_grp.attrs['num_landmarks'], 400)
+            self.assertEqual(h5_grp['V'].shape, (2, 32))
+            self.assertTrue(np.allclose(h5_grp['S'][()], scree))
+            proj = h5_u[()]
+        self.assertTrue(np.allclose(scree, exp_scree, rtol=0.2))
+        for comp_ind in range(2):
+            self.assertGreater(np.abs(np.corrcoef(proj[:, comp_ind], exp_proj[:, comp_ind])[0, 1]), 0.95)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:23:31 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.processing.tree import ClusterTree, LinkageTree
+
+num_clusters = 7
+num_pos = 500
+rand_state = np.random.RandomState(0)
+labels = rand_state.randint(0, num_clusters, size=num_pos)
+centroids = rand_state.rand(num_clusters, 16)
+linkage_pairing = linkage(pdist(centroids), 'weighted')
+
+
+class TestLinkageTree(unittest.TestCase):
+
+    def setUp(self):
+        self.ref_tree = ClusterTree(linkage_pairing[:, :2], labels, distances=linkage_pairing[:, 2],
+                                    centroids=centroids)
+        self.tree = LinkageTree(linkage_pairing[:, :2], labels, distances=linkage_pairing[:, 2],
+                                centroids=centroids)
+
+    def test_num_nodes(self):
+        self.assertEqual(self.tree.num_nodes, len(self.ref_tree.nodes))
+        self.assertEqual(self.tree.root, self.ref_tree.tree.name)
+
+    def test_members_match_cluster_tree(self):
+        for node in self.ref_tree.nodes:
+            self.assertTrue(np.array_equal(np.sort(self.tree.get_members(node.name)), np.ravel(node.labels)))
+            self.assertEqual(self.tree.sizes[node.name], np.size(node.labels))
+
+    def test_centroids_match_cluster_tree(self):
+        for node in self.ref_tree.nodes:
+            self.assertTrue(np.allclose(self.tree.centroids[node.name], node.value))
+
+    def test_children_and_levels(self):
+        for node in self.ref_tree.nodes:
+            self.assertEqual(self.tree.levels[node.name], node.level)
+            self.assertEqual(list(self.tree.get_children(node.name)), [child.name for child in node.children])
+            for child in node.children:
+                self.assertEqual(self.tree.parents[child.name], node.name)
+
+    def test_leaves_contiguous(self):
+        leaves = self.tree.get_leaves(self.tree.root)
+        self.assertTrue(np.array_equal(np.sort(leaves), np.arange(num_clusters)))
+        for node in range(self.tree.num_nodes):
+            members = self.tree.get_members(node)
+            self.assertTrue(np.all(np.in1d(labels[members], self.tree.get_leaves(node))))
+
+    def test_top_down_order(self):
+        visited = set()
+        for node in self.tree.get_top_down_order():
+            if node != self.tree.root:
+                self.assertTrue(self.tree.parents[node] in visited)
+            visited.add(node)
+
+
+if __name__ == '__main__':
+    unittest.main()
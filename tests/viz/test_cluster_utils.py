@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 00:25:34 2026
+
+@author: agent
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.viz.cluster_utils import plot_cluster_dendrogram
+
+
+class TestPlotClusterDendrogram(unittest.TestCase):
+
+    def tearDown(self):
+        plt.close('all')
+
+    def test_float_labels(self):
+        rand_state = np.random.RandomState(0)
+        label_mat = rand_state.randint(0, 4, size=(6, 5))
+        e_vals = rand_state.rand(6, 5, 3)
+        int_fig = plot_cluster_dendrogram(label_mat, e_vals, 2, 4)
+        float_fig = plot_cluster_dendrogram(np.float64(label_mat), e_vals, 2, 4)
+        int_leaves = [text.get_text() for text in int_fig.axes[0].get_xticklabels()]
+        float_leaves = [text.get_text() for text in float_fig.axes[0].get_xticklabels()]
+        self.assertEqual(len(float_leaves), 4)
+        self.assertEqual(float_leaves, int_leaves)
+
+
+if __name__ == '__main__':
+    unittest.main()